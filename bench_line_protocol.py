@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+# bench_line_protocol.py v.20261018.1
+# copyright 2023 John Ackermann N8UR jra@febo.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Micro-benchmark of the schema encoders in maser_funcs.py against the
+# string-building functions they replaced, which are kept below
+# unchanged apart from the ?STAT fix.  Both sides turn one cycle of
+# canned maser replies into encoded line protocol bytes.  The readings
+# change from cycle to cycle (there are variants replies of each, with
+# the first value's last digits changed) but the status replies don't,
+# as on the real maser.  Note that the old functions pass whatever text
+# the maser sent straight through, while the schemas check that the
+# float fields are numbers.
+#
+# The schemas are benchmarked without their deadbands, which leave
+# most of the status fields out of the lines and so do less work than
+# the old functions rather than the same work faster.
+#
+# Usage: bench_line_protocol.py [cycles]
+
+import sys
+import time
+import timeit
+
+from maser_funcs import *
+
+cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+variants = 97
+
+# one cycle of maser replies, already split into tokens
+replies = [
+    "7.1 7.0 7.2 7.1 5.9 3.3".split(),
+    "26.9 27.8 27.9 15.02 -15.01 5.02".split(),
+    "3512 1.25e-06 0.52 0.13 1.1 0.284 11.9 4.2".split(),
+    "0.002 2046 1932 45.1 1.3 0.12 688".split(),
+    "0.03 11.2 0.02 10.8 0.05 12.1".split(),
+    "0".split(),
+    "N0=12 C0=3 Nc=0 C=1 Nf=4 dF=0.0 R=5 n=2 s=0 phi=0.13 NSN=1".split(),
+    "1".split(),
+    "5000000.0".split(),
+    "0".split(),
+    ]
+
+schemas = [ Schema(s.measurement, s.tags, s.fields, s.parse,
+        check=s.check)
+        for s in [ rss_schema, pwr_schema, kvd_schema, fll_schema,
+        thr_schema, navstat_schema, ppsmea_schema, esynsig_schema,
+        synth_schema, stat_schema ] ]
+
+# the replies that are readings, and the variants of each cycle's
+readings = [0, 1, 2, 3, 4, 6]
+cycle_replies = []
+for k in range(variants):
+    cycle = [list(r) for r in replies]
+    for x in readings:
+        cycle[x][-1] = cycle[x][-1] + '%02d' % k
+    cycle_replies.append(cycle)
+cycle_count = 0
+
+def next_replies():
+    global cycle_count
+    cycle_count = cycle_count + 1
+    return cycle_replies[cycle_count % variants]
+
+##### The replaced functions #####
+
+def rss_func(t, fields):
+    msg = \
+            " 5MHz_#1_level=" + str(fields[0]) + \
+            ",5MHz_#2_level=" + str(fields[1]) + \
+            ",10MHz_#1_level=" + str(fields[2]) + \
+            ",10MHz_#2_level=" + str(fields[3]) + \
+            ",100MHz_level=" + str(fields[4]) + \
+            ",2048kHz_level=" + str(fields[5]) + \
+            " " + t + \
+            "\n"
+    return msg
+
+def pwr_func(t, fields):
+    msg = \
+            " bat_vdc=" + str(fields[0]) + \
+            ",ext_27_vdc=" + str(fields[1]) + \
+            ",int_27vdc=" + str(fields[2]) + \
+            ",int+15vdc=" + str(fields[3]) + \
+            ",int-15vdc=" + str(fields[4]) + \
+            ",int+5vdc=" + str(fields[5]) + \
+            " " + t + \
+            "\n"
+    return msg
+
+def kvd_func(t, fields):
+    msg = \
+            " ion_volts=" + str(fields[0]) + \
+            ",ion_current=" + str(fields[1]) + \
+            ",pur_volts=" + str(fields[2]) + \
+            ",pur_current=" + str(fields[3]) + \
+            ",h_press=" + str(fields[4]) + \
+            ",hfo_current=" + str(fields[5]) + \
+            ",hfo_volts=" + str(fields[6]) + \
+            ",dis_volts=" + str(fields[7]) + \
+            " " + t + \
+            "\n"
+    return msg
+
+def fll_func(t, fields):
+    msg = \
+            " 2nd_harm=" + str(fields[0]) + \
+            ",xtal_dac=" + str(fields[1]) + \
+            ",resonator_dac=" + str(fields[2]) + \
+            ",afc_tmp=" + str(fields[3]) + \
+            ",if_level=" + str(fields[4]) + \
+            ",synth_output=" + str(fields[5]) + \
+            ",synth_dac=" + str(fields[6]) + \
+            " " + t + \
+            "\n"
+    return msg
+
+def thr_func(t, fields):
+    msg = \
+            " cav_side_mismatch=" + str(fields[0]) + \
+            ",cav_side_pwr=" + str(fields[1]) + \
+            ",cav_base_mismatch=" + str(fields[2]) + \
+            ",cav_base_pwr=" + str(fields[3]) + \
+            ",h_src_mismatch=" + str(fields[4]) + \
+            ",h_src_pwr=" + str(fields[5]) + \
+            " " + t + \
+            "\n"
+    return msg
+
+def navstat_func(t, fields):
+    msg = \
+            " status=" + str(fields[0]) + \
+            " " + t + \
+            "\n"
+    return msg
+
+def ppsmea_func(t, fields):
+    # fields: N0, C0, Nc, C, Nf, dF, STOP/MEASURE, R,
+    # n, s, phi, NSN
+    # Guess what?  the "STOP/MEASURE" field
+    # goes away when we're measuring.
+    # we're going to strip their tag and supply
+    # our own, just to help document the code
+    count = 0
+    #print("fields going in to ppsmea_func:")
+    #print(fields)
+    if fields[6][:2] == "R=":
+        fields.insert(6,"MEASURING")
+
+    for x in fields:
+        if '=' in x:
+            fields[count] = x.split('=')[-1]
+        count  = count + 1
+
+    msg = \
+            " N0=" + str(fields[0]) + \
+            ",C0=" + str(fields[1]) + \
+            ",Nc=" + str(fields[2]) + \
+            ",C=" + str(fields[3]) + \
+            ",Nf=" + str(fields[4]) + \
+            ",dF=" + str(fields[5]) + \
+            ",measure_state=\"" + str(fields[6]) + "\"" \
+            ",R=" + str(fields[7]) + \
+            ",n=" + str(fields[8]) + \
+            ",s=" + str(fields[9]) + \
+            ",phi=" + str(fields[10]) + \
+            ",NSN=" + str(fields[11]) + \
+            " " + t + \
+            "\n"
+    return msg
+
+def esynsig_func(t, fields):
+    msg = \
+            " synsig=" + fields[0] + \
+            " " + t + "\n"
+    return msg
+
+def synth_func(t, fields):
+    msg = \
+            " freq=" + str(fields[0]) + \
+            " " + t + \
+            "\n"
+    return msg
+
+def stat_func(t, fields):
+    stat_int = int(fields[0])
+    msg = \
+            " stat_word_dec=\"" + str(stat_int) + "\""
+
+    # anything after the status word is diagnostic text
+    if len(fields) > 1:
+        diag = " ".join(fields[1:]).replace('"','\\"')
+        msg = msg + ",diag=\"" + diag + "\""
+    msg = msg + " " + t + "\n"
+    return msg
+
+legacy_funcs = [ rss_func, pwr_func, kvd_func, fll_func, thr_func,
+        navstat_func, ppsmea_func, esynsig_func, synth_func, stat_func ]
+
+##### Benchmark #####
+
+def run_legacy():
+    t = str(time.time_ns())
+    msg = []
+    replies = next_replies()
+    for x in range(len(legacy_funcs)):
+        # ppsmea_func edits its argument, so hand it a copy
+        m = legacy_funcs[x](t, list(replies[x]))
+        msg.append((measure_name + ",location=" + location + m).encode())
+    return msg
+
+buf = bytearray()
+def run_schema():
+    buf.clear()
+    t = time.time_ns()
+    replies = next_replies()
+    for x in range(len(schemas)):
+        schemas[x].encode_tokens_into(buf, replies[x], t)
+    return [bytes(buf)]
+
+def bench(funcs, repeat=7):
+    # best time per cycle of each of funcs, in us, taking turns so a
+    # busy spell on the machine doesn't land on just one of them
+    best = [None] * len(funcs)
+    for r in range(repeat):
+        for i,func in enumerate(funcs):
+            t = timeit.timeit(func, number=cycles)
+            if best[i] is None or t < best[i]:
+                best[i] = t
+    return [t / cycles * 1e6 for t in best]
+
+if __name__ == '__main__':
+    print("Sample output:")
+    print(run_schema()[0].decode(), end='')
+    old, new = bench([run_legacy, run_schema])
+    print("{} cycles of {} replies".format(cycles, len(replies)))
+    print("string concatenation: {:8.2f} us/cycle".format(old))
+    print("schema encoder:       {:8.2f} us/cycle".format(new))
+    print("ratio:                {:8.2f}x".format(old / new))
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+# bench_output.py v.20261018.1
+# copyright 2023 John Ackermann N8UR jra@febo.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Compare the two output paths for collected data, end to end:
+#
+#   telegraf: TelegrafSocket -> unixgram -> telegraf -> HTTP -> InfluxDB
+#   direct:   spool -> InfluxWriter (gzip) -> HTTP -> InfluxDB
+#
+# InfluxDB is replaced by a small local HTTP server that accepts
+# /api/v2/write, unzips the body and counts the lines.  Telegraf is
+# replaced by a process that does what telegraf's socket_listener and
+# influxdb_v2 output do with each point: read the datagram, parse each
+# line into measurement, tags, fields and time, serialize it again,
+# and POST gzip'd batches of metric_batch_size.  It's not telegraf, but
+# it pays the same extra hop, parse and re-serialization.
+#
+# Points are maser lines from the schemas in maser_funcs.py.  For each
+# path it reports points/sec from the first send until the stand-in
+# server has counted every point, and the CPU seconds used by the
+# collector side plus (for the telegraf path) the telegraf stand-in.
+# The CPU used by the HTTP server itself is left out of both.
+#
+# Usage: bench_output.py [points]
+
+import gzip
+import http.client
+import multiprocessing as mp
+import os
+import socket
+import sys
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from maser_funcs import *
+from logger_funcs import TelegrafSocket
+
+points = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+metric_batch_size = 1000    # telegraf's default
+flush_interval = 1.0        # seconds, for both paths
+
+##### InfluxDB stand-in #####
+
+def http_server(port_q, count):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            if self.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            n = sum(1 for x in body.split(b'\n') if x)
+            with count.get_lock():
+                count.value = count.value + n
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    srv = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    port_q.put(srv.server_address[1])
+    srv.serve_forever()
+
+##### telegraf stand-in #####
+
+def parse_line(line):
+    # split a line into (measurement, tags, fields, time) the way
+    # telegraf's parser does; escapes are ignored, ours have none
+    head, fieldset, t = line.rsplit(b' ', 2)
+    parts = head.split(b',')
+    tags = dict(x.split(b'=', 1) for x in parts[1:])
+    fields = dict(x.split(b'=', 1) for x in fieldset.split(b','))
+    return parts[0], tags, fields, int(t)
+
+def serialize(m, tags, fields, t):
+    return m + b''.join(b',' + k + b'=' + v for k,v in sorted(tags.items())) + \
+        b' ' + b','.join(k + b'=' + v for k,v in fields.items()) + \
+        b' %d' % t
+
+def telegraf(path, port, ready, cpu):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    sock.settimeout(flush_interval)
+    ready.set()
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    batch = []
+    last = time.monotonic()
+
+    def flush():
+        body = gzip.compress(b'\n'.join(batch) + b'\n')
+        conn.request('POST', '/api/v2/write?org=o&bucket=b&precision=ns',
+            body, {'Content-Encoding': 'gzip'})
+        conn.getresponse().read()
+        batch.clear()
+
+    while True:
+        try:
+            data = sock.recv(65536)
+        except socket.timeout:
+            data = None
+        if data == b'quit\n':
+            break
+        if data:
+            for line in data.splitlines():
+                batch.append(serialize(*parse_line(line)))
+        if batch and (len(batch) >= metric_batch_size or
+                time.monotonic() - last >= flush_interval):
+            flush()
+            last = time.monotonic()
+    if batch:
+        flush()
+    cpu.value = time.process_time()
+
+##### the two paths #####
+
+def make_lines(n):
+    # without the deadbands, which would leave the repeated rss lines
+    # empty
+    schemas = [ Schema(s.measurement, s.tags, s.fields, s.parse,
+        check=s.check)
+        for s in [rss_schema, pwr_schema, kvd_schema, fll_schema,
+        thr_schema] ]
+    replies = [
+        "7.1 7.0 7.2 7.1 5.9 3.3".split(),
+        "26.9 27.8 27.9 15.02 -15.01 5.02".split(),
+        "3512 1.25e-06 0.52 0.13 1.1 0.284 11.9 4.2".split(),
+        "0.002 2046 1932 45.1 1.3 0.12 688".split(),
+        "0.03 11.2 0.02 10.8 0.05 12.1".split(),
+        ]
+    t = time.time_ns()
+    lines = []
+    for i in range(n):
+        x = i % len(schemas)
+        lines.append(schemas[x].encode(replies[x], t + i))
+    return lines
+
+def wait_for(count, n, timeout=120):
+    end = time.monotonic() + timeout
+    while count.value < n and time.monotonic() < end:
+        time.sleep(0.01)
+    return count.value
+
+def run_telegraf(lines, port, count):
+    path = os.path.join(tempfile.mkdtemp(), 'telegraf.sock')
+    ready = mp.Event()
+    cpu = mp.Value('d', 0.0)
+    proc = mp.Process(target=telegraf, args=(path, port, ready, cpu))
+    proc.start()
+    ready.wait()
+    sender = TelegrafSocket(path)
+    count.value = 0
+    start = time.monotonic()
+    cpu0 = time.process_time()
+    # one cycle's worth of lines per send(), as the collectors do
+    for i in range(0, len(lines), 10):
+        sender.send(lines[i:i + 10])
+    cpu1 = time.process_time()
+    sender.send([b'quit\n'])
+    got = wait_for(count, len(lines))
+    wall = time.monotonic() - start
+    proc.join()
+    sender.close()
+    return got, wall, (cpu1 - cpu0) + cpu.value
+
+def run_direct(lines, port, count):
+    # the way logger_daemon.py does it: each cycle's lines go into the
+    # spool, and the drainer sends what has built up every
+    # flush_interval with synchronous writes
+    from influx_writer import InfluxWriter
+    from spool import Spool
+    writer = InfluxWriter(url='http://127.0.0.1:%d' % port, token='t',
+        org='o', bucket='b')
+    spool = Spool(tempfile.mkdtemp())
+    count.value = 0
+    start = time.monotonic()
+    cpu0 = time.process_time()
+    last = start
+    for i in range(0, len(lines), 10):
+        spool.append(lines[i:i + 10])
+        if time.monotonic() - last >= flush_interval:
+            spool.drain(writer, max_rate=float('inf'))
+            last = time.monotonic()
+    spool.close()
+    spool.drain(writer, max_rate=float('inf'))
+    writer.close()
+    cpu1 = time.process_time()
+    got = wait_for(count, len(lines))
+    wall = time.monotonic() - start
+    return got, wall, cpu1 - cpu0
+
+def report(name, n, result):
+    got, wall, cpu = result
+    print("{:9s} {:8d} of {:8d} points  {:10.0f} points/s  {:7.2f} CPU s".format(
+        name, got, n, got / wall, cpu))
+
+if __name__ == '__main__':
+    port_q = mp.Queue()
+    count = mp.Value('l', 0)
+    server = mp.Process(target=http_server, args=(port_q, count), daemon=True)
+    server.start()
+    port = port_q.get()
+
+    lines = make_lines(points)
+    report("telegraf", points, run_telegraf(lines, port, count))
+    try:
+        report("direct", points, run_direct(lines, port, count))
+    except ImportError:
+        print("direct: influxdb_client isn't installed (pip3 install influxdb-client)")
+    server.terminate()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+# bench_pushdown.py v.20261018.1
+# copyright 2023 John Ackermann N8UR jra@febo.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Benchmark of how influx_query.py picks fields: regex filters on
+# _measurement, _field and tags (the old way) against the equality
+# filters select_filter() builds now.  Both pick the same series, and
+# the results are checked to be the same; only the filter differs.
+#
+# This needs a real InfluxDB v2 server: a stand-in can't show what the
+# server's series index does.  The url, org and token are those in
+# influx_query.py unless given with --url, --org and --token, so a
+# throwaway server can be used, e.g.
+#
+#   docker run -p 8086:8086 -e DOCKER_INFLUXDB_INIT_MODE=setup \
+#       -e DOCKER_INFLUXDB_INIT_USERNAME=bench \
+#       -e DOCKER_INFLUXDB_INIT_PASSWORD=benchbench \
+#       -e DOCKER_INFLUXDB_INIT_ORG=bench \
+#       -e DOCKER_INFLUXDB_INIT_BUCKET=bench \
+#       -e DOCKER_INFLUXDB_INIT_ADMIN_TOKEN=benchtoken influxdb:2
+#   bench_pushdown.py --url http://localhost:8086 --org bench \
+#       --token benchtoken
+#
+# (the token must be allowed to create buckets).  A scratch bucket is made and filled with a day of one-a-minute points
+# for many series: measurements m000, m001... each with the same
+# fields f00, f01... (as instruments share field names like "temp")
+# and each written at several values of a location tag.  It is deleted
+# at the end.
+#
+# Each query is run repeat times after one run to warm up, and the
+# best time is reported.
+#
+# Usage: bench_pushdown.py [measurements] [hours] [--url URL]
+#            [--org ORG] [--token TOKEN]
+
+import argparse
+import time
+
+import numpy as np
+from influxdb_client import InfluxDBClient
+from influxdb_client.client.write_api import SYNCHRONOUS
+
+import influx_query as iq
+
+measurements = 50
+hours = 24
+num_fields = 20
+locations = 4
+repeat = 5
+batch_lines = 5000
+bench_bucket = 'bench_pushdown'
+start = 1672531200          # 2023-01-01T00:00:00Z
+
+# (name, fields, tags) queried both ways
+cases = [
+    ('4 fields, 1 instrument',
+        ['m003.f00','m003.f01','m003.f02','m003.f03'],
+        {'location': 'loc1'}),
+    ('same field, 2 instruments',
+        ['m003.f05','m007.f05'], {'location': 'loc2'}),
+    ('1 field, 1 instrument',
+        ['m011.f19'], {'location': 'loc0'}),
+    ]
+
+def make_lines(t):
+    # one line per measurement and location at unix time t
+    lines = []
+    for m in range(measurements):
+        for loc in range(locations):
+            v = np.sin(t / 3600 + m + loc * 0.1 + np.arange(num_fields))
+            lines.append('m%03d,location=loc%d ' % (m, loc) +
+                ','.join('f%02d=%.6f' % (i, x) for i,x in enumerate(v)) +
+                ' %d' % t)
+    return lines
+
+def fill(client):
+    write_api = client.write_api(write_options=SYNCHRONOUS)
+    lines = []
+    for t in range(start, start + hours * 3600, 60):
+        lines.extend(make_lines(t))
+        if len(lines) >= batch_lines:
+            write_api.write(bench_bucket, iq.org, lines, write_precision='s')
+            lines = []
+    if lines:
+        write_api.write(bench_bucket, iq.org, lines, write_precision='s')
+
+def flux_regex(s):
+    # s as a Flux regex matching only itself
+    return '/^' + ''.join('\\' + c if not c.isalnum() and c != '_'
+        else c for c in s) + '$/'
+
+def regex_filter(fields, tags):
+    # select_filter() as regex tests, the way build_query() used to
+    # match fields
+    by_measurement = {}
+    for m,name in map(iq.split_field, fields):
+        by_measurement.setdefault(m, []).append(name)
+    terms = []
+    for m,names in by_measurement.items():
+        term = 'r["_field"] =~ /^(' + '|'.join(flux_regex(n)[2:-2]
+            for n in names) + ')$/'
+        if m is not None:
+            term = 'r["_measurement"] =~ ' + flux_regex(m) + \
+                ' and ' + term
+        terms.append('(' + term + ')')
+    q = '|> filter(fn: (r) => ' + ' or '.join(terms) + ')'
+    if tags:
+        q = q + '|> filter(fn: (r) => ' + ' and '.join('r[' + \
+            iq.flux_string(k) + '] =~ ' + flux_regex(v) \
+            for k,v in sorted(tags.items())) + ')'
+    return q
+
+def run(client, query, columns):
+    best = None
+    for i in range(repeat + 1):
+        t0 = time.perf_counter()
+        rows = list(iq.pivot_rows(iq.query_records(client, query), columns))
+        t = time.perf_counter() - t0
+        if i and (best is None or t < best):
+            best = t
+    return rows, best
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="time regex against equality field filters")
+    parser.add_argument('measurements', type=int, nargs='?',
+        default=measurements)
+    parser.add_argument('hours', type=int, nargs='?', default=hours)
+    parser.add_argument('--url', default=iq.url)
+    parser.add_argument('--org', default=iq.org)
+    parser.add_argument('--token', default=iq.token)
+    args = parser.parse_args()
+    measurements = args.measurements
+    hours = args.hours
+    iq.org = args.org
+    series = measurements * locations * num_fields
+    points = series * hours * 60
+    with InfluxDBClient(url=args.url, token=args.token, org=args.org,
+            timeout=iq.timeout) as client:
+        buckets = client.buckets_api()
+        old = buckets.find_bucket_by_name(bench_bucket)
+        if old:
+            buckets.delete_bucket(old)
+        b = buckets.create_bucket(bucket_name=bench_bucket, org=iq.org)
+        try:
+            print("writing {:,} series, {:,} points...".format(series,
+                points))
+            fill(client)
+            a = iq.format_time(start)
+            z = iq.format_time(start + hours * 3600)
+            for name,fields,tags in cases:
+                q = iq.build_query(a, z, '10m', fields, bench_bucket, tags)
+                rq = q.replace(iq.select_filter(fields, tags),
+                    regex_filter(fields, tags))
+                columns = iq.column_names(fields)
+                new, t_new = run(client, q, columns)
+                old, t_old = run(client, rq, columns)
+                print("{:28s} regex {:7.3f} s   equality {:7.3f} s   "
+                    "{:5.1f}x   {} rows".format(name, t_old, t_new,
+                    t_old / t_new, len(new)))
+                if old != new:
+                    print("  results differ!")
+        finally:
+            buckets.delete_bucket(b)
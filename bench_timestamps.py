@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# bench_timestamps.py v.20261018.1
+# copyright 2023 John Ackermann N8UR jra@febo.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Benchmark of the timestamp handling in influx_query.py and
+# phm_plot.py, per row in Python (as they used to do it) against in
+# bulk with numpy (as they do now).  A synthetic influx_query.py
+# output file of one row a minute is written to a temporary directory
+# and its iso and unix columns read back, then each step is timed both
+# ways over the whole file:
+#
+#   unix column   influx_query.py: ISO time -> unix seconds, written
+#                 out with the csv module as write_rows() does
+#   x axis        phm_plot.py: unix seconds -> matplotlib date numbers
+#
+# The old influx_query.py code used local time and the new code UTC,
+# so run this with TZ=UTC (the default on most servers) if you want
+# the two results checked against each other.
+#
+# Usage: bench_timestamps.py [rows]
+
+import csv
+import io
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import matplotlib.dates as mdates
+
+# influx_query imports influxdb_client at the top, which write_chunk()
+# doesn't need; if it isn't installed, use a copy
+try:
+    from influx_query import write_chunk
+except ImportError:
+    def write_chunk(writer, chunk):
+        if chunk:
+            ns = np.array([row[0] for row in chunk],
+                dtype='datetime64[ns]').view(np.int64)
+            for row,u in zip(chunk, (ns // 1_000_000_000).tolist()):
+                row.insert(1, u)
+        writer.writerows(chunk)
+        return len(chunk)
+
+rows = int(sys.argv[1]) if len(sys.argv) > 1 else 3_000_000
+start = 1672531200          # 2023-01-01T00:00:00Z
+chunk_rows = 10_000         # as in influx_query.py
+
+def make_file(path, n):
+    # iso, unix and two fields, as influx_query.py writes them
+    t = start + 60 * np.arange(n, dtype=np.int64)
+    iso = t.astype('datetime64[s]').astype(str)
+    with open(path, 'w') as f:
+        f.write('iso\tunix\tfield1\tfield2\n')
+        block = 100_000
+        for i in range(0, n, block):
+            f.writelines('%s\t%d\t%.6f\t%.3f\n' % (a, b, b * 1e-9, b % 97)
+                for a,b in zip(iso[i:i + block].tolist(),
+                    t[i:i + block].tolist()))
+
+def read_columns(path):
+    isos = []
+    unix = []
+    with open(path) as f:
+        next(f)
+        for line in f:
+            a, b, rest = line.split('\t', 2)
+            isos.append(a)
+            unix.append(b)
+    return isos, np.array(unix, dtype=np.int64)
+
+def timed(func, *args):
+    t0 = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - t0
+
+##### influx_query.py unix column #####
+
+def write_chunk_old(writer, chunk):
+    for row in chunk:
+        row.insert(1, str(int(datetime.fromisoformat(row[0]).timestamp())))
+    writer.writerows(chunk)
+    return len(chunk)
+
+def unix_column(func, isos):
+    # write every row through func in chunk_rows blocks, as
+    # influx_query.write_rows() does, and return the output
+    out = io.StringIO()
+    writer = csv.writer(out, delimiter='\t', lineterminator='\n')
+    for i in range(0, len(isos), chunk_rows):
+        func(writer, [[x, '1.0'] for x in isos[i:i + chunk_rows]])
+    return out.getvalue()
+
+def unix_old(isos):
+    return unix_column(write_chunk_old, isos)
+
+def unix_new(isos):
+    return unix_column(write_chunk, isos)
+
+##### phm_plot.py x axis #####
+
+def xaxis_old(unix):
+    dates = [datetime.fromtimestamp(ts) for ts in unix]
+    return mdates.date2num(dates)
+
+def xaxis_new(unix):
+    return mdates.date2num(unix.astype('datetime64[s]'))
+
+def report(name, old, new):
+    print("{:12s} per row {:7.2f} s   numpy {:7.3f} s   {:6.1f}x".format(
+        name, old, new, old / new))
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'synthetic.dat')
+        print("writing", rows, "rows...")
+        make_file(path, rows)
+        print("file is {:.0f} MB".format(os.path.getsize(path) / 1e6))
+        isos, unix = read_columns(path)
+
+    a, old = timed(unix_old, isos)
+    b, new = timed(unix_new, isos)
+    report("unix column", old, new)
+    if a != b:
+        print("  results differ (local time isn't UTC?)")
+
+    a, old = timed(xaxis_old, unix)
+    b, new = timed(xaxis_new, unix)
+    report("x axis", old, new)
+    if not np.allclose(a, b, rtol=0, atol=1e-9):
+        print("  results differ (local time isn't UTC?)")
@@ -0,0 +1,300 @@
+# columnar_out.py v.20261018.1
+# copyright 2023 John Ackermann N8UR jra@febo.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Typed binary output for influx_query.py --format.  Instead of text,
+# the query result is written as columns:
+#
+#   time        int64 ns since the epoch, UTC (an Arrow timestamp[ns]
+#               in parquet and arrow files)
+#   <field>     float64 (or float32 with --float32), missing values NaN
+#   <field>     for fields that aren't numbers: int32 codes into a list
+#               of the distinct strings, -1 (or null) where missing
+#
+# Formats:
+#   parquet  one row group per chunk_rows; compression none, snappy,
+#            gzip, brotli, lz4 or zstd (needs pyarrow)
+#   arrow    Arrow IPC file (Feather v2); compression none, lz4 or zstd
+#            (needs pyarrow)
+#   npz      numpy .npz; string columns are <field> codes plus
+#            <field>.categories; compression none or zip.  Everything
+#            is held in memory until the end.
+#   hdf5     one extendable dataset per column; string columns are codes
+#            with the strings in a "categories" attribute; compression
+#            none, gzip or lzf (needs h5py)
+#
+# The query metadata from the text output's "#" header (bucket, query
+# time, start, stop, fields) is stored as JSON under the key
+# "influx_query": in the schema metadata for parquet and arrow, as the
+# "_meta" array in npz, and as a file attribute in hdf5.
+#
+# A column's type is settled by the first chunk of rows.  A column
+# with no values at all in that chunk is taken as float.
+
+import importlib
+import json
+import numpy as np
+
+formats = {
+    'parquet': '.parquet',
+    'arrow': '.arrow',
+    'npz': '.npz',
+    'hdf5': '.h5',
+    }
+
+# first entry is the default
+compressions = {
+    'parquet': ['snappy','none','gzip','brotli','lz4','zstd'],
+    'arrow': ['none','lz4','zstd'],
+    'npz': ['none','zip'],
+    'hdf5': ['none','gzip','lzf'],
+    }
+
+chunk_rows = 100_000        # rows converted and written at a time
+
+# modules each format needs beyond numpy
+requires = {
+    'parquet': 'pyarrow.parquet',
+    'arrow': 'pyarrow',
+    'hdf5': 'h5py',
+    }
+
+def arrow_schema(names, kinds, float32, meta):
+    import pyarrow as pa
+    fields = [pa.field('time', pa.timestamp('ns', tz='UTC'))]
+    for name,kind in zip(names, kinds):
+        if kind == 'f':
+            fields.append(pa.field(name,
+                pa.float32() if float32 else pa.float64()))
+        else:
+            fields.append(pa.field(name,
+                pa.dictionary(pa.int32(), pa.string())))
+    return pa.schema(fields, metadata={'influx_query': json.dumps(meta)})
+
+def arrow_arrays(schema, t, columns, kinds, cats):
+    import pyarrow as pa
+    arrays = [pa.array(t, type=schema.field(0).type)]
+    for a,kind,cat in zip(columns, kinds, cats):
+        if kind == 'f':
+            arrays.append(pa.array(a))
+        else:
+            arrays.append(pa.DictionaryArray.from_arrays(
+                pa.array(a, mask=a < 0), pa.array(list(cat), pa.string())))
+    return arrays
+
+class ParquetOut:
+
+    def __init__(self, path, compression, names, kinds, float32, meta):
+        import pyarrow.parquet as pq
+        self.schema = arrow_schema(names, kinds, float32, meta)
+        self.kinds = kinds
+        self.writer = pq.ParquetWriter(path, self.schema,
+            compression=compression)
+
+    def write(self, t, columns, cats):
+        import pyarrow as pa
+        self.writer.write_table(pa.Table.from_arrays(
+            arrow_arrays(self.schema, t, columns, self.kinds, cats),
+            schema=self.schema))
+
+    def close(self, cats):
+        self.writer.close()
+
+class ArrowOut:
+
+    def __init__(self, path, compression, names, kinds, float32, meta):
+        import pyarrow as pa
+        self.schema = arrow_schema(names, kinds, float32, meta)
+        self.kinds = kinds
+        # the string lists only grow, so each batch's dictionary is a
+        # delta on the one before
+        options = pa.ipc.IpcWriteOptions(
+            compression=None if compression == 'none' else compression,
+            emit_dictionary_deltas=True)
+        self.sink = pa.OSFile(path, 'wb')
+        self.writer = pa.ipc.new_file(self.sink, self.schema,
+            options=options)
+
+    def write(self, t, columns, cats):
+        import pyarrow as pa
+        self.writer.write_batch(pa.RecordBatch.from_arrays(
+            arrow_arrays(self.schema, t, columns, self.kinds, cats),
+            schema=self.schema))
+
+    def close(self, cats):
+        self.writer.close()
+        self.sink.close()
+
+class NpzOut:
+
+    def __init__(self, path, compression, names, kinds, float32, meta):
+        self.path = path
+        self.compression = compression
+        self.names = names
+        self.kinds = kinds
+        self.meta = meta
+        self.chunks = [[] for x in range(len(names) + 1)]
+
+    def write(self, t, columns, cats):
+        self.chunks[0].append(t)
+        for i,a in enumerate(columns):
+            self.chunks[i + 1].append(a)
+
+    def close(self, cats):
+        arrays = {'time': np.concatenate(self.chunks[0]),
+            '_meta': np.array(json.dumps(self.meta))}
+        for i,name in enumerate(self.names):
+            arrays[name] = np.concatenate(self.chunks[i + 1])
+            if self.kinds[i] == 'c':
+                arrays[name + '.categories'] = np.array(list(cats[i]), str)
+        if self.compression == 'zip':
+            np.savez_compressed(self.path, **arrays)
+        else:
+            np.savez(self.path, **arrays)
+
+class Hdf5Out:
+
+    def __init__(self, path, compression, names, kinds, float32, meta):
+        import h5py
+        self.f = h5py.File(path, 'w')
+        self.f.attrs['influx_query'] = json.dumps(meta)
+        opts = {}
+        if compression != 'none':
+            opts['compression'] = compression
+        self.datasets = [self.f.create_dataset('time', (0,), np.int64,
+            maxshape=(None,), chunks=(chunk_rows,), **opts)]
+        for name,kind in zip(names, kinds):
+            if kind == 'f':
+                dtype = np.float32 if float32 else np.float64
+            else:
+                dtype = np.int32
+            # h5py takes '/' as a group separator
+            self.datasets.append(self.f.create_dataset(
+                name.replace('/','_'), (0,), dtype, maxshape=(None,),
+                chunks=(chunk_rows,), **opts))
+        self.kinds = kinds
+
+    def write(self, t, columns, cats):
+        n = self.datasets[0].shape[0]
+        for ds,a in zip(self.datasets, [t] + columns):
+            ds.resize((n + len(a),))
+            ds[n:] = a
+
+    def close(self, cats):
+        import h5py
+        for ds,kind,cat in zip(self.datasets[1:], self.kinds, cats):
+            if kind == 'c':
+                ds.attrs['categories'] = np.array(list(cat),
+                    dtype=h5py.string_dtype())
+        self.f.close()
+
+outputs = {
+    'parquet': ParquetOut,
+    'arrow': ArrowOut,
+    'npz': NpzOut,
+    'hdf5': Hdf5Out,
+    }
+
+class ColumnarWriter:
+
+    def __init__(self, path, fmt, names, meta, compression=None,
+            float32=False):
+        if fmt not in formats:
+            raise ValueError("unknown format " + repr(fmt))
+        if fmt in requires:
+            # find out now rather than after the query has run
+            importlib.import_module(requires[fmt])
+        if compression is None:
+            compression = compressions[fmt][0]
+        if compression not in compressions[fmt]:
+            raise ValueError(fmt + " compression must be one of " + \
+                ', '.join(compressions[fmt]))
+        self.path = path
+        self.fmt = fmt
+        self.compression = compression
+        self.names = list(names)
+        self.meta = meta
+        self.float32 = float32
+        self.kinds = None           # 'f' or 'c' per column, once known
+        self.cats = [{} for x in self.names]    # string -> code
+        self.out = None
+        self.pending = []
+        self.partial = ''
+        self.rows = 0
+
+    def write_rows(self, rows):
+        # rows of [iso time, value for each column], as strings (what
+        # influx_query.pivot_rows yields).  Returns the row count.
+        for row in rows:
+            self.pending.append(row)
+            if len(self.pending) >= chunk_rows:
+                self.flush()
+        return self.rows + len(self.pending)
+
+    def write(self, text):
+        # Take the tab separated text influx_query writes (iso, unix,
+        # values...), so the sharded and cached paths can copy their
+        # parts straight in.  The unix column is dropped.
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            if line and line[0] != '#':
+                row = line.split('\t')
+                del row[1]
+                self.pending.append(row)
+        if len(self.pending) >= chunk_rows:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            columns = list(zip(*self.pending))
+        else:
+            columns = [()] * (len(self.names) + 1)
+        self.rows = self.rows + len(self.pending)
+        self.pending = []
+        t = np.array(columns[0], dtype='datetime64[ns]').view(np.int64)
+        if self.kinds is None:
+            self.kinds = [self.kind(c) for c in columns[1:]]
+            self.out = outputs[self.fmt](self.path, self.compression,
+                self.names, self.kinds, self.float32, self.meta)
+        arrays = []
+        for i,col in enumerate(columns[1:]):
+            if self.kinds[i] == 'f':
+                a = np.array(col, dtype=str)
+                a = np.where(a == '', 'nan', a).astype(np.float64)
+                if self.float32:
+                    a = a.astype(np.float32)
+            else:
+                cat = self.cats[i]
+                a = np.fromiter((-1 if x == '' else
+                    cat.setdefault(x, len(cat)) for x in col),
+                    np.int32, len(col))
+            arrays.append(a)
+        if len(t) or self.rows == 0:
+            self.out.write(t, arrays, self.cats)
+
+    def kind(self, col):
+        # 'f' if every value in col is a number (or missing), else 'c'
+        a = np.array(col, dtype=str)
+        try:
+            a[a != ''].astype(np.float64)
+        except ValueError:
+            return 'c'
+        return 'f'
+
+    def close(self):
+        if self.partial:
+            self.write('\n')
+        if self.pending or self.out is None:
+            self.flush()
+        self.out.close(self.cats)
+        return self.rows
@@ -0,0 +1,130 @@
+# data_loader.py v.20261018.1
+# copyright 2023 John Ackermann N8UR jra@febo.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Column loader for the files influx_query.py writes, used by
+# phm_plot.py.  Only the columns asked for are parsed, and the first
+# time a column is read from a file it is also saved as a .npy file in
+# a sidecar directory next to it (<file>.cols), so the next load of
+# that column is just a memory map of the .npy.  The sidecar records
+# the size and mtime of the file it came from and is thrown away and
+# rebuilt if either changes.
+#
+# Lines starting with '#' are skipped, and the first other line is
+# the column names.  Numeric columns become float64 with empty values
+# as NaN ('unix' is int64); anything else stays as strings.  If the
+# sidecar can't be written the columns are just returned from memory.
+
+import json
+import os
+import shutil
+import numpy as np
+
+block_lines = 100_000       # lines parsed at a time
+
+def sidecar_dir(path):
+    return path + '.cols'
+
+def read_header(f, delimiter):
+    # skip the '#' lines; return the column names
+    for line in f:
+        if not line.startswith('#'):
+            return line.rstrip('\r\n').split(delimiter)
+    raise ValueError("no header line")
+
+def to_array(name, values):
+    # list of strings to the best numpy type
+    a = np.array(values, dtype=str)
+    if name == 'unix':
+        return a.astype(np.int64)
+    try:
+        return np.where(a == '', 'nan', a).astype(np.float64)
+    except ValueError:
+        return a
+
+def parse_columns(path, names, delimiter):
+    # read just the named columns from the text file
+    with open(path, newline='') as f:
+        header = read_header(f, delimiter)
+        missing = [n for n in names if n not in header]
+        if missing:
+            raise KeyError("not in " + path + ": " + ', '.join(missing))
+        index = [header.index(n) for n in names]
+        values = [[] for n in names]
+        block = []
+
+        def split_block():
+            for line in block:
+                row = line.rstrip('\r\n').split(delimiter)
+                for v,i in zip(values, index):
+                    v.append(row[i] if i < len(row) else '')
+            block.clear()
+
+        for line in f:
+            if line[0] != '#':
+                block.append(line)
+                if len(block) >= block_lines:
+                    split_block()
+        split_block()
+    return header, [to_array(n, v) for n,v in zip(names, values)]
+
+def load_columns(path, names, delimiter='\t'):
+    # Return {name: numpy array} for each of names in file path
+    st = os.stat(path)
+    stamp = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+        'delimiter': delimiter}
+    side = sidecar_dir(path)
+    meta_file = os.path.join(side, 'meta.json')
+    try:
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta['stamp'] != stamp:
+            shutil.rmtree(side)
+            meta = None
+    except (FileNotFoundError, ValueError, KeyError):
+        meta = None
+    if meta is None:
+        meta = {'stamp': stamp, 'columns': {}}
+
+    columns = {}
+    todo = []
+    for name in names:
+        if name in columns or name in todo:
+            continue
+        if name in meta['columns']:
+            columns[name] = np.load(os.path.join(side,
+                meta['columns'][name]), mmap_mode='r')
+        else:
+            todo.append(name)
+    if not todo:
+        return columns
+
+    header, arrays = parse_columns(path, todo, delimiter)
+    try:
+        os.makedirs(side, exist_ok=True)
+        for name,a in zip(todo, arrays):
+            # files are named by column number, since names can have
+            # characters that don't belong in file names
+            npy = '%04d.npy' % header.index(name)
+            np.save(os.path.join(side, npy + '.tmp'), a)
+            os.replace(os.path.join(side, npy + '.tmp.npy'),
+                os.path.join(side, npy))
+            meta['columns'][name] = npy
+            columns[name] = np.load(os.path.join(side, npy), mmap_mode='r')
+        with open(meta_file + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_file + '.tmp', meta_file)
+    except OSError as e:
+        print("data_loader: couldn't save columns in", side + ":", e)
+        for name,a in zip(todo, arrays):
+            columns.setdefault(name, a)
+    return columns
@@ -0,0 +1,82 @@
+# decimate.py v.20261018.1
+# copyright 2023 John Ackermann N8UR jra@febo.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Min/max decimation for plotting, used by phm_plot.py.  A trace with
+# far more points than the plot has pixels across is cut into bins
+# (one per pixel column) and only the lowest and highest point of each
+# bin are kept, in time order, placed at the middle of the bin.  Drawn
+# as a line that looks the same as the full data: every spike still
+# reaches its true height, but the line has only two vertices per
+# pixel whatever the length of the data.
+#
+# Bins hold equal numbers of samples, which matches equal time for
+# data logged at a steady rate.  NaN values are ignored, and a bin
+# that is all NaN gives NaN, so gaps in the data stay gaps.
+#
+# envelope() does the same for a band between two traces, such as the
+# per window min and max from influx_query.py --stats: the lowest of
+# the lower and the highest of the upper in each bin.
+
+import numpy as np
+
+def minmax(x, y, bins):
+    # Return (x, y) cut down to at most 2 * bins points
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if bins < 1 or n <= 2 * bins:
+        return x, y
+    per = -(-n // bins)             # samples per bin, rounded up
+    bins = -(-n // per)
+    pad = bins * per - n
+    # padding at the end of the last bin is never picked, since there
+    # is always a real sample in it to choose first
+    lo = np.concatenate([y, np.full(pad, np.inf)]).reshape(bins, per)
+    hi = np.concatenate([y, np.full(pad, -np.inf)]).reshape(bins, per)
+    nan = np.isnan(lo)
+    # an all NaN bin picks its first sample, which is NaN
+    imin = np.where(nan, np.inf, lo).argmin(axis=1)
+    imax = np.where(nan, -np.inf, hi).argmax(axis=1)
+    # keep each bin's pair in time order
+    start = np.arange(bins) * per
+    index = np.empty(2 * bins, dtype=np.int64)
+    index[0::2] = start + np.minimum(imin, imax)
+    index[1::2] = start + np.maximum(imin, imax)
+    # Both points of a bin go at the x of its middle sample, so each
+    # bin draws as an upright stroke that fills its pixel column from
+    # min to max.  At their true x the pair often falls in different
+    # columns and the slanting stroke leaves pale streaks.
+    mid = np.minimum(start + per // 2, n - 1)
+    return np.repeat(np.asarray(x)[mid], 2), y[index]
+
+def envelope(x, lo, hi, bins):
+    # Return (x, lo, hi) for a band drawn between lo and hi (per window
+    # min and max, say) cut down to at most bins points: the lowest lo
+    # and highest hi in each bin, at the x of its middle sample.
+    lo = np.asarray(lo, dtype=np.float64)
+    hi = np.asarray(hi, dtype=np.float64)
+    n = len(lo)
+    if bins < 1 or n <= bins:
+        return x, lo, hi
+    per = -(-n // bins)
+    bins = -(-n // per)
+    pad = bins * per - n
+    # NaN pads, so an all NaN bin stays a gap in the band
+    lo = np.concatenate([lo, np.full(pad, np.nan)]).reshape(bins, per)
+    hi = np.concatenate([hi, np.full(pad, np.nan)]).reshape(bins, per)
+    empty = np.isnan(lo).all(axis=1) | np.isnan(hi).all(axis=1)
+    lo = np.where(empty[:,None], 0.0, lo)
+    hi = np.where(empty[:,None], 0.0, hi)
+    blo = np.where(empty, np.nan, np.nanmin(lo, axis=1))
+    bhi = np.where(empty, np.nan, np.nanmax(hi, axis=1))
+    mid = np.minimum(np.arange(bins) * per + per // 2, n - 1)
+    return np.asarray(x)[mid], blo, bhi
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+# fake_serial.py v.20261018.1
+# copyright 2023 John Ackermann N8UR jra@febo.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Stand-in for the serial instruments, for trying therm_usb.py and
+# hp5071a.py (and logger_daemon.py) without the hardware.  It makes a
+# pty, prints the name of its tty, and answers on it like the device:
+#
+#   therm     the Arduino: any byte but '~' gets one line of
+#             rtd_temp bme_temp pressure humidity
+#   hp5071a   the HP 5071A: each ';' separated SCPI message gets one
+#             line of ';' separated replies to its DIAG commands
+#
+# --delay S waits S seconds before each answer, and --silent never
+# answers, to see the collectors' timeouts.  So, in two terminals:
+#
+#   fake_serial.py therm --delay 2
+#   therm_usb.py /dev/pts/5
+#
+# "fake_serial.py check" runs each collector's get_data() against a
+# fake in this process, then against a silent one, and prints how long
+# each took and how much CPU the process used meanwhile.  Waiting out a
+# silent device should cost next to no CPU (serial_transport.py sleeps
+# in select()).
+#
+# Usage: fake_serial.py therm|hp5071a [--delay S] [--silent]
+#        fake_serial.py check
+
+import argparse
+import os
+import random
+import selectors
+import threading
+import time
+
+import hp5071a
+from serial_transport import make_raw
+
+# values per reply for the hp5071a commands that return a list
+hp_list_len = {5: 2, 13: 4, 15: 3}
+hp_strings = {0: 'ON', 6: 'Operating normally', 7: 'OK'}
+stop_check = 0.2        # seconds between looks at the stop event
+
+def therm_reply(line):
+    return '{:.3f} {:.2f} {:.2f} {:.2f}\r\n'.format(
+        20 + random.random(), 21 + random.random(),
+        1013 + random.random(), 45 + random.random()).encode()
+
+def hp_value(i):
+    if i in hp_strings:
+        return hp_strings[i]
+    if i in hp_list_len:
+        return ','.join('%.3f' % random.random()
+            for x in range(hp_list_len[i]))
+    return '%.3f' % (random.random() * 10)
+
+def hp_reply(line):
+    # reply to each command of a message in turn
+    values = []
+    for cmd in line.decode().strip().split(';'):
+        cmd = cmd.lstrip(':')
+        if cmd in hp5071a.cmds:
+            values.append(hp_value(hp5071a.cmds.index(cmd)))
+        else:
+            values.append('0')
+    return (';'.join(values) + '\r\n').encode()
+
+def therm_frame(buf):
+    # every byte is a prompt
+    return 1 if buf else 0
+
+def hp_frame(buf):
+    # a message is a line
+    return buf.find(b'\n') + 1
+
+# how each device cuts up what it's sent, and answers each piece
+devices = {
+    'therm': (therm_frame, therm_reply),
+    'hp5071a': (hp_frame, hp_reply),
+    }
+
+def serve(master, device, delay=0, silent=False, stop=None):
+    # Answer what comes in on the pty master until stop is set
+    frame, reply = devices[device]
+    buf = bytearray()
+    sel = selectors.DefaultSelector()
+    sel.register(master, selectors.EVENT_READ)
+    while stop is None or not stop.is_set():
+        if not sel.select(stop_check):
+            continue
+        try:
+            buf += os.read(master, 4096)
+        except OSError:
+            # EIO while nothing has the tty open
+            time.sleep(stop_check)
+            continue
+        while True:
+            n = frame(buf)
+            if n <= 0:
+                break
+            prompt = bytes(buf[:n])
+            del buf[:n]
+            if silent or prompt == b'~':
+                continue
+            if delay:
+                time.sleep(delay)
+            os.write(master, reply(prompt))
+    sel.close()
+
+def open_fake():
+    # (master fd, slave fd, tty name); the slave is held open so the
+    # master still works while no collector has the tty
+    master, slave = os.openpty()
+    make_raw(slave)
+    return master, slave, os.ttyname(slave)
+
+def timed(device, silent, timeout):
+    # run device's get_data against a fake; (result, wall, cpu)
+    mod = __import__({'therm': 'therm_usb'}.get(device, device))
+    master, slave, name = open_fake()
+    stop = threading.Event()
+    t = threading.Thread(target=serve, args=(master, device, 0, silent,
+        stop))
+    t.start()
+    try:
+        ser = mod.open_port(name)
+        try:
+            wall = time.monotonic()
+            cpu = time.process_time()
+            result = mod.get_data(ser, timeout)
+            return result, time.monotonic() - wall, \
+                time.process_time() - cpu
+        finally:
+            ser.close()
+    finally:
+        stop.set()
+        t.join()
+        os.close(master)
+        os.close(slave)
+
+def check():
+    for device in devices:
+        for silent in (False, True):
+            result, wall, cpu = timed(device, silent, 3 if silent else 10)
+            if silent:
+                what = 'timed out' if result is None else 'answered!'
+            else:
+                what = 'no answer!' if result is None else \
+                    str(len(result)) + ' values'
+            print("{:8s} {:7s} {:11s} {:6.3f} s, {:6.3f} s CPU".format(
+                device, 'silent' if silent else 'normal', what, wall, cpu))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="fake serial instrument on a pty")
+    parser.add_argument('device', choices=list(devices) + ['check'])
+    parser.add_argument('--delay', type=float, default=0,
+        help="seconds to wait before each answer")
+    parser.add_argument('--silent', action='store_true',
+        help="never answer")
+    args = parser.parse_args()
+    if args.device == 'check':
+        check()
+        return
+    master, slave, name = open_fake()
+    print(name, flush=True)
+    try:
+        serve(master, args.device, args.delay, args.silent)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
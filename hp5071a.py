@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-# hp5071a.py v.20230110.1
+# hp5071a.py v.20261018.1
 # copyright 2023 John Ackermann N8UR jra@febo.com
 #
 # This program is free software; you can redistribute it and/or modify
@@ -14,19 +14,36 @@
 # GNU General Public License for more details.
 
 # This program is called by logger_1m.sh to query an HP5071A Cesium
-# frequency standard for operating parameters.
+# frequency standard for operating parameters.  It can also be
+# imported by logger_daemon.py, which uses HP5071ACollector to keep
+# the port open between cycles.
+#
+# The point is stamped with the start of the cycle (see cycle_time() in
+# logger_funcs.py), with acq_latency the seconds from then until the
+# last response came in.
+#
+# State, Status and Pwr_Supply come back as text.  They're written as
+# int codes (State_code etc., see enums below) that InfluxDB can
+# aggregate and store in a few bits; the text itself is only written,
+# to the old string field, for a reply that has no code yet.  Under
+# logger_daemon.py they have a deadband (see line_protocol.py): they're
+# only written when they change, or once per heartbeat.
+#
+# The port is read through serial_transport.py, which waits for each
+# reply line with a selector up to the response timeout.
 
+import csv
 import sys
-import signal
-import socket
-import serial
-import time
-from datetime import datetime
-from datetime import timezone
 
-from influxdb_client import InfluxDBClient
+from logger_funcs import send_to_telegraf, cycle_time, latency, \
+    latency_field
+from line_protocol import Schema, Enum
+from serial_transport import SerialPort, deadline
 
-port = sys.argv[1]
+measure_name = "hp5071a"
+location = "clockroom"
+baud = 9600
+response_timeout = 5    # wait up to 5 seconds for each response
 
 cmds = ['DIAG:CONT:STATE?','DIAG:CURR:BEAM?','DIAG:CURR:CFIELD?',
         'DIAG:CURR:PUMP?','DIAG:GAIN?','DIAG:RFAMPLITUDE?',
@@ -42,107 +59,204 @@ fields = ['State','Beam_Current','C-Field',
         'PLL_1','PLL_2','PLL_3','PLL_4','Osc_Mon','PS_+5',
         'PS_+12','PS_-12']
 
-results = []
+# these fields hold strings; all the rest are floats
+string_fields = ['State','Status','Pwr_Supply']
+
+# Codes for the string fields, from the replies the unit gives (with
+# spaces made '_').  A reply that isn't listed is printed the first
+# time it's seen, gets code -1 and goes in the string field; add it to
+# the end of its list.
+enums = {
+    # continuous operation: off, enabled, or on
+    'State': Enum('hp5071a State', ['OFF', 'ENA', 'ON']),
+    'Status': Enum('hp5071a Status', ['Operating_normally']),
+    'Pwr_Supply': Enum('hp5071a Pwr_Supply', ['OK']),
+    }
+
+def schema_fields():
+    # each string field becomes <field>_code plus the string field for
+    # replies with no code
+    out = []
+    for f in fields:
+        if f in string_fields:
+            out.extend([(f + '_code', 'int'), (f, 'string')])
+        else:
+            out.append((f, 'float'))
+    return out + [(latency_field, 'float')]
+
+schema = Schema(measure_name, {'location': location}, schema_fields(),
+    deadband={g: ('change',) for f in string_fields
+        for g in [f + '_code', f]})
+
 # these are commands that return a single float
 float_results = [1,2,3,4,8,9,10,11,12,14]
 # these are commands that return a string
 string_results = [0,6,7]
+# these are commands that return a comma separated list of floats
+# (RF amplitudes, PLL voltages and power supplies; the manual says
+# there are 4 supply values, but only 3 are returned)
+list_results = [5,13,15]
 
-### GET DATA ###
-try:
-    ser = serial.Serial(port, 9600, timeout=0.5)
-except:
-    print("hp5071a: couldn't open serial port ", port)
-    exit()
+# Send the commands joined with ';' into as few SCPI messages as will
+# fit in max_message characters, rather than one command per round
+# trip.  The unit answers each message with one line of ';' separated
+# responses.  With max_message at 255 the 16 commands go out in two
+# messages; raise it to send them all in one if your unit's input
+# buffer allows.  Set batch = False to send one command at a time.
+batch = True
+max_message = 255
 
-for i,x in enumerate(cmds):
-    c = (x + '\r\n').encode()
-    try:
-        ser.write(c)
-    except serial.SerialTimeoutException:
-        print("hp5071a: timeout while sending command",x)
-        exit()
+def parse_float(value):
+    return [float(value)]
 
-    timeout = time.time() + 5 # wait up to 5 seconds for response
-    while True:
-        while not ser.inWaiting():
-            if time.time() > timeout:
-                print("hp5071a: didn't get response")
-                exit()
-        tmp = []
-        tmp = ser.read(255).split()
-
-        if i == 0:  # continuous operation status -- OFF/ENA/ON
-            results.append("\"" + tmp[1].decode() +"\"")
-        if i in float_results:      # all the commands returning single float
-            results.append(float(tmp[1]))
-        if i == 5:      # output voltage; two values
-            x,y = tmp[1].decode().split(',')
-            results.append(float(x))
-            results.append(float(y))
-        if i == 6:      # Status -- two word string 
-            x = tmp[1].decode().replace('"','')
-            y = tmp[2].decode().replace('"','')
-            results.append("\"" +x + "_" + y + "\"")
-        if i == 7: results.append("\"" + tmp[1].decode() + "\"") 
-        if i == 13: # PLL voltages
-            a,b,c,d = tmp[1].decode().split(',')
-            results.append(float(a))
-            results.append(float(b))
-            results.append(float(c))
-            results.append(float(d))
-        if i == 15:     # Power supplies
-            # manual says 4 values, but only 3 returned
-            a,b,c = tmp[1].decode().split(',')
-            results.append(float(a))
-            results.append(float(b))
-            results.append(float(c))
-
-        break
-ser.close()
-
-#for x,y in enumerate(fields):
-#        print(y," ",results[x])
-
-### Create messages for telegraf ###
-#The file handler for the Telegraf process.
-telegraf_socket = "/var/telegraf/telegraf.sock"
-
-# Connection to Telegraf, over a network socket.
-with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
-    sock.settimeout(5)
-    attempts = 0
-    while attempts < 3:
-        try:
-            sock.connect(telegraf_socket)
-            print("hp5071a: connected to telegraf socket")
-        except socket.error as e:
-            print("hp5071a: couldn't connect to telegraf!")
-            print("Try again in 3 seconds")
-            print(e)
-            attempts = attempts + 1
-            time.sleep(3)
-            break
-
-        print("hp5071a: sending to telegraf socket")
-        for idx,cmd in enumerate(fields):
-            message = "hp5071a,location=clockroom " + \
-            cmd + "=" + str(results[idx]) + " " + \
-            str(time.time_ns()) + '\n'
-            try:
-                sock.send(message.encode())
-                attempts = 3
-            except socket.error as e:
-                print("hp5071a: couldn't send to socket; wait and try again")
-                print(e)
-                attempts = attempts + 1
-                time.sleep(3)
+def parse_list(value):
+    return [float(x) for x in value.split(',')]
+
+def parse_string(value):
+    # the two word status becomes word1_word2
+    return [value.strip().replace(' ','_')]
+
+# parser for each command in cmds, built from the lists above
+parsers = [None] * len(cmds)
+for i in float_results:
+    parsers[i] = parse_float
+for i in string_results:
+    parsers[i] = parse_string
+for i in list_results:
+    parsers[i] = parse_list
+
+def group_commands(batch=batch):
+    # Group command indexes into SCPI messages.  Commands after the
+    # first start with ':' so each is parsed from the root of the tree.
+    groups = [[]]
+    length = 0
+    for i,x in enumerate(cmds):
+        if groups[-1] and (not batch or length + len(x) + 2 > max_message):
+            groups.append([])
+            length = 0
+        groups[-1].append(i)
+        length = length + len(x) + 2
+    return [(g, ';:'.join(cmds[i] for i in g)) for g in groups]
+
+scpi_messages = group_commands()
+
+def open_port(port):
+    return SerialPort(port, baud)
+
+def read_line(ser, until):
+    # Return the next line from the unit, stripped, or None at the
+    # deadline
+    line = ser.read_line(until)
+    if line is None:
+        return None
+    return line.decode(errors='replace').strip()
+
+def get_data(ser, timeout=response_timeout):
+    # Send the commands and return the list of values, one per entry
+    # in fields, or None if the unit stops answering.  Raises
+    # ValueError on a reply that doesn't match what was asked for.
+    # TimeoutError from a write that can't go out is passed up to the
+    # caller.
+    results = []
+    ser.reset_input_buffer()
+    for group,message in scpi_messages:
+        until = deadline(timeout)
+        ser.write((message + '\r\n').encode(), until)
+        while True:
+            line = read_line(ser, until)
+            if line is None:
+                return None
+            # skip blank lines and the unit's echo of our command
+            if line and not line.endswith(message):
                 break
+        values = next(csv.reader([line], delimiter=';'))
+        if len(values) != len(group):
+            raise ValueError("expected " + str(len(group)) + \
+                " responses to " + message + ", got: " + line)
+        for i,value in zip(group, values):
+            results.extend(parsers[i](value))
+    if len(results) != len(fields):
+        raise ValueError("got " + str(len(results)) + " values for " + \
+            str(len(fields)) + " fields")
+    return results
+
+def make_messages(results, cycle, lat):
+    # One point per cycle, stamped with the cycle start.  Returns a
+    # list to match the other collectors.
+    #for x,y in enumerate(fields):
+    #        print(y," ",results[x])
+    values = []
+    for f,v in zip(fields, results):
+        if f in string_fields:
+            code = enums[f].code(v)
+            values.extend([code, v if code == enums[f].unknown else None])
+        else:
+            values.append(v)
+    return [schema.encode(values + [lat], cycle)]
+
+class HP5071ACollector:
+    # Used by logger_daemon.py.  The port is opened on the first
+    # sample and left open; any error closes it so the next cycle
+    # starts from a fresh open.
+    name = "hp5071a"
+    # committed by logger_daemon.py once a sample's lines are spooled
+    deadbands = [schema.deadband]
+
+    def __init__(self, port):
+        self.port = port
+        self.ser = None
+
+    def sample(self, cycle=None):
+        if cycle is None:
+            cycle = cycle_time()
         try:
-            sock.close()
-            attempts = 3
-        except socket.error as e:
-            print("hp5071a: couldn't close socket!")
-            print(e)
-            break
-quit()
+            if self.ser is None:
+                self.ser = open_port(self.port)
+            results = get_data(self.ser)
+        except Exception:
+            self.close()
+            raise
+        if results is None:
+            self.close()
+            raise TimeoutError("didn't get response")
+        return make_messages(results, cycle, latency(cycle))
+
+    def close(self):
+        if self.ser is not None:
+            try:
+                self.ser.close()
+            except Exception:
+                pass
+            self.ser = None
+
+def main():
+    port = sys.argv[1]
+    cycle = cycle_time()
+
+    ### GET DATA ###
+    try:
+        ser = open_port(port)
+    except:
+        print("hp5071a: couldn't open serial port ", port)
+        exit()
+
+    try:
+        results = get_data(ser)
+        lat = latency(cycle)
+    except TimeoutError:
+        print("hp5071a: timeout while sending command")
+        exit()
+    except ValueError as e:
+        print("hp5071a: bad response:", e)
+        exit()
+    ser.close()
+    if results is None:
+        print("hp5071a: didn't get response")
+        exit()
+
+    ### Send messages to telegraf ###
+    print("hp5071a: sending to telegraf socket")
+    send_to_telegraf(make_messages(results, cycle, lat), "hp5071a")
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 #! /usr/bin/env -S python3
 
-# influx_query.py  v.20230110.1
+# influx_query.py  v.20261018.1
 # copyright 2023 John Ackermann N8UR jra@febo.com
 #
 # This program is free software; you can redistribute it and/or modify
@@ -25,29 +25,94 @@
 # is in fact many decimal places deep so we don't want to lose precision
 # for them.  It's probably better to deal with rounding after this
 # processing is complete.
+#
+# The query result is streamed: the raw HTTP response is read in
+# chunks and parsed with the csv module, and rows are formatted and
+# written in blocks of chunk_rows through a large output buffer, so
+# memory use stays flat no matter how long the time range is.  Progress
+# (rows and rows/sec) is printed every progress_interval seconds.
+#
+# Long ranges can be split into shards with --shard <duration>.  Each
+# shard is a separate query over a slice of the range, aligned to
+# agg_val so no aggregation window is split, and --workers of them run
+# at once over a pool of that many connections.  Finished shards are
+# saved under <output file>.parts and copied to the output in time
+# order as soon as all the shards before them are in.  A shard that
+# fails is retried on its own (--retries times), and if the run still
+# fails, running the same command again picks up where it left off.
+#
+# With --cache, results are also kept in a local cache (see
+# query_cache.py) by day-long chunks, keyed on bucket, field list and
+# agg_val.  A later run over an overlapping range only queries the
+# chunks it doesn't already have, and builds the output from the
+# cache.  The newest cache_recent of data, which may still be coming
+# in, is always queried fresh and never cached; --refresh <duration>
+# also throws away cached chunks that end within that much of now.
+#
+# --format parquet, arrow, npz or hdf5 writes typed binary columns
+# instead of text (see columnar_out.py), with --compression <name> and
+# --float32 to halve the size of the values.  The header information
+# goes into the file's metadata.
+#
+# Instead of giving agg_val, --points N (or --pixels N, for a plot N
+# pixels wide at points_per_pixel) picks the shortest agg_val from
+# agg_ladder that gives no more than N rows for the range, going by
+# sample_period.  --estimate prints the rows and bytes a query would
+# produce, and how many raw points the server would scan, without
+# running it.
+#
+# --raw skips the aggregation and pivots the points on their own
+# timestamps, for full resolution exports.  That only lines up for
+# data from collectors that stamp every point of a cycle with the
+# same time (the cycle start; see logger_funcs.py), which they do now;
+# older data, stamped as each reading came in, needs an agg_val.
+#
+# --stats mean,min,max,stddev,count (any of them) gives those per
+# window for each field, as <field>_<stat> columns, all from one pass
+# over the data on the server.  stddev is left empty for a window with
+# fewer than two points.
+#
+# Fields are picked with equality tests on measurement, field and tag
+# values rather than regexes, so the server can look the series up in
+# its index instead of trying a regex on each series key
+# (bench_pushdown.py times the two).  See fields and tags below.
+#
+# Collectors run under logger_daemon.py leave fields out of a point
+# while they stay within a deadband (see line_protocol.py), sending
+# them at least once per heartbeat, so the export has gaps where the
+# value didn't change.  --fill [<duration>] fills an empty value with
+# the last one above it in that column, if that was no more than
+# <duration> (default fill_limit, which should be longer than the
+# heartbeat) before; a gap longer than that is a real outage and is
+# left.  The value each field had just before <start> is looked up
+# with a last() query, so the first rows are filled too.
+#
+# Usage: influx_query.py <start> <stop> [<agg_val>]
+#            [--points N | --pixels N | --raw] [--estimate]
+#            [--shard <duration>] [--workers N] [--retries N]
+#            [--cache] [--refresh <duration>]
+#            [--format tsv|parquet|arrow|npz|hdf5] [--compression <name>]
+#            [--float32] [--stats [<stat>,...]]
+#            [--field [<measurement>.]<field> ...] [--tag <key>=<value> ...]
+#            [--fill [<duration>]]
 
 
-import codecs
-from datetime import datetime
+import argparse
+import concurrent.futures
+import csv
+from datetime import datetime, timezone
+import io
+import json
 import os
 import re
+import shutil
 import sys
+import time
+import numpy as np
 # pip3 install influxdb-client
 from influxdb_client import InfluxDBClient
 
-# ISO8601 format datetime
-start = str(sys.argv[1])
-stop = str(sys.argv[2])
-
-# InfluxDB wants Zulu at end of date (RFC3339)
-if not start[-1] == 'Z':
-   start = start + 'Z'
-if not stop[-1] == 'Z':
-   stop = stop + 'Z'
-
-# reduce data by aggregating this number of readings
-# needs to be string with m,h,d, etc. e.g. '5m'
-agg_val = str(sys.argv[3])
+from maser_funcs import stat_flags
 
 # adjust for local environment
 url = 'your_url'
@@ -55,19 +120,6 @@ org = 'your_org'
 bucket = 'your_bucket'
 token = 'your_token'
 
-# Output file name is built from bucket, start, stop, aggregation 
-# value, with ISO8601 dates truncated to the minute and without Z,
-# just to shorten things up a bit
-outfile = bucket + '_' + start[:16].replace(':','')  + \
-        '_' + stop[:16].replace(':','') + '_' + agg_val + '.dat'
-# open output file
-try:
-    outf = open(outfile,'w')
-except:
-    print("Couldn't open output file",outfile)
-    sys.exit()
-print("Output is in",outfile)
-
 # This is a list of all the fields you want to get from the
 # database.  This list isn't actually used in the program, but
 # is awfully handy to have for reference.
@@ -75,89 +127,870 @@ print("Output is in",outfile)
 
 full_field_list = [ 'field1','field2','field3','etc' ]
 
-# These are the fields to log.  We assume all fields have unique
-# names, so don't need to deal with the measurement name.  Instead,
-# we build a regex that the database can match field names agains
-# Timestamp field is implied
+# These are the fields to log, each either 'field' or
+# 'measurement.field' (e.g. 'phm107.ion_current').  A bare field is
+# taken from whatever measurement has it, so its name must be unique
+# in the bucket.  Naming the measurement lets InfluxDB pass over every
+# other measurement's series without looking at them, and lets two
+# instruments have fields of the same name: a field picked from more
+# than one measurement gets columns named measurement.field, any
+# other just field.  Timestamp field is implied.  Output columns are
+# in this order.  --field replaces this list.
 
 fields = [ 'field1','field2', ]
 
-# Convert list 'fields' into a regex with values OR'd
-# I *think* this needs to be in plain text, not compiled
-# into a perl regex
-fields_re = '|'.join(fields)
-# '+' sign in Flux queries need to be escaped.  Are there others?
-fields_re = fields_re.replace('+','\+')
-
-# Pattern to semi-reliably detect an ISO8601 date
-iso = re.compile(r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d')
-
-# Build pieces of the query string.  Sort by time as that's
-# not guarantted.  Always include the aggregate function even
-# if not needed, as it strips off the fractional part of the
-# ISO8601 seconds.  Drop the _start and _stop columns as they're
-# not useful here.  Add the group and pivot functions to turn results
-# into a column-oriented set of data records
-from_bucket = 'from(bucket: "' + bucket + '")'  # need to add the '"'s
-time_range = '|> range(start: ' + start + ', stop: ' + stop + ')'
-field_match = '|> filter(fn: (r) => r["_field"] =~ /^(' + fields_re + ')$/)'
-sort = '|> sort(columns: ["_time"])'
-aggregate = '|> aggregateWindow(every: ' + str(agg_val) + ', fn: mean)'
-drop = '|> drop(columns: ["_start","_stop"])'
-group = '|> group() '
-pivot = \
-    '|> pivot(rowKey: ["_time"], columnKey: ["_field"],valueColumn: "_value")'
-
-# Put 'em together
-my_query = from_bucket + time_range + field_match + sort + aggregate + \
-    drop + group + pivot
+# Fields stored as true/false (the maser status bits, named in
+# maser_funcs.stat_flags).  aggregateWindow's mean won't take a bool,
+# so these are turned into 1.0/0.0 first, giving the fraction of each
+# window the bit was set.
+bool_fields = [name for name in stat_flags if name is not None]
+
+# Only take series with these tag values, e.g. {'location':
+# 'clockroom'}.  --tag adds to these.
+tags = {}
 
 # Note the weird timeout value.  This needs to be pretty
 # long for big queries
-with InfluxDBClient(url=url,token=token,org=org,timeout=600_000) as client:
-    query_api = client.query_api()
-    csv_result = query_api.query_csv(my_query)
-    for record in csv_result:
-        if record == []:        # empty record
+timeout = 600_000
+
+chunk_rows = 10_000         # rows formatted and written at a time
+buffer_size = 1 << 20       # output file buffer, bytes
+read_size = 1 << 16         # HTTP response read size, bytes
+progress_interval = 5.0     # seconds between progress reports
+
+# defaults for sharded queries
+workers = 4
+retries = 3
+
+# --cache stores chunks of this length (a multiple of agg_val), and
+# never stores the newest cache_recent of data
+cache_chunk = '1d'
+cache_recent = '2h'
+
+# For --points/--pixels and --estimate: seconds between raw points
+# (the collectors log once a minute), the aggregation periods to
+# choose from, and rough output sizes
+sample_period = 60
+agg_ladder = ['1m','2m','5m','10m','15m','30m','1h','2h','3h','6h',
+    '12h','1d','2d','7d']
+points_per_pixel = 2
+text_bytes = 12             # bytes per value in tsv output, with tab
+time_text_bytes = 31        # iso and unix columns
+
+# --fill: how old a value can be and still fill a gap (a bit over the
+# collectors' deadband heartbeat)
+fill_limit = '15m'
+
+def zulu(t):
+    # InfluxDB wants Zulu at end of date (RFC3339)
+    if not t[-1] == 'Z':
+        t = t + 'Z'
+    return t
+
+def parse_time(t):
+    # RFC3339 string to aware UTC datetime
+    return datetime.fromisoformat(zulu(t).replace('Z','+00:00'))
+
+def format_time(ts):
+    # unix seconds to RFC3339 string
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat(). \
+        replace('+00:00','Z')
+
+duration_units = { 'ns': 1e-9, 'us': 1e-6, 'µs': 1e-6, 'ms': 1e-3,
+    's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800 }
+duration_re = re.compile(r'(\d+)(ns|us|µs|ms|mo|s|m|h|d|w|y)')
+
+# agg_val for --raw: no aggregation
+raw_agg = 'raw'
+
+def agg_seconds(agg_val):
+    # seconds per output row: the aggregation period, or for raw data
+    # the time between collector cycles
+    if agg_val == raw_agg:
+        return sample_period
+    return parse_duration(agg_val)
+
+def parse_duration(d):
+    # Flux duration such as '10m' or '1h30m' to seconds.  Months and
+    # years vary in length, so they aren't accepted.
+    total = 0
+    pos = 0
+    for m in duration_re.finditer(d):
+        if m.start() != pos or m.group(2) in ('mo','y'):
+            break
+        total = total + int(m.group(1)) * duration_units[m.group(2)]
+        pos = m.end()
+    if pos != len(d) or pos == 0:
+        raise ValueError("can't use duration " + repr(d) + \
+            " here; use units from ns to w")
+    return total
+
+def outfile_name(start, stop, agg_val, bucket=bucket):
+    # Output file name is built from bucket, start, stop, aggregation 
+    # value, with ISO8601 dates truncated to the minute and without Z,
+    # just to shorten things up a bit
+    return bucket + '_' + start[:16].replace(':','')  + \
+        '_' + stop[:16].replace(':','') + '_' + agg_val + '.dat'
+
+def flux_string(s):
+    # s as a Flux string literal
+    return '"' + s.replace('\\','\\\\').replace('"','\\"'). \
+        replace('${','\\${') + '"'
+
+def split_field(f):
+    # 'measurement.field' or 'field' to (measurement or None, field)
+    m, dot, name = f.partition('.')
+    return (m, name) if dot else (None, f)
+
+def renamed_fields(fields=fields):
+    # field names picked from more than one measurement
+    seen = {}
+    for m,name in map(split_field, fields):
+        seen.setdefault(name, set()).add(m)
+    renamed = [name for name,ms in seen.items() if len(ms) > 1]
+    for name in renamed:
+        if None in seen[name]:
+            raise ValueError("field " + repr(name) + " is in more than "
+                "one measurement; give the measurement every time")
+    return renamed
+
+def column_names(fields=fields):
+    # the output column for each of fields
+    renamed = renamed_fields(fields)
+    return [m + '.' + name if name in renamed else name
+        for m,name in map(split_field, fields)]
+
+def select_filter(fields=fields, tags=tags):
+    # Flux filters picking fields and tags by plain equality, which
+    # InfluxDB hands down to its storage engine to pick out matching
+    # series from the index, rather than testing a regex on each one.
+    # Fields are grouped by measurement:
+    #   (r._measurement == "a" and (r._field == "x" or r._field == "y"))
+    #   or (r._field == "z")
+    by_measurement = {}
+    for m,name in map(split_field, fields):
+        by_measurement.setdefault(m, []).append(name)
+    terms = []
+    for m,names in by_measurement.items():
+        term = ' or '.join('r["_field"] == ' + flux_string(name)
+            for name in names)
+        if m is not None:
+            term = 'r["_measurement"] == ' + flux_string(m) + \
+                ' and (' + term + ')'
+        terms.append('(' + term + ')')
+    q = '|> filter(fn: (r) => ' + ' or '.join(terms) + ')'
+    if tags:
+        q = q + '|> filter(fn: (r) => ' + ' and '.join('r[' + \
+            flux_string(k) + '] == ' + flux_string(v) \
+            for k,v in sorted(tags.items())) + ')'
+    return q
+
+def field_expr(fields=fields):
+    # Flux expression giving a record's output column name, for a
+    # record still having its _measurement
+    renamed = renamed_fields(fields)
+    if not renamed:
+        return 'r._field'
+    return '(if contains(value: r._field, set: [' + \
+        ', '.join(map(flux_string, renamed)) + \
+        ']) then r._measurement + "." + r._field else r._field)'
+
+def build_query(start, stop, agg_val, fields=fields, bucket=bucket,
+        tags=tags):
+    # Build pieces of the query string.  Sort by time as that's
+    # not guarantted.  Include the aggregate function even if not
+    # needed, as it strips off the fractional part of the ISO8601
+    # seconds -- except with agg_val 'raw' (--raw), for data from
+    # collectors that stamp every point of a cycle with the same
+    # time, which pivots as it is.  Drop the _start and _stop columns
+    # as they're not useful here.  Add the group and pivot functions
+    # to turn results into a column-oriented set of data records
+    from_bucket = 'from(bucket: "' + bucket + '")'  # need to add the '"'s
+    time_range = '|> range(start: ' + start + ', stop: ' + stop + ')'
+    field_match = select_filter(fields, tags)
+    sort = '|> sort(columns: ["_time"])'
+    aggregate = '|> aggregateWindow(every: ' + str(agg_val) + ', fn: mean)'
+    if agg_val == raw_agg:
+        aggregate = ''
+    drop = '|> drop(columns: ["_start","_stop"])'
+    group = '|> group() '
+    # same named fields from different measurements get their own
+    # columns
+    rename = ''
+    if renamed_fields(fields):
+        rename = '|> map(fn: (r) => ({r with _field: ' + \
+            field_expr(fields) + '}))'
+    pivot = \
+        '|> pivot(rowKey: ["_time"], columnKey: ["_field"],valueColumn: "_value")'
+
+    # Bool fields are read as a stream of their own and made floats
+    # before the mean; the rest keep a plain aggregateWindow, which
+    # InfluxDB can work out in its storage engine
+    bools = [f for f in fields if split_field(f)[1] in bool_fields]
+    if aggregate and bools:
+        others = [f for f in fields if f not in bools]
+        streams = [from_bucket + time_range + select_filter(bools, tags) +
+            sort + '|> toFloat()' + aggregate]
+        if others:
+            streams.insert(0, from_bucket + time_range +
+                select_filter(others, tags) + sort + aggregate)
+        source = streams[0] if len(streams) == 1 else \
+            'union(tables: [' + ', '.join(streams) + '])'
+        return source + drop + group + rename + pivot
+
+    # Put 'em together
+    return from_bucket + time_range + field_match + sort + aggregate + \
+        drop + group + rename + pivot
+
+# --stats: what each statistic is, from the accumulator reduce() leaves
+# for each window (Welford's running mean and sum of squares)
+stat_exprs = {
+    'mean': 'r.mean',
+    'min': 'r.min',
+    'max': 'r.max',
+    'stddev': 'math.sqrt(x: r.m2 / (r.count - 1.0))',
+    'count': 'r.count',
+    }
+
+# windows a statistic is given for; in the others its column is left
+# empty (a single point has no spread to measure)
+stat_filters = {
+    'stddev': 'r.count > 1.0',
+    }
+
+def output_columns(stats=None, names=None):
+    # the data columns a query gives: a column per field, or with stats
+    # one <column>_<stat> for each
+    if names is None:
+        names = column_names(fields)
+    if not stats:
+        return list(names)
+    return [f + '_' + st for f in names for st in stats]
+
+def build_stats_query(start, stop, agg_val, stats, fields=fields,
+        bucket=bucket, tags=tags):
+    # Like build_query(), but each window gives every statistic in
+    # stats for every field, all from one pass over the data: window()
+    # and a reduce() that keeps count, running mean and sum of squares,
+    # min and max, then one map() per statistic renaming the field to
+    # <field>_<stat>, unioned back together for the pivot.  Rows are
+    # stamped with the end of their window, like aggregateWindow.
+    welford = '''reduce(
+        identity: {count: 0.0, mean: 0.0, m2: 0.0,
+            min: math.mInf(sign: 1), max: math.mInf(sign: -1)},
+        fn: (r, accumulator) => {
+            v = float(v: r._value)
+            n = accumulator.count + 1.0
+            d = v - accumulator.mean
+            mean = accumulator.mean + d / n
+            return {count: n, mean: mean,
+                m2: accumulator.m2 + d * (v - mean),
+                min: if v < accumulator.min then v else accumulator.min,
+                max: if v > accumulator.max then v else accumulator.max}
+        })'''
+    maps = ['stats |> ' + ('filter(fn: (r) => ' + stat_filters[st] +
+        ') |> ' if st in stat_filters else '') +
+        'map(fn: (r) => ({_time: r._time, _field: ' +
+        field_expr(fields) + ' + "_' + st + '", _value: ' +
+        stat_exprs[st] + '}))' for st in stats]
+    return 'import "math"\n' + \
+        'stats = from(bucket: "' + bucket + '")' + \
+        '|> range(start: ' + start + ', stop: ' + stop + ')' + \
+        select_filter(fields, tags) + \
+        '|> window(every: ' + str(agg_val) + ')' + \
+        '|> ' + welford + \
+        '|> duplicate(column: "_stop", as: "_time")\n' + \
+        'union(tables: [' + ', '.join(maps) + '])' + \
+        '|> keep(columns: ["_time","_field","_value"])' + \
+        '|> group()' + \
+        '|> pivot(rowKey: ["_time"], columnKey: ["_field"],valueColumn: "_value")' + \
+        '|> sort(columns: ["_time"])'
+
+def make_query(start, stop, agg_val, stats=None):
+    # the query for the fields and tags in force (main() may have
+    # changed them)
+    if stats:
+        return build_stats_query(start, stop, agg_val, stats, fields,
+            bucket, tags)
+    return build_query(start, stop, agg_val, fields, bucket, tags)
+
+def query_records(client, query):
+    # Run query and return a csv reader over the streamed response.
+    # query_raw() hands back the unread HTTP response, so nothing is
+    # held in memory beyond the read buffer.
+    response = client.query_api().query_raw(query)
+    text = io.TextIOWrapper(io.BufferedReader(response, read_size),
+        encoding='utf-8', newline='')
+    return csv.reader(text)
+
+def pivot_rows(records, columns):
+    # Turn annotated CSV records from a pivoted query into rows of
+    # [iso time, value for each of columns].  Each table in the result
+    # starts with its own header row, and columns are matched up by
+    # name, so a table missing some fields gets empty values for them.
+    # The first 3 fields of each record (blank, result, table) aren't
+    # useful.
+    remap = None
+    for record in records:
+        if not record or record[0].startswith('#'):  # blank or annotation
             continue
-        if str(record[0]).startswith('#'):  # get rid of comments
+        if record[3] == '_time':
+            names = record[4:]
+            if names == columns:
+                remap = None
+            else:
+                index = dict((n, i + 4) for i,n in enumerate(names))
+                remap = [index.get(c) for c in columns]
             continue
-        try:
-            record = record[3:]     # first 3 fields aren't useful
-        except:
+        iso = record[3].rstrip('Z')     # get rid of trailing Z
+        if remap is None:
+            record[3] = iso
+            yield record[3:]
+        else:
+            yield [iso] + [record[i] if i is not None else '' \
+                for i in remap]
+
+def header_meta(columns, start, stop, agg_val, bucket=bucket):
+    # what the header says, for the binary formats
+    return {'bucket': bucket,
+        'query_time': datetime.utcnow().isoformat(timespec='seconds',sep='T'),
+        'start': start.rstrip('Z'), 'stop': stop.rstrip('Z'),
+        'agg_val': agg_val, 'fields': list(columns)}
+
+def write_header(outf, columns, start, stop, bucket=bucket):
+    # print metadata
+    outf.write("# Query run on bucket {} at {}\n". \
+        format(bucket, \
+        datetime.utcnow().isoformat(timespec='seconds',sep='T')))
+    outf.write("# Records start at {} and end at {}\n". \
+        format(start.rstrip('Z'),stop.rstrip('Z')))
+    outf.write("# Field names:\n")
+    # print the list of fields.  note no "#" at
+    # beginning because astropy won't read them
+    outf.write('\t'.join(['iso','unix'] + columns) + '\n')
+
+def write_rows(outf, rows, progress=True):
+    # Write rows of [iso, values...] with a unix time column added
+    # after the iso one, chunk_rows at a time.  Returns the row count.
+    writer = csv.writer(outf, delimiter='\t', lineterminator='\n')
+    count = 0
+    start = last = time.monotonic()
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_rows:
+            count = count + write_chunk(writer, chunk)
+            chunk = []
+            now = time.monotonic()
+            if progress and now - last >= progress_interval:
+                print("{} rows, {:.0f} rows/sec".format(count,
+                    count / (now - start)), file=sys.stderr)
+                last = now
+    count = count + write_chunk(writer, chunk)
+    if progress:
+        elapsed = max(time.monotonic() - start, 1e-9)
+        print("{} rows in {:.1f} seconds, {:.0f} rows/sec".format(count,
+            elapsed, count / elapsed), file=sys.stderr)
+    return count
+
+def unix_times(isos):
+    # UTC ISO8601 strings (no Z) to an int64 array of unix seconds,
+    # parsed all at once by numpy
+    ns = np.array(isos, dtype='datetime64[ns]').view(np.int64)
+    return ns // 1_000_000_000
+
+def write_chunk(writer, chunk):
+    # Convert the ISO timestamp into unix time for convenience
+    # (both are included in output).  The whole chunk's times are
+    # converted in one go.
+    if chunk:
+        unix = unix_times([row[0] for row in chunk]).tolist()
+        for row,u in zip(chunk, unix):
+            row.insert(1, u)
+    writer.writerows(chunk)
+    return len(chunk)
+
+##### Forward fill #####
+
+def fill_query(start, limit, fields=fields, bucket=bucket, tags=tags):
+    # the last value of each field in the limit seconds before start
+    a = format_time(parse_time(start).timestamp() - limit)
+    return 'from(bucket: ' + flux_string(bucket) + ')' + \
+        '|> range(start: ' + a + ', stop: ' + start + ')' + \
+        select_filter(fields, tags) + '|> last()' + \
+        '|> map(fn: (r) => ({_time: r._time, _field: ' + \
+        field_expr(fields) + ', _value: r._value}))'
+
+def fill_seed(client, start, limit):
+    # {column: (value, unix time)} from fill_query().  Each table of
+    # the result has its own header row, as the values' types differ.
+    seed = {}
+    index = None
+    for record in query_records(client, fill_query(start, limit,
+            fields, bucket, tags)):
+        if not record or record[0].startswith('#'):
             continue
-        try:
-            record[0] = record[0].rstrip('Z')    # get rid of trailing Z
-        except:
+        if record[1] == 'result':
+            index = [record.index(c) for c in ['_time','_field','_value']]
             continue
-        # The order of the columns in the returned data might not
-        # be predictable, but the field names are contained in the
-        # first row that doesn't start with '#'.  Assumes the first
-        # field of header names starts with _time and all following
-        # rows are iso 8601 strings.  Convert the ISO timestamp into
-        # unix time for convenience (both are included in output).
-        if record[0] == '_time':
-            # drop the _time field
-            field_list = record[1:]
-            # insert iso and unix time fields
-            field_list.insert(0,'unix')
-            field_list.insert(0,'iso')
-            f = '\t'.join(field_list)
-            # print metadata
-            outf.write("# Query run on bucket {} at {}\n". \
-                format(bucket, \
-                datetime.utcnow().isoformat(timespec='seconds',sep='T')))
-            outf.write("# Records start at {} and end at {}\n". \
-                format(start.rstrip('Z'),stop.rstrip('Z')))
-            outf.write("# Field names:\n")
-            # print the list of fields.  note no "#" at
-            # beginning because astropy won't read them
-            outf.write(f + '\n')
+        t, name, value = [record[i] for i in index]
+        seed[name] = (value, int(unix_times([t.rstrip('Z')])[0]))
+    return seed
+
+class FillOut:
+    # Wraps the output for --fill: empty values are filled from the
+    # last value in their column no more than limit seconds before.
+    # Takes the text the tsv paths write (iso, unix, values...) and,
+    # for ColumnarWriter, rows of [iso, values...].
+
+    def __init__(self, out, columns, seed, limit):
+        self.out = out
+        self.limit = limit
+        self.last = [seed.get(c) for c in columns]  # (value, unix time)
+        self.partial = ''
+
+    def fill(self, values, t, first):
+        # values[first:] are the columns
+        for i,v in enumerate(values[first:]):
+            if v != '':
+                self.last[i] = (v, t)
+            elif self.last[i] is not None and \
+                    t - self.last[i][1] <= self.limit:
+                values[first + i] = self.last[i][0]
+
+    def write(self, text):
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        out = []
+        for line in lines:
+            if line and line[0] != '#':
+                row = line.split('\t')
+                self.fill(row, int(row[1]), 2)
+                line = '\t'.join(row)
+            out.append(line + '\n')
+        self.out.write(''.join(out))
+
+    def filled(self, rows):
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_rows:
+                yield from self.fill_chunk(chunk)
+                chunk = []
+        yield from self.fill_chunk(chunk)
+
+    def fill_chunk(self, chunk):
+        if chunk:
+            unix = unix_times([row[0] for row in chunk]).tolist()
+            for row,t in zip(chunk, unix):
+                self.fill(row, t, 1)
+        return chunk
+
+    def write_rows(self, rows):
+        return self.out.write_rows(self.filled(rows))
+
+    def close(self):
+        if self.partial:
+            self.write('\n')
+        return self.out.close()
+
+##### Sharded queries #####
+
+def shard_windows(start, stop, shard_len):
+    # Split start..stop into (start, stop) RFC3339 pairs at multiples
+    # of shard_len seconds since the epoch.  aggregateWindow windows
+    # are aligned to the epoch too, so if shard_len is a multiple of
+    # the aggregation period no window straddles two shards.
+    t0 = parse_time(start).timestamp()
+    t1 = parse_time(stop).timestamp()
+    edges = [t0]
+    edge = (t0 // shard_len + 1) * shard_len
+    while edge < t1:
+        edges.append(edge)
+        edge = edge + shard_len
+    edges.append(t1)
+    windows = []
+    for a,b in zip(edges[:-1], edges[1:]):
+        windows.append((format_time(a), format_time(b)))
+    windows[0] = (start, windows[0][1])
+    windows[-1] = (windows[-1][0], stop)
+    return windows
+
+def fetch_shard(client, query, part, retries, columns):
+    # Run one shard's query into its part file, retrying on failure.
+    # The part file only appears once it is complete.
+    tmp = part + '.tmp'
+    for attempt in range(retries + 1):
         try:
-            unix_time = str(int(datetime.fromisoformat(record[0]).timestamp()))
-            record.insert(1,unix_time)
-        except:
-            continue
-        line = '\t'.join(record).rstrip('\r')
-        outf.write(line + '\n')
-outf.close()
+            with open(tmp, 'w', buffering=buffer_size, newline='') as f:
+                n = write_rows(f, pivot_rows(query_records(client, query),
+                    columns), progress=False)
+            os.replace(tmp, part)
+            return n
+        except Exception as e:
+            if attempt == retries:
+                raise
+            print("shard " + os.path.basename(part) + " failed (" + \
+                str(e) + "), retrying", file=sys.stderr)
+            time.sleep(2 ** attempt)
+
+def run_sharded(client, outf, outfile, start, stop, agg_val, shard,
+        workers, retries, stats=None):
+    # Returns True if every shard made it into outf
+    agg_len = agg_seconds(agg_val)
+    shard_len = parse_duration(shard)
+    if shard_len < agg_len or shard_len % agg_len:
+        raise ValueError("shard length must be a multiple of agg_val")
+    windows = shard_windows(start, stop, shard_len)
+
+    # Finished shards from an earlier run of the same query are reused
+    parts_dir = outfile + '.parts'
+    plan = {'bucket': bucket, 'start': start, 'stop': stop,
+        'agg_val': agg_val, 'shard': shard, 'fields': fields,
+        'tags': tags, 'stats': stats}
+    try:
+        with open(os.path.join(parts_dir, 'plan.json')) as f:
+            if json.load(f) != plan:
+                shutil.rmtree(parts_dir)
+    except FileNotFoundError:
+        pass
+    os.makedirs(parts_dir, exist_ok=True)
+    with open(os.path.join(parts_dir, 'plan.json'), 'w') as f:
+        json.dump(plan, f)
+    parts = [os.path.join(parts_dir, 'shard-%06d.tsv' % i)
+        for i in range(len(windows))]
+    done = [os.path.exists(p) for p in parts]
+    print("{} shards, {} already done".format(len(windows), sum(done)),
+        file=sys.stderr)
+
+    failed = False
+    rows = 0
+    next_part = 0
+    started = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        futures = {}
+        for i,(a,b) in enumerate(windows):
+            if not done[i]:
+                q = make_query(a, b, agg_val, stats)
+                futures[pool.submit(fetch_shard, client, q, parts[i],
+                    retries, output_columns(stats))] = i
+        pending = set(futures)
+        while True:
+            # copy out every finished shard that's next in time order
+            while next_part < len(parts) and done[next_part]:
+                with open(parts[next_part], newline='') as f:
+                    shutil.copyfileobj(f, outf, buffer_size)
+                next_part = next_part + 1
+            if not pending:
+                break
+            finished, pending = concurrent.futures.wait(pending,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in finished:
+                i = futures[fut]
+                try:
+                    n = fut.result()
+                except Exception as e:
+                    print("shard {} of {} ({} to {}) failed: {}".format(
+                        i + 1, len(windows), windows[i][0], windows[i][1], e),
+                        file=sys.stderr)
+                    failed = True
+                    continue
+                done[i] = True
+                rows = rows + n
+                elapsed = max(time.monotonic() - started, 1e-9)
+                print("shard {} of {} done, {} rows, {:.0f} rows/sec".format(
+                    i + 1, len(windows), rows, rows / elapsed),
+                    file=sys.stderr)
+    if failed:
+        return False
+    shutil.rmtree(parts_dir)
+    return True
+
+##### Cached queries #####
+
+def fetch_into_cache(client, cache, first, last, agg_val, stats=None):
+    # Query chunks first..last (inclusive) in one go and store each
+    a = cache.chunk_range(first)[0]
+    b = cache.chunk_range(last)[1]
+    q = make_query(format_time(a), format_time(b), agg_val, stats)
+    rows = pivot_rows(query_records(client, q), output_columns(stats))
+    chunk = first
+    batch = []
+    # rows go by comparing their iso time with each chunk's end as
+    # strings, which sorts the same as comparing the times
+    end = format_time(cache.chunk_range(chunk)[1])[:19]
+
+    def store(i, batch):
+        tmp = cache.chunk_path(i) + '.tmp'
+        with open(tmp, 'w', buffering=buffer_size, newline='') as f:
+            write_chunk(csv.writer(f, delimiter='\t', lineterminator='\n'),
+                batch)
+        cache.put(i, tmp)
+
+    for row in rows:
+        while row[0][:19] > end and chunk < last:
+            store(chunk, batch)
+            batch = []
+            chunk = chunk + 1
+            end = format_time(cache.chunk_range(chunk)[1])[:19]
+        batch.append(row)
+    while chunk <= last:
+        store(chunk, batch)
+        batch = []
+        chunk = chunk + 1
+
+def run_cached(client, outf, start, stop, agg_val, workers, refresh,
+        stats=None):
+    from query_cache import QueryCache, evict
+    agg_len = parse_duration(agg_val)
+    chunk_len = parse_duration(cache_chunk)
+    if chunk_len < agg_len or chunk_len % agg_len:
+        raise ValueError("cache_chunk must be a multiple of agg_val")
+    # keyed on the fields as given, stats and tags, so each selection
+    # has its own
+    cache = QueryCache(bucket, output_columns(stats, fields) + \
+        [k + '=' + v for k,v in sorted(tags.items())], agg_val, chunk_len)
+    now = time.time()
+    if refresh:
+        n = cache.invalidate(now - parse_duration(refresh))
+        print("dropped", n, "cached chunks", file=sys.stderr)
+    cutoff = now - parse_duration(cache_recent)
+
+    t0 = parse_time(start).timestamp()
+    t1 = parse_time(stop).timestamp()
+    first = int(t0 // chunk_len)
+    last = cache.chunk_of(t1)
+    # chunks that are old enough to cache; anything after is live
+    cacheable = [i for i in range(first, last + 1)
+        if cache.chunk_range(i)[1] <= cutoff]
+    missing = [i for i in cacheable if cache.get(i) is None]
+    print("{} cached chunks, {} to fetch".format(
+        len(cacheable) - len(missing), len(missing)), file=sys.stderr)
+
+    # fetch each run of consecutive missing chunks as one query
+    runs = []
+    for i in missing:
+        if runs and runs[-1][1] == i - 1:
+            runs[-1][1] = i
+        else:
+            runs.append([i, i])
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        for fut in [pool.submit(fetch_into_cache, client, cache, a, b,
+                agg_val, stats) for a,b in runs]:
+            fut.result()
+
+    # Assemble the output; only the chunks at each end need trimming
+    # to start < time <= stop.  The rows' iso times compare as strings.
+    lo = format_time(t0)[:19]
+    hi = format_time(t1)[:19]
+    for i in cacheable:
+        with open(cache.get(i), newline='') as f:
+            a,b = cache.chunk_range(i)
+            if a >= t0 and b <= t1:
+                shutil.copyfileobj(f, outf, buffer_size)
+            else:
+                for line in f:
+                    if lo < line[:19] <= hi:
+                        outf.write(line)
+    if not cacheable or cache.chunk_range(cacheable[-1])[1] < t1:
+        live = start
+        if cacheable:
+            live = format_time(cache.chunk_range(cacheable[-1])[1])
+        q = make_query(live, stop, agg_val, stats)
+        write_rows(outf, pivot_rows(query_records(client, q),
+            output_columns(stats)))
+    freed = evict()
+    if freed:
+        print("cache: evicted", freed, "bytes", file=sys.stderr)
+
+##### Planning #####
+
+def plan_agg(start, stop, points):
+    # shortest agg_val from agg_ladder giving at most points rows
+    span = parse_time(stop).timestamp() - parse_time(start).timestamp()
+    for agg in agg_ladder:
+        length = parse_duration(agg)
+        if length >= sample_period and span / length <= points:
+            return agg
+    return agg_ladder[-1]
+
+def estimate(start, stop, agg_val, fmt, float32, stats=None):
+    # (rows, output bytes, raw points scanned) for a query
+    span = parse_time(stop).timestamp() - parse_time(start).timestamp()
+    rows = int(span // agg_seconds(agg_val))
+    columns = len(output_columns(stats))
+    if fmt == 'tsv':
+        size = rows * (time_text_bytes + text_bytes * columns)
+    else:
+        size = rows * (8 + (4 if float32 else 8) * columns)
+    scanned = int(span // sample_period) * len(fields)
+    return rows, size, scanned
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Query InfluxDB into a tab separated file")
+    # ISO8601 format datetime
+    parser.add_argument('start')
+    parser.add_argument('stop')
+    # reduce data by aggregating this number of readings
+    # needs to be string with m,h,d, etc. e.g. '5m'
+    parser.add_argument('agg_val', nargs='?')
+    budget = parser.add_mutually_exclusive_group()
+    budget.add_argument('--points', type=int,
+        help="choose agg_val to give at most this many rows")
+    budget.add_argument('--pixels', type=int,
+        help="choose agg_val for a plot this many pixels wide")
+    budget.add_argument('--raw', action='store_true',
+        help="no aggregation: every point, pivoted on its exact time "
+        "(for data from collectors that share cycle timestamps)")
+    parser.add_argument('--estimate', action='store_true',
+        help="print the expected size of the result and stop")
+    parser.add_argument('--stats', nargs='?', const=','.join(stat_exprs),
+        help="comma separated statistics per window, from " + \
+        ', '.join(stat_exprs) + " (default all); columns are "
+        "<field>_<stat>")
+    parser.add_argument('--field', action='append',
+        metavar='[MEASUREMENT.]FIELD',
+        help="field to get, instead of the list in this file (may be "
+        "repeated)")
+    parser.add_argument('--tag', action='append', default=[],
+        metavar='KEY=VALUE',
+        help="only series with this tag value (may be repeated)")
+    parser.add_argument('--fill', nargs='?', const=fill_limit,
+        metavar='DURATION',
+        help="fill empty values from the last value up to this old "
+        "(default %(const)s), for fields only sent when they change")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--shard', metavar='DURATION',
+        help="split the range into shards of this length, a multiple "
+        "of agg_val (e.g. 1d), and run them in parallel")
+    mode.add_argument('--cache', action='store_true',
+        help="use the local query cache")
+    parser.add_argument('--workers', type=int, default=workers,
+        help="shards to run at once (default %(default)s)")
+    parser.add_argument('--retries', type=int, default=retries,
+        help="times to retry a failed shard (default %(default)s)")
+    parser.add_argument('--refresh', metavar='DURATION',
+        help="with --cache, first drop cached data newer than this")
+    parser.add_argument('--format', default='tsv',
+        choices=['tsv','parquet','arrow','npz','hdf5'],
+        help="output format (default %(default)s)")
+    parser.add_argument('--compression',
+        help="compression for binary formats (see columnar_out.py)")
+    parser.add_argument('--float32', action='store_true',
+        help="store values as float32 in binary formats")
+    args = parser.parse_args()
+
+    start = zulu(args.start)
+    stop = zulu(args.stop)
+    if args.pixels:
+        args.points = args.pixels * points_per_pixel
+    if args.raw:
+        if args.agg_val:
+            parser.error("give agg_val or --raw, not both")
+        if args.cache or args.stats:
+            parser.error("--raw can't be used with --cache or --stats")
+        agg_val = raw_agg
+    elif args.points:
+        if args.agg_val:
+            parser.error("give agg_val or --points/--pixels, not both")
+        agg_val = plan_agg(start, stop, args.points)
+        print("Using agg_val", agg_val, file=sys.stderr)
+    elif args.agg_val:
+        agg_val = args.agg_val
+    else:
+        parser.error("agg_val, --points/--pixels or --raw is needed")
+
+    global fields, tags
+    if args.field:
+        fields = args.field
+    for t in args.tag:
+        key, eq, value = t.partition('=')
+        if not eq:
+            parser.error("--tag needs KEY=VALUE, not " + repr(t))
+        tags = dict(tags, **{key: value})
+    try:
+        column_names(fields)
+    except ValueError as e:
+        parser.error(e)
+
+    stats = None
+    if args.stats:
+        stats = args.stats.split(',')
+        for st in stats:
+            if st not in stat_exprs:
+                parser.error("unknown statistic " + repr(st))
+    columns = output_columns(stats)
+    if args.fill:
+        if stats:
+            parser.error("--fill can't be used with --stats")
+        try:
+            fill_len = parse_duration(args.fill)
+        except ValueError as e:
+            parser.error(e)
+
+    if args.estimate:
+        rows, size, scanned = estimate(start, stop, agg_val, args.format,
+            args.float32, stats)
+        print("agg_val {}: about {:,} rows of {} columns, {:.1f} MB as {}; "
+            "the server scans about {:,} points".format(agg_val, rows,
+            len(columns), size / 1e6, args.format, scanned))
+        return
+
+    outfile = outfile_name(start, stop, agg_val)
+    columnar = args.format != 'tsv'
+    # open output file
+    try:
+        if columnar:
+            from columnar_out import ColumnarWriter, formats
+            outfile = outfile[:-4] + formats[args.format]
+            meta = header_meta(columns, start, stop, agg_val)
+            if args.fill:
+                meta['fill'] = args.fill
+            outf = ColumnarWriter(outfile, args.format, columns, meta,
+                args.compression, args.float32)
+        else:
+            outf = open(outfile, 'w', buffering=buffer_size, newline='')
+    except (ValueError, ImportError) as e:
+        print(e)
+        sys.exit(1)
+    except:
+        print("Couldn't open output file",outfile)
+        sys.exit()
+    print("Output is in",outfile)
+
+    with InfluxDBClient(url=url,token=token,org=org,timeout=timeout,
+            connection_pool_maxsize=max(args.workers, 1)) as client:
+        if not columnar:
+            write_header(outf, columns, start, stop)
+        if args.fill:
+            outf = FillOut(outf, columns,
+                fill_seed(client, start, fill_len), fill_len)
+        if args.shard:
+            ok = run_sharded(client, outf, outfile, start, stop, agg_val,
+                args.shard, args.workers, args.retries, stats)
+        elif args.cache:
+            run_cached(client, outf, start, stop, agg_val, args.workers,
+                args.refresh, stats)
+            ok = True
+        elif columnar:
+            my_query = make_query(start, stop, agg_val, stats)
+            outf.write_rows(pivot_rows(query_records(client, my_query),
+                columns))
+            ok = True
+        else:
+            my_query = make_query(start, stop, agg_val, stats)
+            write_rows(outf, pivot_rows(query_records(client, my_query),
+                columns))
+            ok = True
+    rows = outf.close()
+    if columnar:
+        print(rows, "rows written", file=sys.stderr)
+    if not ok:
+        os.remove(outfile)
+        print("Some shards failed; run the same command again to finish",
+            file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+# influx_writer.py v.20261018.1
+# copyright 2023 John Ackermann N8UR jra@febo.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Optional output that writes line protocol straight to InfluxDB over
+# HTTP instead of going through telegraf's unix socket.  Lines are sent
+# gzip'd in writes of up to batch_size points, and send() only returns
+# once InfluxDB has accepted them all, so spool.drain() acknowledges
+# nothing that could still be lost in a client buffer.
+#
+# A write that fails for want of a connection, or with a 429 or 5xx
+# reply, is tried again up to max_retries times, waiting retry_interval
+# ms at first and exponential_base times longer each time, up to
+# max_retry_delay.  If it still fails send() raises OSError like
+# TelegrafSocket does; the lines stay in the spool and the drainer
+# tries again later with its own backoff.  A write refused as bad data
+# (400, 413 or 422) is split in half and each half tried again, down
+# to the single lines InfluxDB won't take; those are raised as
+# spool.Rejected, for the drainer to set aside, and the rest is stored.
+# Any other refusal (a wrong token or bucket) is an OSError, so the
+# data waits until the settings are fixed.
+#
+# There is no flush interval: the spool does the batching.  Lines wait
+# there until the drainer next runs (as each cycle's lines come in,
+# under logger_daemon.py), and it sends all that's waiting in writes of
+# batch_size.  That costs a write per cycle rather than one per
+# flush_interval, a few each minute, which is nothing to InfluxDB, and
+# buys acknowledging only what is stored (see bench_output.py).
+#
+# InfluxWriter has the same send(lines)/close() methods as
+# logger_funcs.TelegrafSocket, so it can be used anywhere that is.
+# Set output = 'influxdb' in logger_funcs.py to use it.
+
+import threading
+import time
+
+# pip3 install influxdb-client
+from influxdb_client import InfluxDBClient
+from influxdb_client.client.exceptions import InfluxDBError
+from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client.rest import ApiException
+from urllib3.exceptions import HTTPError
+
+from spool import Rejected
+
+# adjust for local environment
+url = 'your_url'
+org = 'your_org'
+bucket = 'your_bucket'
+token = 'your_token'
+
+gzip = True
+batch_size = 5000           # points per HTTP write
+timeout = 30_000            # ms to wait for InfluxDB to answer a write
+retry_interval = 1_000      # ms before the first retry
+max_retries = 3
+max_retry_delay = 8_000     # ms
+exponential_base = 2
+
+# replies that mean InfluxDB won't take (some of) the lines as they are
+refused = (400, 413, 422)
+
+class InfluxWriter:
+
+    def __init__(self, url=url, token=token, org=org, bucket=bucket,
+            batch_size=batch_size, timeout=timeout):
+        self.bucket = bucket
+        self.org = org
+        self.batch_size = batch_size
+        self.client = InfluxDBClient(url=url, token=token, org=org,
+            enable_gzip=gzip, timeout=timeout)
+        self.write_api = self.client.write_api(write_options=SYNCHRONOUS)
+
+    def write(self, records):
+        # One write of records, retrying as above.  Raises ApiException
+        # if InfluxDB refuses the data, OSError if it can't be sent.
+        delay = retry_interval
+        for attempt in range(max_retries + 1):
+            try:
+                self.write_api.write(bucket=self.bucket, org=self.org,
+                    record=b'\n'.join(records))
+                return
+            except ApiException as e:
+                if e.status in refused:
+                    raise
+                error = e
+                if e.status != 429 and (e.status or 0) < 500:
+                    break
+            except (InfluxDBError, HTTPError) as e:
+                error = e
+            if attempt < max_retries:
+                time.sleep(delay / 1000)
+                delay = min(delay * exponential_base, max_retry_delay)
+        raise OSError("InfluxDB write failed: " + str(error)) from error
+
+    def send(self, lines):
+        # lines is a list of str or bytes line protocol; an item may
+        # hold several newline separated lines.  Blocks until InfluxDB
+        # has taken every line, or raises OSError (lines from writes
+        # before the failed one have been stored), or raises Rejected
+        # with the lines it refused (all the others have been stored).
+        records = []
+        for x in lines:
+            if isinstance(x, str):
+                x = x.encode()
+            records.extend(x.splitlines())
+        parts = [records[i:i + self.batch_size]
+            for i in range(0, len(records), self.batch_size)]
+        parts.reverse()
+        bad = []
+        reason = None
+        while parts:
+            part = parts.pop()
+            try:
+                self.write(part)
+            except ApiException as e:
+                if len(part) == 1:
+                    bad.extend(part)
+                    reason = "InfluxDB replied " + str(e.status)
+                else:
+                    half = len(part) // 2
+                    parts.extend([part[half:], part[:half]])
+        if bad:
+            raise Rejected(bad, reason)
+        return len(records)
+
+    def close(self):
+        self.write_api.close()
+        self.client.close()
+
+# One client shared by everything in the process
+shared = None
+shared_lock = threading.Lock()
+
+def get_writer():
+    global shared
+    with shared_lock:
+        if shared is None:
+            shared = InfluxWriter()
+        return shared
@@ -0,0 +1,436 @@
+# line_protocol.py v.20261018.1
+# copyright 2023 John Ackermann N8UR jra@febo.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Schema-driven InfluxDB line protocol encoder used by the collectors.
+#
+# Each instrument reply is described once by a Schema: the measurement
+# name, its tags, the list of (field name, type) pairs, and optionally
+# a parse function that turns the reply's whitespace separated tokens
+# into one value per field.  When the Schema is built it generates and
+# compiles an encoder for that exact field list, with the escaped
+# measurement, tags and field keys already baked into it, so encoding
+# a reading is a format and an append to a reusable bytearray.
+#
+# Field types:
+#   'float'  - written as a plain number (how telegraf stores them now);
+#              text from the device that is a plain decimal number is
+#              written as it came, so no precision is lost; other text
+#              goes through float()
+#   'int'    - written with the 'i' suffix
+#   'string' - quoted, with '"' and '\' escaped
+#   'bool'   - written as t or f
+#
+# A value of None leaves that field out of the line.  Float values
+# that aren't finite are left out too, since InfluxDB rejects them.
+# If no fields are left, no line is written at all.
+#
+# Devices report some things as text or as packed bits.  Stored as
+# strings these can't be averaged on the server (aggregateWindow
+# leaves them out) and take far more room than numbers, so Enum turns
+# text from a known list into small int codes, and word_flags() splits
+# a status word into one bool per bit.  InfluxDB won't change the type
+# of an existing field, so the numeric versions need new field names.
+#
+# A Schema can also be given deadband rules, so fields that haven't
+# moved are left out of its lines (see Deadband).  The last values sent
+# are kept in memory, so this only saves anything in a long running
+# process (logger_daemon.py); a collector run on its own every minute
+# sends everything each time.  Values only count as sent once the
+# daemon has the lines in its spool and commits them.
+
+import math
+import re
+
+# seconds: a field with a deadband is still sent at least this often
+heartbeat = 600
+
+def escape_measurement(s):
+    return s.replace('\\','\\\\').replace(',','\\,').replace(' ','\\ ')
+
+def escape_key(s):
+    # tag keys, tag values and field keys
+    return escape_measurement(s).replace('=','\\=')
+
+def escape_string(s):
+    return s.replace('\\','\\\\').replace('"','\\"')
+
+# A number as InfluxDB takes it.  Anything else ('nan', '1-2' or empty
+# text from a garbled reply) would get the line, and with it everything
+# packed in the same datagram, refused by InfluxDB, so it is left out of
+# the line instead.
+is_number = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'). \
+    fullmatch
+
+# Float texts already found to be numbers.  Device readings repeat a
+# lot, so the encoders' fast path checks a line's float texts against
+# this set in one issuperset() call, and only tests the new ones.
+numbers_seen = set()
+max_numbers_seen = 100000
+
+def all_numbers(texts):
+    # True if every one of texts is finite number text, remembering
+    # the new ones in numbers_seen
+    for x in texts:
+        if x not in numbers_seen:
+            if not (is_number(x) and math.isfinite(float(x))):
+                return False
+            if len(numbers_seen) >= max_numbers_seen:
+                numbers_seen.clear()
+            numbers_seen.add(x)
+    return True
+
+# the timestamp text of the last line encoded, as (t, b' t\n'), shared
+# by all the encoders; it is replaced whole, so threads can share it
+stamp = [(None, None)]
+
+def format_float(x):
+    # number text from the device is written as it came, less any
+    # padding, and numbers as repr() gives them; None (leave the field
+    # out) for text that isn't a number and for nan and inf
+    if isinstance(x, str):
+        x = x.strip()
+        return x.encode() if all_numbers((x,)) else None
+    f = float(x)
+    if not math.isfinite(f):
+        return None
+    return repr(f).encode()
+
+def format_int(x):
+    return b'%di' % int(x)
+
+def format_string(x):
+    return b'"' + escape_string(str(x)).encode() + b'"'
+
+def format_bool(x):
+    return b't' if x else b'f'
+
+formatters = {
+    'float': format_float,
+    'int': format_int,
+    'string': format_string,
+    'bool': format_bool,
+    }
+
+def split_tokens(tokens, num_fields):
+    # default parse rule: one token per field, in order; missing
+    # trailing fields become None and extra tokens are ignored
+    if len(tokens) == num_fields:
+        return tokens
+    values = list(tokens[:num_fields])
+    values.extend([None] * (num_fields - len(values)))
+    return values
+
+class Enum:
+    # Small int codes for the values a device reports as text.  A
+    # value's code is its place in names, so only ever add names at
+    # the end.  Text not in the list gets code unknown, and is printed
+    # the first time it's seen so it can be added.
+
+    def __init__(self, name, names, unknown=-1):
+        self.name = name
+        self.codes = dict((n, i) for i,n in enumerate(names))
+        self.unknown = unknown
+        self.seen = set()
+
+    def code(self, text):
+        if text is None:
+            return None
+        c = self.codes.get(text)
+        if c is None:
+            if text not in self.seen:
+                self.seen.add(text)
+                print(self.name + ": no code for " + repr(text))
+            c = self.unknown
+        return c
+
+# the flags in each byte value, lowest bit first, so a status word is
+# decoded a byte at a time by lookup rather than bit by bit
+byte_flags = [tuple(bool(b >> i & 1) for i in range(8)) for b in range(256)]
+
+def word_flags(word, nbits=32):
+    # list of nbits bools, bit 0 first
+    b = byte_flags
+    if nbits == 32:
+        return list(b[word & 0xff] + b[word >> 8 & 0xff] +
+            b[word >> 16 & 0xff] + b[word >> 24 & 0xff])
+    flags = []
+    for shift in range(0, nbits, 8):
+        flags.extend(b[word >> shift & 0xff])
+    return flags[:nbits]
+
+class Deadband:
+    # Leaves fields out of a schema's lines while they stay within a
+    # band around the value last sent.  rules maps field name to
+    #   ('abs', x)   send once it is more than x from the last sent
+    #   ('rel', x)   send once it is more than x times the last sent
+    #                value away from it
+    #   ('change',)  send whenever it differs at all (status words,
+    #                codes, flags, text)
+    # Fields with no rule are always sent.  Every field is sent at
+    # least once per heartbeat seconds whatever it does, so a steady
+    # value can be told from a dead collector.
+
+    def __init__(self, field_names, rules, heartbeat=heartbeat):
+        self.rules = []
+        for name,rule in rules.items():
+            if rule[0] not in ('abs','rel','change'):
+                raise ValueError("unknown deadband " + repr(rule[0]) + \
+                    " for field " + name)
+            self.rules.append((field_names.index(name), rule))
+        self.heartbeat = int(heartbeat * 1_000_000_000)
+        self.last = {}          # field index -> (value, t) last sent
+        # (index, value) encoded for time pending_t, until commit()
+        self.pending = []
+        self.pending_t = None
+
+    def moved(self, rule, last, v):
+        if rule[0] == 'change':
+            return v != last
+        last = float(last)
+        d = abs(float(v) - last)
+        if rule[0] == 'abs':
+            return d > rule[1]
+        return d > rule[1] * abs(last)
+
+    def filter(self, values, t):
+        # values with the fields that haven't moved since they were
+        # last sent replaced by None, and the list of (index, value)
+        # that are to go out
+        out = None
+        sent = []
+        for i,rule in self.rules:
+            v = values[i]
+            if v is None:
+                continue
+            last = self.last.get(i)
+            if last is None or t - last[1] >= self.heartbeat or \
+                    self.moved(rule, last[0], v):
+                sent.append((i, v))
+            else:
+                if out is None:
+                    out = list(values)
+                out[i] = None
+        return (values if out is None else out), sent
+
+    def commit(self, t):
+        # Count the values encoded for time t as sent, once their lines
+        # are safely away.  Values encoded for any other time belong to
+        # a sample that was dropped, and are forgotten.
+        if self.pending_t == t:
+            for i,v in self.pending:
+                self.last[i] = (v, t)
+        self.discard()
+
+    def discard(self):
+        # forget what was encoded since the last commit, so it goes
+        # out again next time
+        self.pending = []
+        self.pending_t = None
+
+    def wrap(self, encode_into):
+        # encode_into with this deadband applied; what it encodes is
+        # held for commit()
+        def filtered(buf, v, t):
+            v, sent = self.filter(v, t)
+            ok = encode_into(buf, v, t)
+            if self.pending_t != t:
+                self.pending = []
+                self.pending_t = t
+            self.pending.extend(sent)
+            return ok
+        return filtered
+
+class Schema:
+
+    def __init__(self, measurement, tags, fields, parse=None,
+            deadband=None, check=True):
+        self.measurement = measurement
+        self.tags = dict(tags)
+        self.fields = list(fields)
+        self.field_names = [name for name,ftype in self.fields]
+        self.parse = parse
+        self.check = check
+        for name,ftype in self.fields:
+            if ftype not in formatters:
+                raise ValueError("unknown type " + repr(ftype) + \
+                    " for field " + name)
+        prefix = escape_measurement(measurement)
+        for k in sorted(self.tags):  # InfluxDB likes tags sorted by key
+            prefix = prefix + ',' + escape_key(k) + '=' + \
+                escape_key(str(self.tags[k]))
+        self.prefix = (prefix + ' ').encode()
+        self.encode_into = self.compile()
+        self.deadband = None
+        if deadband:
+            self.deadband = Deadband(self.field_names, deadband)
+            self.encode_into = self.deadband.wrap(self.encode_into)
+        elif parse is None:
+            # the encoder takes tokens as they are
+            self.encode_tokens_into = self.encode_into
+        else:
+            encode_into = self.encode_into
+            def encode_tokens_into(buf, tokens, t):
+                return encode_into(buf, parse(tokens), t)
+            self.encode_tokens_into = encode_tokens_into
+
+    def compile(self):
+        # Generate the source of an encode_into(buf, v, t) function
+        # for this field list and compile it.  It appends one line for
+        # values v and timestamp t (integer ns) to bytearray buf and
+        # returns True, or returns False and leaves buf alone if every
+        # field was None.
+        #
+        # The usual case, every field present and every float plain
+        # number text as read from a device, is one join building the
+        # whole line, and so is every field but the strings (the
+        # maser's diag text, say) being present.  The float texts are
+        # checked all at once against numbers_seen (see all_numbers()),
+        # unless the schema was made with check=False for a device
+        # whose replies are always plain numbers: then they go in as
+        # they came.  There is no separate test for missing values: a
+        # None makes the join, int() or the bool lookup raise, and the
+        # line goes to the unrolled per-field code below, which skips
+        # missing fields, takes floats that aren't text and leaves out
+        # float text that isn't a number.  The
+        # timestamp text is kept from one line to the next, since all
+        # the lines of a cycle have the same time.  v may also be a
+        # reply's tokens, one per field; if there are too many or too
+        # few, the per-field code lines them up with split_tokens().
+        env = {'P': self.prefix, 'escape_string': escape_string,
+            'seen': numbers_seen, 'all_numbers': all_numbers,
+            'stamp': stamp,
+            'BT': {True: 't', False: 'f'}, 'split_tokens': split_tokens}
+        names = ["x%d" % i for i in range(len(self.fields))]
+        strings = [i for i,(name,ftype) in enumerate(self.fields)
+            if ftype == 'string']
+        others = [i for i in range(len(self.fields)) if i not in strings]
+
+        src = ["def encode_into(buf, v, t):",
+               "    s = stamp[0]",
+               "    if s[0] != t:",
+               "        s = (t, b' %d\\n' % t)",
+               "        stamp[0] = s",
+               "    try:",
+               "        " + ', '.join(names) + ", = v"]
+        if not strings:
+            src.extend(self.fast_line(env, 'A', range(len(self.fields))))
+        else:
+            src.append("        if " + ' and '.join(names[i] +
+                " is not None" for i in strings) + ":")
+            src.extend("    " + x for x in
+                self.fast_line(env, 'A', range(len(self.fields))))
+            if others:
+                src.append("        elif " + ' and '.join(names[i] +
+                    " is None" for i in strings) + ":")
+                src.extend("    " + x for x in
+                    self.fast_line(env, 'B', others))
+        src.extend(["    except (TypeError, KeyError, ValueError):",
+                    "        pass",
+                    "    if len(v) != %d:" % len(self.fields),
+                    "        v = split_tokens(v, %d)" % len(self.fields),
+                    "    mark = len(buf)",
+                    "    buf += P",
+                    "    first = len(buf)"])
+        for i,(name,ftype) in enumerate(self.fields):
+            key = escape_key(name).encode()
+            env['K%d' % i] = key + b'='
+            env['C%d' % i] = b',' + key + b'='
+            env['F%d' % i] = formatters[ftype]
+            comma = "K%d if len(buf) == first else C%d" % (i, i)
+            src.append("    x = v[%d]" % i)
+            src.append("    if x is not None:")
+            if ftype == 'float':
+                src.append("        x = F%d(x)" % i)
+                src.append("        if x is not None:")
+                src.append("            buf += " + comma)
+                src.append("            buf += x")
+            elif ftype == 'bool':
+                env['T%d' % i] = key + b'=t'
+                env['U%d' % i] = b',' + key + b'=t'
+                env['G%d' % i] = key + b'=f'
+                env['H%d' % i] = b',' + key + b'=f'
+                src.append("        if len(buf) == first:")
+                src.append("            buf += T%d if x else G%d" % (i, i))
+                src.append("        else:")
+                src.append("            buf += U%d if x else H%d" % (i, i))
+            else:
+                src.append("        buf += " + comma)
+                src.append("        buf += F%d(x)" % i)
+        src.extend(["    if len(buf) == first:",
+                    "        del buf[mark:]",
+                    "        return False",
+                    "    buf += s[1]",
+                    "    return True"])
+        exec(compile('\n'.join(src), '<schema ' + self.measurement + '>',
+            'exec'), env)
+        return env['encode_into']
+
+    def fast_line(self, env, tag, index):
+        # Source, indented for the body of the try, that writes the
+        # fields in index as one line and returns True if the floats
+        # are number text.  The constant parts of the line go in env as
+        # <tag>0, <tag>1...
+        text = self.prefix.decode()
+        expr = []
+        floats = []
+        for n,i in enumerate(index):
+            name, ftype = self.fields[i]
+            text = text + (',' if n else '') + escape_key(name) + '='
+            x = "x%d" % i
+            if ftype == 'float':
+                floats.append(x)
+                value, after = x, ''
+            elif ftype == 'int':
+                value, after = "str(int(" + x + "))", 'i'
+            elif ftype == 'string':
+                text = text + '"'
+                value, after = "escape_string(str(" + x + "))", '"'
+            else:
+                value, after = "BT[" + x + "]", ''
+            env[tag + str(n)] = text
+            expr.extend([tag + str(n), value])
+            text = after
+        if text:
+            env[tag + 'E'] = text
+            expr.append(tag + 'E')
+        line = ["        line = ''.join((" + ', '.join(expr) + ")).encode()",
+            "        buf += line",
+            "        buf += s[1]",
+            "        return True"]
+        if not floats or not self.check:
+            return line
+        if len(floats) == 1:
+            x = floats[0]
+            test = x + " in seen or all_numbers((" + x + ",))"
+        else:
+            f = "(" + ', '.join(floats) + ",)"
+            if len(floats) == len(self.fields):
+                f = "v"
+            test = "seen.issuperset(" + f + ") or all_numbers(" + f + ")"
+        return ["        if " + test + ":"] + \
+            ["    " + x for x in line]
+
+    def values(self, tokens):
+        # turn a device reply, split into tokens, into field values
+        if self.parse is not None:
+            return self.parse(tokens)
+        return split_tokens(tokens, len(self.fields))
+
+    def encode(self, values, t):
+        # return the line for values as bytes (b'' if nothing to send)
+        buf = bytearray()
+        self.encode_into(buf, values, int(t))
+        return bytes(buf)
+
+    def encode_tokens_into(self, buf, tokens, t):
+        return self.encode_into(buf, self.values(tokens), int(t))
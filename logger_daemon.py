@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+# logger_daemon.py v.20261018.1
+# copyright 2023 John Ackermann N8UR jra@febo.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# This is a long-running replacement for logger_1m.timer/logger_1m.sh.
+# Instead of starting a fresh python for each instrument every minute,
+# it imports therm_usb.py, maser_logger.py and hp5071a.py once and runs
+# their collectors as concurrent asyncio tasks.  Serial ports, the
+# maser connection and the telegraf socket stay open between cycles,
+# each cycle starts on the minute, and each device gets its own
+# deadline so a slow or hung instrument doesn't hold up the others.
+#
+# The collectors do blocking I/O, so each sample runs in a worker
+# thread.  A thread can't be killed, so if a device blows its deadline
+# that collector is skipped on later cycles until the stuck sample
+# returns, and its handle is then closed so the next cycle reopens it.
+#
+# Every cycle's lines are written to the on-disk spool (spool.py) and a
+# separate drainer task sends the spool to telegraf, so if telegraf is
+# down nothing is lost and sampling carries on; the backlog goes out
+# as soon as telegraf is back.  With output = 'influxdb' in
+# logger_funcs.py the drainer writes to InfluxDB directly instead,
+# through one HTTP client shared by all the collectors.
+#
+# Each collector is handed the start time of the cycle, which it uses
+# as the timestamp of all its points (see cycle_time() in
+# logger_funcs.py), so every instrument's data for a cycle lines up.
+#
+# High rate mode: collectors listed in fast_collectors are also polled
+# every fast_period seconds for some of their fields (the therm sensors
+# and the maser ?FLL and ?KVD values).  Rather than writing every
+# reading, each is folded into running statistics and one summary point
+# per fast_window seconds is written, stamped with the window's start,
+# with the mean, min, max, standard deviation and count of each field
+# (see window_stats.py).  Write load stays the same as one sample a
+# minute however fast the polling.  A collector with nothing left to
+# read once a minute (therm_usb) drops out of the minute cycle.
+#
+# Usage: logger_daemon.py
+# Run from logger_daemon.service rather than logger_1m.timer.
+
+import asyncio
+import signal
+import threading
+import time
+
+from logger_funcs import make_sender, cycle_period
+from spool import Spool
+from therm_usb import ThermCollector
+from maser_logger import MaserCollector
+from hp5071a import HP5071ACollector
+from window_stats import WindowStats
+
+# Collectors to run and the deadline in seconds for each.  The deadline
+# must be less than cycle_period (set in logger_funcs.py; cycles start
+# on a multiple of it).
+therm = ThermCollector("/dev/ttyACM0")
+maser = MaserCollector()
+collectors = [
+    (therm, 25),
+    (maser, 20),
+    (HP5071ACollector("/dev/ttyUSB0"), 40),
+    ]
+
+# High rate mode: collectors to poll, e.g. [therm, maser] (empty for
+# none), seconds between polls and seconds per summary point.
+# fast_window should divide cycle_period so windows start on the
+# minute.  A poll not done within fast_timeout seconds is given up on;
+# ticks that pass while it runs are skipped.
+fast_collectors = []
+fast_period = 1.0
+fast_window = 60
+fast_timeout = 5.0
+
+# If True, hold each collector's lines until every collector in the
+# cycle has finished or timed out, and send them all together in as
+# few datagrams as possible.  If False, each collector's lines are sent
+# as soon as it finishes.
+pack_cycle = False
+
+# seconds between attempts to drain the spool while telegraf is down,
+# doubling after each failed attempt up to drain_retry_max
+drain_retry = 10
+drain_retry_max = 600
+
+class Slot:
+    # Per-collector state kept by the daemon between cycles
+    def __init__(self, collector, deadline):
+        self.collector = collector
+        self.name = collector.name
+        self.deadline = deadline
+        self.pending = None     # executor future of a sample in progress
+        self.stale = False      # close the handle once pending finishes
+
+    def finished(self, fut):
+        # Runs in the event loop.  The close can wait on a lock a worker
+        # thread holds, so it goes to the executor, and becomes pending
+        # so nothing samples the collector until it's done.
+        if self.stale:
+            self.stale = False
+            self.pending = asyncio.get_running_loop().run_in_executor(
+                None, self.collector.close)
+
+    def commit(self, cycle):
+        # the sample's lines for cycle are in the spool, so its
+        # deadbands can count them as sent
+        for d in self.collector.deadbands:
+            d.commit(cycle)
+
+    def discard(self):
+        # the sample was dropped; what it encoded must go out again
+        for d in self.collector.deadbands:
+            d.discard()
+
+class FastSlot(Slot):
+    # A collector in high rate mode, with the running statistics for
+    # each of its polled schemas
+    def __init__(self, collector):
+        Slot.__init__(self, collector, fast_timeout)
+        self.stats = [WindowStats(schema, fields)
+            for schema,fields in collector.fast]
+        self.failing = False
+
+async def spool_lines(spool, wake, lines):
+    # appends are small, but an fsync can take a moment
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, spool.append, lines)
+    wake.set()
+
+async def drainer(spool, sender, wake, halt):
+    # Send the spool whenever new lines arrive, and every drain_retry
+    # seconds anyway.  While sending fails, new lines don't wake it and
+    # the wait between tries backs off.  When it's cancelled, a drain in
+    # progress is told to stop with halt (a threading.Event) and waited
+    # for, so the spool and sender can be closed after.
+    loop = asyncio.get_running_loop()
+    retry = None        # seconds to the next try while failing
+    while True:
+        if retry is None:
+            try:
+                await asyncio.wait_for(wake.wait(), drain_retry)
+            except asyncio.TimeoutError:
+                pass
+        else:
+            await asyncio.sleep(retry)
+        wake.clear()
+        running = loop.run_in_executor(None,
+            lambda: spool.drain(sender, stop=halt))
+        try:
+            sent = await asyncio.shield(running)
+        except asyncio.CancelledError:
+            halt.set()
+            await asyncio.gather(running, return_exceptions=True)
+            raise
+        except OSError as e:
+            if retry is None:
+                print("logger_daemon: couldn't send to telegraf; " + \
+                    "spooling until it's back")
+                print("logger_daemon: ", e)
+                retry = drain_retry
+            else:
+                retry = min(retry * 2, drain_retry_max)
+            continue
+        if retry is not None:
+            print("logger_daemon: telegraf is back; sent " + str(sent) + \
+                " lines from spool")
+        retry = None
+
+async def run_slot(slot, cycle):
+    # Returns the collector's lines for the cycle starting at cycle
+    # (ns), or [] if it failed or timed out
+    loop = asyncio.get_running_loop()
+    if slot.pending is not None and not slot.pending.done():
+        print(slot.name + ": previous sample still running; skipped")
+        return []
+    start = time.monotonic()
+    slot.pending = loop.run_in_executor(None, slot.collector.sample, cycle)
+    slot.pending.add_done_callback(slot.finished)
+    try:
+        lines = await asyncio.wait_for(asyncio.shield(slot.pending),
+            slot.deadline)
+    except asyncio.TimeoutError:
+        print(slot.name + ": no data within " + str(slot.deadline) + \
+            " seconds")
+        slot.stale = True
+        slot.discard()
+        return []
+    except Exception as e:
+        print(slot.name + ": ", e)
+        slot.discard()
+        return []
+    print(slot.name + ": got data in " + \
+        format(time.monotonic() - start, '.2f') + " seconds")
+    return lines
+
+async def poll_slot(slot):
+    # one high rate reading into slot's statistics.  Failures are
+    # reported once, not every poll.
+    loop = asyncio.get_running_loop()
+    if slot.pending is not None and not slot.pending.done():
+        return
+    slot.pending = loop.run_in_executor(None, slot.collector.poll)
+    slot.pending.add_done_callback(slot.finished)
+    try:
+        readings = await asyncio.wait_for(asyncio.shield(slot.pending),
+            slot.deadline)
+    except Exception as e:
+        if isinstance(e, asyncio.TimeoutError):
+            # a collector the minute cycle also uses is left open for
+            # it; its own timeouts deal with a hung connection
+            slot.stale = slot.collector.fast_only
+            e = "no reading within " + str(slot.deadline) + " seconds"
+        if not slot.failing:
+            print(slot.name + ": high rate polling failed: ", e)
+        slot.failing = True
+        return
+    if readings is None:
+        return      # the collector was busy; no reading this time
+    if slot.failing:
+        print(slot.name + ": high rate polling is back")
+    slot.failing = False
+    for stats,values in zip(slot.stats, readings):
+        stats.add(values)
+
+async def fast_loop(slots, spool, wake):
+    # Poll the fast slots every fast_period seconds, and at the end of
+    # each window spool the summaries of the window just finished
+    tick = int(time.time() // fast_period) + 1
+    window = tick * fast_period // fast_window * fast_window
+    while True:
+        t = tick * fast_period
+        await asyncio.sleep(max(0.0, t - time.time()))
+        if t >= window + fast_window:
+            buf = bytearray()
+            for slot in slots:
+                for stats in slot.stats:
+                    stats.encode_into(buf, round(window * 1e9))
+            if buf:
+                await spool_lines(spool, wake, [bytes(buf)])
+            window = t // fast_window * fast_window
+        await asyncio.gather(*(poll_slot(s) for s in slots))
+        # if polling fell behind, skip the ticks already past
+        tick = max(tick + 1, int(time.time() // fast_period) + 1)
+
+async def run_cycle(slots, spool, wake, cycle):
+    if pack_cycle:
+        results = await asyncio.gather(*(run_slot(s, cycle) for s in slots))
+        lines = [line for r in results for line in r]
+        if lines:
+            await spool_lines(spool, wake, lines)
+            for slot,r in zip(slots, results):
+                if r:
+                    slot.commit(cycle)
+    else:
+        async def one(slot):
+            lines = await run_slot(slot, cycle)
+            if lines:
+                await spool_lines(spool, wake, lines)
+                slot.commit(cycle)
+        await asyncio.gather(*(one(s) for s in slots))
+
+def next_cycle(now):
+    return (int(now // cycle_period) + 1) * cycle_period
+
+async def main():
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    fast_slots = [FastSlot(c) for c in fast_collectors]
+    for c in fast_collectors:
+        c.polled = True
+    slots = [Slot(c, d) for c, d in collectors
+        if not (c in fast_collectors and c.fast_only)]
+    spool = Spool()
+    sender = make_sender()
+    wake = asyncio.Event()
+    wake.set()      # send anything left from last time
+    halt = threading.Event()
+    drain_task = asyncio.create_task(drainer(spool, sender, wake, halt))
+    fast_task = None
+    if fast_slots:
+        fast_task = asyncio.create_task(fast_loop(fast_slots, spool, wake))
+    tasks = set()
+
+    print("logger_daemon: started with " + \
+        ", ".join(s.name for s in slots))
+    if fast_slots:
+        print("logger_daemon: polling " + \
+            ", ".join(s.name for s in fast_slots) + " every " + \
+            str(fast_period) + " seconds")
+    while not stop.is_set():
+        # sleep until the top of the next cycle, or until told to stop
+        cycle = next_cycle(time.time())
+        delay = cycle - time.time()
+        try:
+            await asyncio.wait_for(stop.wait(), delay)
+            break
+        except asyncio.TimeoutError:
+            pass
+        task = asyncio.create_task(run_cycle(slots, spool, wake,
+            cycle * 1_000_000_000))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    print("logger_daemon: shutting down")
+    if fast_task is not None:
+        fast_task.cancel()
+    if tasks:
+        await asyncio.wait(tasks, timeout=5)
+    for slot in slots + fast_slots:
+        if slot.pending is None or slot.pending.done():
+            slot.collector.close()
+    # let a drain in progress finish its batch before closing what it
+    # is using
+    halt.set()
+    drain_task.cancel()
+    await asyncio.gather(drain_task, return_exceptions=True)
+    spool.close()
+    sender.close()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,145 @@
+# logger_funcs.py v.20261018.1
+# copyright 2023 John Ackermann N8UR jra@febo.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Helpers shared by the collectors (therm_usb.py, maser_logger.py,
+# hp5071a.py) and by logger_daemon.py, which runs all of them in
+# one long-lived process.
+
+import socket
+import time
+
+# The file handler for the Telegraf process.
+telegraf_socket = "/var/telegraf/telegraf.sock"
+
+# Where collected data goes: 'telegraf' sends it to telegraf's unix
+# socket; 'influxdb' writes it straight to InfluxDB with the HTTP
+# client in influx_writer.py (set the url, token etc. there).
+output = 'telegraf'
+
+# Every point from a cycle is stamped with the time the cycle started,
+# a multiple of cycle_period seconds, rather than the moment each
+# reading came in.  Points from all the instruments then share exact
+# timestamps and can be pivoted on time as they are (influx_query.py
+# --raw).  How many seconds after the cycle start each instrument's
+# reading actually arrived goes in its latency_field.
+cycle_period = 60
+latency_field = 'acq_latency'
+
+def cycle_time(now=None):
+    # start of the cycle holding unix time now (default the present),
+    # in integer ns
+    if now is None:
+        now = time.time()
+    return int(now // cycle_period * cycle_period) * 1_000_000_000
+
+def latency(cycle):
+    # seconds from cycle (ns) until now
+    return (time.time_ns() - cycle) / 1e9
+
+# Lines are packed into datagrams of up to this many bytes.  Telegraf's
+# socket_listener reads each datagram into a 64 KB buffer.
+max_datagram = 32768
+
+def pack_datagrams(lines, limit=max_datagram):
+    # Join line protocol lines (str or bytes, each ending in a newline)
+    # into as few datagrams as fit under limit.  A line longer than
+    # limit goes out on its own.
+    datagrams = []
+    current = bytearray()
+    for line in lines:
+        if isinstance(line, str):
+            line = line.encode()
+        if current and len(current) + len(line) > limit:
+            datagrams.append(bytes(current))
+            current.clear()
+        current += line
+    if current:
+        datagrams.append(bytes(current))
+    return datagrams
+
+class TelegrafSocket:
+    # Unix datagram connection to the telegraf socket_listener.  The
+    # socket is opened on first use and kept open between cycles;
+    # any error closes it so the next send() reconnects.
+
+    def __init__(self, path=telegraf_socket, timeout=5.0,
+            limit=max_datagram):
+        self.path = path
+        self.timeout = timeout
+        self.limit = limit
+        self.sock = None
+
+    def connect(self):
+        if self.sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.path)
+            except socket.error:
+                sock.close()
+                raise
+            self.sock = sock
+        return self.sock
+
+    def send(self, lines):
+        # lines is a list of complete line protocol strings (or bytes),
+        # each ending in a newline.  They are packed into as few
+        # datagrams as possible.  Raises socket.error on failure.
+        sock = self.connect()
+        try:
+            for datagram in pack_datagrams(lines, self.limit):
+                sock.send(datagram)
+        except socket.error:
+            self.close()
+            raise
+        return len(lines)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+def make_sender():
+    # Return the object with send(lines)/close() for the chosen output
+    if output == 'influxdb':
+        from influx_writer import get_writer
+        return get_writer()
+    return TelegrafSocket()
+
+def send_to_telegraf(lines, name):
+    # Used when a collector is run on its own from logger_1m.sh.  The
+    # lines go into the spool first and then everything in the spool
+    # is sent to the chosen output, so anything left over from a run
+    # when telegraf was down goes out too.  Returns True if the spool
+    # was emptied.
+    from spool import Spool
+    spool = Spool()
+    spool.append(lines)
+    sender = make_sender()
+    try:
+        sent = spool.drain(sender)
+    except OSError as e:
+        print(name + ": couldn't send to " + output + "; data kept in spool")
+        print(name + ": ", e)
+        return False
+    finally:
+        sender.close()
+        spool.close()
+    if sent is None:
+        print(name + ": spool is being drained by another process")
+    else:
+        print(name + ": sent " + str(sent) + " lines to " + output)
+    return True
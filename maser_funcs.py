@@ -1,6 +1,7 @@
-
-# Note: these functions do not return the measure_name or
-# location.  These are prepended in the calling function
+# Line protocol schemas for the VCH-1008 maser replies, one per query
+# in maser_logger.py.  Each schema carries the measurement name and
+# location tag, so maser_logger.py no longer builds that prefix
+# itself.  See line_protocol.py for the field types.
 #
 # update 06May2023: Ole Peter Ronningen found two undocumented
 # fields in the kvd return (h_press and dis_volts) so those have
@@ -8,135 +9,125 @@
 #
 # also correct typo from "cav_base_mistmatch" to
 # "cav_base_mismatch"
+#
+# update 18Oct2026: replaced the string-building *_func functions
+# with schemas; this also fixes the ?STAT handling, which referred
+# to names that were never defined
+#
+# update 18Oct2026: the status word is now written as the int field
+# stat_word plus one bool field per bit (named in stat_flags), and the
+# ppsmea measuring state as the int code measure_state_code.  The old
+# string fields stat_word_dec and measure_state are no longer written.
+#
+# update 18Oct2026: fields that hardly ever change (navstat status,
+# esynsig, synth freq, the RSS levels and the ?STAT fields) have
+# deadbands (see line_protocol.py), so under logger_daemon.py they are
+# only written when they move, or once per heartbeat.  influx_query.py
+# --fill puts the gaps back in exports.
+
+from line_protocol import Schema, Enum, word_flags
+from logger_funcs import latency_field
+
+measure_name = "phm107"
+location = "clockroom"
+tags = {'location': location}
 
-def rss_func(t, fields):
-    msg = \
-            " 5MHz_#1_level=" + str(fields[0]) + \
-            ",5MHz_#2_level=" + str(fields[1]) + \
-            ",10MHz_#1_level=" + str(fields[2]) + \
-            ",10MHz_#2_level=" + str(fields[3]) + \
-            ",100MHz_level=" + str(fields[4]) + \
-            ",2048kHz_level=" + str(fields[5]) + \
-            " " + t + \
-            "\n"
-    return msg
-
-def pwr_func(t, fields):
-    msg = \
-            " bat_vdc=" + str(fields[0]) + \
-            ",ext_27_vdc=" + str(fields[1]) + \
-            ",int_27vdc=" + str(fields[2]) + \
-            ",int+15vdc=" + str(fields[3]) + \
-            ",int-15vdc=" + str(fields[4]) + \
-            ",int+5vdc=" + str(fields[5]) + \
-            " " + t + \
-            "\n"
-    return msg
-
-def kvd_func(t, fields):
-    msg = \
-            " ion_volts=" + str(fields[0]) + \
-            ",ion_current=" + str(fields[1]) + \
-            ",pur_volts=" + str(fields[2]) + \
-            ",pur_current=" + str(fields[3]) + \
-            ",h_press=" + str(fields[4]) + \
-            ",hfo_current=" + str(fields[5]) + \
-            ",hfo_volts=" + str(fields[6]) + \
-            ",dis_volts=" + str(fields[7]) + \
-            " " + t + \
-            "\n"
-    return msg
-
-def fll_func(t, fields):
-    msg = \
-            " 2nd_harm=" + str(fields[0]) + \
-            ",xtal_dac=" + str(fields[1]) + \
-            ",resonator_dac=" + str(fields[2]) + \
-            ",afc_tmp=" + str(fields[3]) + \
-            ",if_level=" + str(fields[4]) + \
-            ",synth_output=" + str(fields[5]) + \
-            ",synth_dac=" + str(fields[6]) + \
-            " " + t + \
-            "\n"
-    return msg
-
-def thr_func(t, fields):
-    msg = \
-            " cav_side_mismatch=" + str(fields[0]) + \
-            ",cav_side_pwr=" + str(fields[1]) + \
-            ",cav_base_mismatch=" + str(fields[2]) + \
-            ",cav_base_pwr=" + str(fields[3]) + \
-            ",h_src_mismatch=" + str(fields[4]) + \
-            ",h_src_pwr=" + str(fields[5]) + \
-            " " + t + \
-            "\n"
-    return msg
-
-def navstat_func(t, fields):
-    msg = \
-            " status=" + str(fields[0]) + \
-            " " + t + \
-            "\n"
-    return msg
-
-def ppsmea_func(t, fields):
+# Field names for the bits of the 32 bit ?STAT status word, bit 0
+# first.  Rename them as you learn what they mean, or set one to None
+# to not log that bit.  (Names can't be reused for another bit: the
+# old data would mean something else.)
+stat_flags = ['stat_bit%02d' % i for i in range(32)]
+
+# deadbands: ('abs', x), ('rel', x) or ('change',), see line_protocol.py
+rss_deadband = ('abs', 0.05)
+steady_deadband = ('change',)
+
+# measure_state_code values for the ppsmea state
+measure_states = Enum('ppsmea', ['STOP','MEASURING'])
+
+def ppsmea_parse(tokens):
     # fields: N0, C0, Nc, C, Nf, dF, STOP/MEASURE, R,
     # n, s, phi, NSN
     # Guess what?  the "STOP/MEASURE" field
     # goes away when we're measuring.
     # we're going to strip their tag and supply
     # our own, just to help document the code
-    count = 0
-    #print("fields going in to ppsmea_func:")
-    #print(fields)
-    if fields[6][:2] == "R=":
-        fields.insert(6,"MEASURING")
-
-    for x in fields:
-        if '=' in x:
-            fields[count] = x.split('=')[-1]
-        count  = count + 1
-
-    msg = \
-            " N0=" + str(fields[0]) + \
-            ",C0=" + str(fields[1]) + \
-            ",Nc=" + str(fields[2]) + \
-            ",C=" + str(fields[3]) + \
-            ",Nf=" + str(fields[4]) + \
-            ",dF=" + str(fields[5]) + \
-            ",measure_state=\"" + str(fields[6]) + "\"" \
-            ",R=" + str(fields[7]) + \
-            ",n=" + str(fields[8]) + \
-            ",s=" + str(fields[9]) + \
-            ",phi=" + str(fields[10]) + \
-            ",NSN=" + str(fields[11]) + \
-            " " + t + \
-            "\n"
-    return msg
-
-def esynsig_func(t, fields):
-    msg = \
-            " synsig=" + fields[0] + \
-            " " + t + "\n"
-    return msg
-
-def synth_func(t, fields):
-    msg = \
-            " freq=" + str(fields[0]) + \
-            " " + t + \
-            "\n"
-    return msg
-
-def stat_func(t, fields):
-    stat_int = int(fields[0])
-    # in below, slice reverses to put LSB first
-    stat_bin = format(stat_int,'032b')[::-1]
-    msg = \
-            " stat_word_dec=\"" + str(stat_int) + "\""
-
-    if len(fields) > 1:
-        stat_msg = stat_msg_bits + ",diag=\"" + str(fields[1]) + "\"" \
-        " " + t + "\n"
-    else:
-        stat_msg = stat_msg_bits + " " + t + "\n"
-    return msg
+    tokens = list(tokens)
+    if tokens[6][:2] == "R=":
+        tokens.insert(6,"MEASURING")
+    values = [x.rpartition('=')[2] for x in tokens[:12]]
+    values[6] = measure_states.code(values[6])
+    return values
+
+# the bits that are logged, or None for all of them
+stat_bits = None
+if None in stat_flags:
+    stat_bits = [i for i,name in enumerate(stat_flags) if name is not None]
+
+# the last status word and its values, as it seldom changes
+last_stat = [(None, None)]
+
+def stat_parse(tokens):
+    # status word, its flags, then optional diagnostic text
+    word = int(tokens[0]) & 0xffffffff
+    last = last_stat[0]
+    if last[0] != word:
+        flags = word_flags(word)
+        if stat_bits is not None:
+            flags = [flags[i] for i in stat_bits]
+        last = (word, tuple([word] + flags))
+        last_stat[0] = last
+    values = list(last[1])
+    values.append(" ".join(tokens[1:]) if len(tokens) > 1 else None)
+    return values
+
+rss_schema = Schema(measure_name, tags, [
+    ('5MHz_#1_level','float'), ('5MHz_#2_level','float'),
+    ('10MHz_#1_level','float'), ('10MHz_#2_level','float'),
+    ('100MHz_level','float'), ('2048kHz_level','float')],
+    deadband={f: rss_deadband for f in ['5MHz_#1_level','5MHz_#2_level',
+    '10MHz_#1_level','10MHz_#2_level','100MHz_level','2048kHz_level']})
+
+pwr_schema = Schema(measure_name, tags, [
+    ('bat_vdc','float'), ('ext_27_vdc','float'), ('int_27vdc','float'),
+    ('int+15vdc','float'), ('int-15vdc','float'), ('int+5vdc','float')])
+
+kvd_schema = Schema(measure_name, tags, [
+    ('ion_volts','float'), ('ion_current','float'),
+    ('pur_volts','float'), ('pur_current','float'),
+    ('h_press','float'), ('hfo_current','float'),
+    ('hfo_volts','float'), ('dis_volts','float')])
+
+fll_schema = Schema(measure_name, tags, [
+    ('2nd_harm','float'), ('xtal_dac','float'), ('resonator_dac','float'),
+    ('afc_tmp','float'), ('if_level','float'), ('synth_output','float'),
+    ('synth_dac','float')])
+
+thr_schema = Schema(measure_name, tags, [
+    ('cav_side_mismatch','float'), ('cav_side_pwr','float'),
+    ('cav_base_mismatch','float'), ('cav_base_pwr','float'),
+    ('h_src_mismatch','float'), ('h_src_pwr','float')])
+
+navstat_schema = Schema(measure_name, tags, [('status','float')],
+    deadband={'status': steady_deadband})
+
+ppsmea_schema = Schema(measure_name, tags, [
+    ('N0','float'), ('C0','float'), ('Nc','float'), ('C','float'),
+    ('Nf','float'), ('dF','float'), ('measure_state_code','int'),
+    ('R','float'), ('n','float'), ('s','float'), ('phi','float'),
+    ('NSN','float')], parse=ppsmea_parse)
+
+esynsig_schema = Schema(measure_name, tags, [('synsig','float')],
+    deadband={'synsig': steady_deadband})
+
+synth_schema = Schema(measure_name, tags, [('freq','float')],
+    deadband={'freq': steady_deadband})
+
+# seconds from the start of the cycle until the replies were in
+latency_schema = Schema(measure_name, tags, [(latency_field,'float')])
+
+stat_schema = Schema(measure_name, tags, [('stat_word','int')] +
+    [(name,'bool') for name in stat_flags if name is not None] +
+    [('diag','string')], parse=stat_parse,
+    deadband={f: steady_deadband for f in ['stat_word','diag'] +
+        [name for name in stat_flags if name is not None]})
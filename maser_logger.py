@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-# maser_logger.py v.20230110.1
+# maser_logger.py v.20261018.1
 # copyright 2023 John Ackermann N8UR jra@febo.com
 #
 # This program is free software; you can redistribute it and/or modify
@@ -14,144 +14,257 @@
 # GNU General Public License for more details.
 
 # This program is called by logger_1m.sh to query a VCH-1008 passive
-# hydrogen maser for operating parameters.
+# hydrogen maser for operating parameters.  It can also be imported
+# by logger_daemon.py, which uses MaserCollector to keep the connection
+# to the maser open between cycles.
+#
+# The maser ends each response with a null byte.  MaserClient holds a
+# keep-alive connection, reads through a buffer until it sees that
+# terminator (so a response split across packets comes back whole),
+# and by default sends the whole query list at once and then reads
+# the responses in order, so a cycle costs about one round trip.
+# Set pipeline = False to go back to one query per round trip if the
+# maser ever drops pipelined queries.
+#
+# All the lines are stamped with the start of the cycle (see
+# cycle_time() in logger_funcs.py), and a last one gives acq_latency,
+# the seconds from then until the replies were in.
+#
+# In logger_daemon.py's high rate mode the fast_queries are sent by
+# poll() every few seconds and summarized per window (see
+# window_stats.py), and left out of the once a minute sample.
 
 import sys
-import signal
 import socket
+import threading
 import time
-from datetime import datetime
-from influxdb_client import InfluxDBClient
 from maser_funcs import *
-
-telegraf_socket = "/var/telegraf/telegraf.sock"
+from logger_funcs import send_to_telegraf, cycle_time, latency
 
 host = "maser.febo.com"
 port = 5000
+timeout = 5.0           # seconds to wait for all responses in a cycle
+pipeline = True
 
-logfile = "/home/jra/maser_log.dat"
-measure_name = "phm107"
-location = "clockroom"
+# reconnect backoff doubles from backoff_min up to backoff_max seconds
+backoff_min = 1.0
+backoff_max = 60.0
 
-# in the below, make sure that each list is the same
-# length, and that the query, function, and message
-# line up
+# in the below, make sure that both lists are the same
+# length, and that each query lines up with its schema
+# (measure_name and location are set in maser_funcs.py)
 
 # these are the queries we send to the maser
 query = ["?RSS","?PWR","?KVD","?FLL","?THR","?NAVSTAT", \
         "?PPSMEA","?ESYNSIG","?SYNTH","?STAT"]
 
-# these are the functions that process the return of each query
-# into the proper format to ship to telegraf
-msg_funcs = [ rss_func, pwr_func, kvd_func, fll_func, thr_func, \
-        navstat_func, ppsmea_func, esynsig_func, synth_func, stat_func ]
+# these are the schemas that turn the return of each query
+# into line protocol to ship to telegraf
+schemas = [ rss_schema, pwr_schema, kvd_schema, fll_schema, thr_schema, \
+        navstat_schema, ppsmea_schema, esynsig_schema, synth_schema, \
+        stat_schema ]
 
 num_queries = len(query)      
-fields = []
-msg = []
 
-def get_data(client, query):
-    client.send(query.encode())
-    from_server = client.recv(255)
-    from_server = from_server[:-1]      # strip trailing null byte
-    fields = from_server.decode('utf8').split()
-    return fields
+# queries polled in high rate mode
+fast_queries = ["?FLL","?KVD"]
 
-def worker(num_tries):
-    attempts = 0
-    got_data = False
-    # create socket with 5 second timeout
-    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client.settimeout(5)
+class MaserClient:
+    # Persistent TCP connection to the maser.  Any socket error closes
+    # the connection, and connect() then refuses to try again until
+    # the backoff delay has passed (raising ConnectionError), so a
+    # caller that runs every minute doesn't hammer a dead link.  Only
+    # one thread at a time uses the connection.
 
-    # check and turn on TCP Keepalive
-    x = client.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
-    if (x == 0):
-        x = client.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    def __init__(self, host=host, port=port, timeout=timeout,
+            pipeline=pipeline):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.pipeline = pipeline
+        self.sock = None
+        self.buf = bytearray()
+        self.failures = 0
+        self.retry_at = 0.0
+        self.lock = threading.RLock()
 
-    # now connect to the server
-    while attempts < num_tries:
+    def connect(self):
+        if self.sock is not None:
+            return
+        wait = self.retry_at - time.monotonic()
+        if wait > 0:
+            raise ConnectionError("waiting " + format(wait, '.0f') + \
+                " seconds before reconnecting to maser")
         try:
-            print("maser_logger: connecting to " + host + " on port " +  str(port))
-            client.connect((host,port))
-            print("maser_logger: connected")
-            break
-        except socket.error as e:
-            print("maser_logger: socket connect failed! Try again in 3 seconds")
-            print("maser_logger: ",e)
-            attempts = attempts + 1
-            time.sleep(5.0)
-            continue
+            sock = socket.create_connection((self.host,self.port),
+                self.timeout)
+        except OSError:
+            self.failed()
+            raise
+        # turn on TCP keepalive, and on Linux notice a dead link
+        # in about a minute rather than two hours
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for opt,val in (('TCP_KEEPIDLE',30),('TCP_KEEPINTVL',10),
+                ('TCP_KEEPCNT',3)):
+            if hasattr(socket, opt):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket,opt), val)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        self.buf.clear()
+        self.failures = 0
+
+    def failed(self):
+        self.close()
+        self.failures = self.failures + 1
+        delay = min(backoff_max, backoff_min * 2 ** (self.failures - 1))
+        self.retry_at = time.monotonic() + delay
+
+    def read_response(self, deadline):
+        # return the next null-terminated response, without the null
+        while True:
+            end = self.buf.find(b'\0')
+            if end >= 0:
+                response = bytes(self.buf[:end])
+                del self.buf[:end + 1]
+                return response
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("timed out waiting for maser response")
+            self.sock.settimeout(remaining)
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise ConnectionError("maser closed the connection")
+            self.buf += chunk
+
+    def query(self, queries):
+        # Send queries and return the responses, each split into fields
+        with self.lock:
+            return self.query_locked(queries)
+
+    def query_locked(self, queries):
+        self.connect()
+        deadline = time.monotonic() + self.timeout
+        responses = []
+        try:
+            if self.pipeline:
+                self.sock.sendall(''.join(queries).encode())
+                for q in queries:
+                    responses.append(self.read_response(deadline))
+            else:
+                for q in queries:
+                    self.sock.sendall(q.encode())
+                    responses.append(self.read_response(deadline))
+        except OSError:
+            self.failed()
+            raise
+        return [r.decode('utf8').split() for r in responses]
+
+    def close(self):
+        with self.lock:
+            if self.sock is not None:
+                try:
+                    self.sock.close()
+                except OSError:
+                    pass
+                self.sock = None
+            self.buf.clear()
 
+def make_messages(client, buf=None, cycle=None, which=None):
+    # Query the maser and return its lines, stamped with cycle (ns;
+    # default the current cycle), as a list holding one bytes object.
+    # Pass a bytearray as buf to reuse it from cycle to cycle, and a
+    # list of indexes into query as which to send only those.
+    if buf is None:
+        buf = bytearray()
+    if cycle is None:
+        cycle = cycle_time()
+    if which is None:
+        which = range(num_queries)
+    buf.clear()
+    replies = client.query([query[x] for x in which])
+    lat = latency(cycle)
+    for x,reply in zip(which, replies):
+        # a float field that isn't a number is left out of its line;
+        # a reply too garbled to parse loses just its own line
+        mark = len(buf)
+        try:
+            schemas[x].encode_tokens_into(buf, reply, cycle)
+        except (ValueError, IndexError):
+            del buf[mark:]
+            print("maser_logger: bad reply to " + query[x] + ": " + \
+                repr(" ".join(reply)))
+    latency_schema.encode_into(buf, [lat], cycle)
+    return [bytes(buf)]
+
+class MaserCollector:
+    # Used by logger_daemon.py.  The MaserClient keeps the connection
+    # open between cycles and handles reconnecting.
+    name = "maser_logger"
+    # high rate mode: (schema, fields) that poll() gives readings for;
+    # the rest still comes from the once a minute sample
+    fast = [(schemas[query.index(q)], None) for q in fast_queries]
+    fast_only = False
+    # committed by logger_daemon.py once a sample's lines are spooled
+    deadbands = [s.deadband for s in schemas if s.deadband is not None]
+
+    def __init__(self, host=host, port=port):
+        self.client = MaserClient(host, port)
+        self.buf = bytearray()
+        self.polled = False     # set by logger_daemon.py in high rate mode
+
+    def sample(self, cycle=None):
+        which = None
+        if self.polled:
+            which = [x for x in range(num_queries)
+                if query[x] not in fast_queries]
+        return make_messages(self.client, self.buf, cycle, which)
+
+    def poll(self):
+        # one reading for each of fast, or None if the once a minute
+        # sample has the connection, rather than waiting behind it
+        if not self.client.lock.acquire(blocking=False):
+            return None
+        try:
+            replies = self.client.query_locked(fast_queries)
+        finally:
+            self.client.lock.release()
+        return [schema.values(r) for (schema,f),r in zip(self.fast, replies)]
+
+    def close(self):
+        self.client.close()
+
+def worker(num_tries):
     attempts = 0
-    while attempts <  num_tries and got_data == False:
+    msg = []
+    client = MaserClient()
+    cycle = cycle_time()
+    print("maser_logger: connecting to " + host + " on port " +  str(port))
+    while attempts < num_tries:
         try:
-            t = str(time.time_ns())
-            for x in range(0, num_queries - 1):
-                fields = get_data(client, query[x])
-                tmp_msg = msg_funcs[x](t, fields)
-                msg.append(measure_name + ",location=" + location + tmp_msg)
-            got_data = True
+            msg = make_messages(client, cycle=cycle)
             print("maser_logger: got data from maser")
-        except socket.timeout as e:
-            print("maser_logger: socket timeout! Try again in 3 seconds")
+            break
+        except OSError as e:
+            print("maser_logger: couldn't get data from maser")
             print("maser_logger: ",e)
             attempts = attempts + 1
-            time.sleep(3)
+            # wait out the reconnect backoff before trying again
+            time.sleep(max(0.0, client.retry_at - time.monotonic()))
         except Exception as e:
             print("maser_logger: other error; exit and try again")
             print("maser_logger: ",e)
             attempts = attempts + 1
-        try:
-            sock.close()
-        except:
-            pass
+    client.close()
+    if not msg:
+        quit()
 
 ##### END OF DATA COLLECTION #####
 
 ##### BEGINNING OF DATA SEND TO TELEGRAF #####
 
-# Connection to Telegraf, over a network socket.
-    attempts = 0
-    while attempts < num_tries and got_data == True:
-        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
-            try:
-                print("maser_logger: trying to connect to telegraf socket")
-                sock.connect(telegraf_socket)
-                sock.settimeout(5.0)
-                print("maser_logger: connected")
-            except socket.error as e:
-                print("maser_logger: connect failed! Try again in 3 seconds")
-                print("maser_logger: ",e)
-                attempts = attempts + 1
-                time.sleep(3.0)
-                break
-            for x in range(len(msg)):
-                try:
-                    sock.send(msg[x].encode())
-                    got_data = False
-                except socket.timeout as e:
-                    print("maser_logger: ",e)
-                    attempts = attempts + 1
-                    time.sleep(3)
-                except Exception as e:
-                    print("maser_logger: other error; exit and try again")
-                    print("maser_logger: ",e)
-                    attempts = attempts + 1
-            print("maser_logger: sent messages to telegraf")
-            try:
-                sock.close()
-            except:
-                pass
-
-    with open(logfile,'a') as f:
-        try:
-            for x in range(len(msg)):
-                f.write(msg[x])
-            f.close()
-        except Exception as e:
-            print("maser_logger: couldn't open log file ", logfile)
-            print("maser_logger: " +e)
+    # this goes through the spool (see spool.py), which also
+    # replaces the old unbounded maser_log.dat
+    send_to_telegraf(msg, "maser_logger")
     quit()   
 
 if __name__ == '__main__':
@@ -1,6 +1,6 @@
 #! /usr/bin/env -S python3      # took away -u to see if it helps
 
-# phm_plot.py v.20230123.1
+# phm_plot.py v.20261018.1
 # copyright 2023 John Ackermann N8UR jra@febo.com
 #
 # This program is free software; you can redistribute it and/or modify
@@ -26,32 +26,85 @@
 # the first line is a list of all the fields with the same delimiter
 # between them.
 #
-# ASSUMPTION: there is a field called 'iso' that contains
-# an iso8601 timestamp for each line, and another called 'unix' that
-# contains a Unix timestamp for each line as in the output file
-# created in the influx_query.py program.  If desired, this
-# could be changed in the code below without too much trouble
+# ASSUMPTION: there is a field called 'unix' that contains a Unix
+# timestamp for each line as in the output file created in the
+# influx_query.py program.  If desired, this could be changed in
+# the code below without too much trouble
 # 
-# Usage: phm_plot.py <input_file>
-# Generates <input_file_basename>.png
+# Batch mode renders many figures without a display: every input file
+# with every layout given, in a pool of worker processes.  A layout is
+# a JSON file setting any of the layout values below (suptitle,
+# subs, num_rows, num_cols, fig_width, ...); the rest keep the values
+# set here.  Each input file is loaded once for all its layouts, and
+# a table of load, draw and save times per figure is printed at the
+# end.
+#
+# Live mode keeps the figure up and adds new data every --live
+# seconds, either from the end of a file that is still being written
+# or straight from InfluxDB.  The figure is built once; each refresh
+# appends only the new rows to fixed size ring buffers, points the
+# existing lines at them, and draws just the new stretch of each line
+# unless the new data has run off the axes.  Traces aren't decimated
+# in live mode.
+#
+# Rollup mode plots the means from the rollup store built by
+# rollup.py rather than a file, at whichever level gives a couple of
+# points per pixel for the range.  On the display, zooming re-reads
+# the zoomed column at the level suited to the new range, so it stays
+# quick from a decade down to an hour.
+#
+# Usage: phm_plot.py [--no-show] <input_file>
+#        phm_plot.py --batch [--layout <layout.json>]... [--jobs N]
+#            [--outdir <dir>] <input_file>...
+#        phm_plot.py --live <seconds> [--window <hours>]
+#            (<input_file> | --influx <agg_val>)
+#        phm_plot.py [--no-show] --rollup <start> <stop>
+# Generates <input_file_basename>.png, or in batch mode
+# <input_file_basename>.<layout>.png for each layout given
 
+import argparse
+import concurrent.futures
+import json
 import os
 import sys
+import time
 from datetime import datetime
-from astropy.io import ascii
-from astropy.table import Table
-import astropy.units as u
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 import matplotlib.dates as mdates
+from matplotlib.figure import Figure
+from data_loader import load_columns, read_header, to_array
+from decimate import minmax, envelope
+from rollup import Rollup, choose_level, to_unix
 
 # delimiter of input data file
 input_delimiter = '\t'
 
-# Show plot on display; make output PNG
+# Show plot on display (unless --no-show); make output PNG.  Batch
+# mode never shows, and always makes a PNG.
 show_disp = True ; make_png = True
 
+# Live mode shows the last live_window seconds, keeping at most
+# live_points rows of each field
+live_window = 24 * 3600
+live_points = 100_000
+
+# Thin each trace to the min and max of each of this many bins per
+# pixel across before plotting (see decimate.py).  It looks the same,
+# spikes and all, but draws in the same time however long the data
+# is.  With 1 bin per pixel faint streaks can show in dense traces.
+# Set to 0 to plot every point.
+decimate = 2
+
+# Files from influx_query.py --stats have <field>_mean, <field>_min,
+# <field>_max... columns in place of <field>.  The mean is plotted as
+# the field, and if envelopes is True its min and max as a shaded band
+# around it, envelope_alpha opaque, in the trace's colour.  The rollup
+# store always has min and max, so rollup mode draws bands too.
+envelopes = True
+envelope_alpha = 0.25
+
 # Plot will have subplots in row, column format
 # with shared x axis as timestamp
 num_rows = 4 ; num_cols = 3
@@ -127,93 +180,530 @@ mpl.rcParams['lines.linewidth'] = 0.6
 
 ############################### CODE BEGINS #############################
 
-# Read in columnular data with tab separated values
-# NOTE: I haven't figured out how to get astropy tables to read
-# field names from a line beginning with '#'
-t = Table.read(sys.argv[1],format='ascii',delimiter=input_delimiter)
-
-# Make X axis based on timestamps
-start_iso = t[0]['iso']
-end_iso = t[len(t)-1]['iso']
-dates=[datetime.fromtimestamp(ts) for ts in t['unix']]
-x=mdates.date2num(dates)
-subtitle = "Data starts " + start_iso + " and ends " + end_iso
-
-# set up figures
-fig, axes = plt.subplots(nrows=num_rows, ncols=num_cols, 
-    figsize=(fig_width, fig_height),sharex='col')
-
-fig.subplots_adjust(b_left,b_bottom,b_right,b_top,horiz_space)
-
-# Position, size, color of title at top
-fig.suptitle(suptitle,size='xx-large',weight='bold',x=0.5,y=0.98)
-
-# Line showing date range at bottom
-fig.text(0.5,0.029,subtitle,horizontalalignment='center',
-    size='large',weight='bold')
-
-# Put input file name at bottom left
-fig.text(0.015,0.011,"Input File: " + os.path.basename(sys.argv[1]),
-    horizontalalignment='left',size='medium')
-# Put date/time plotted at bottom right
-now = "Created: " + datetime.utcnow().isoformat(timespec='seconds') + " UTC"
-fig.text(0.92,0.011,now,horizontalalignment='right',
-    size='medium')
-
-for i, ax in enumerate(axes.flat):
-    # only make as many subs as have data
-    if i > len(subs) - 1:
-        break
-    if subs[i][0] != None:
-        ax.set_title(subs[i][0])
-
-    # there's always at least one y axis
-    if subs[i][2] != None:
-        ax.set_ylabel(subs[i][2],color='red')
-    ax.tick_params(axis='y',colors='red')
-    ax.ticklabel_format(useOffset=False,style='plain')
-    # if we've set limits for the y axis
-    if subs[i][7] != None and subs[i][8] != None:
-        ax.set_ylim(subs[i][7],subs[i][8])
-    ax.plot(x, t[subs[i][1]],color='red',zorder=0)
-
-    # if there's a second y axis
-    if subs[i][3] != None:
-        axa = ax.twinx()
-        if subs[i][4] != None:
-            axa.set_ylabel(subs[i][4],color='blue')
-        axa.tick_params(axis='y',colors='blue')
-        axa.ticklabel_format(useOffset=False,style='plain')
-        # if we've set limits for the y axis
-        if subs[i][9] != None and subs[i][10] != None:
-            axa.set_ylim(subs[i][9],subs[i][10])
-        axa.plot(x, t[subs[i][3]],color='blue',zorder=5)
-
-    # if there's a third y axis
-    if subs[i][5] != None:
-        axb = ax.twinx()
-        if subs[i][6] != None:
-            axb.set_ylabel(subs[i][6],color='green')
-        axb.tick_params(axis='y',colors='green')
-        axb.ticklabel_format(useOffset=False,style='plain')
-        axb.spines.right.set_position(("axes", third_axis_placement))
+# settings a layout file can change
+layout_keys = ['suptitle','subs','num_rows','num_cols','fig_width',
+    'fig_height','b_left','b_bottom','b_right','b_top','horiz_space',
+    'third_axis_placement']
+
+def load_layout(path=None):
+    # the settings above, with any found in JSON file path replacing them
+    layout = dict((k,globals()[k]) for k in layout_keys)
+    if path != None:
+        with open(path) as f:
+            layout.update(json.load(f))
+    return layout
+
+def columns_needed(layout):
+    needed = ['unix']
+    for sub in layout['subs']:
+        needed.extend([f for f in (sub[1],sub[3],sub[5])
+            if f != None and f not in needed])
+    return needed
+
+def load_data(infile, names):
+    # load_columns() for names from infile, taking <field>_mean as
+    # <field> if the file is from influx_query.py --stats, along with
+    # <field>_min and <field>_max for the envelope.  Those are also
+    # loaded for a plain <field> that has them (the summary fields
+    # logger_daemon.py writes in high rate mode).
+    with open(infile, newline='') as f:
+        header = read_header(f, input_delimiter)
+    load = []
+    means = {}
+    for name in names:
+        if name in header or name + '_mean' not in header:
+            load.append(name)
+            if name in header and envelopes and name != 'unix':
+                load.extend([name + s for s in ('_min','_max')
+                    if name + s in header])
+            continue
+        means[name] = name + '_mean'
+        load.append(name + '_mean')
+        if envelopes:
+            load.extend([name + s for s in ('_min','_max')
+                if name + s in header])
+    t = load_columns(infile,load,input_delimiter)
+    for name,col in means.items():
+        t[name] = t[col]
+    return t
+
+def band(ax, x, t, field, color, zorder, thin_data=True):
+    # shade between field's min and max, if t has them
+    if not envelopes or field + '_min' not in t or field + '_max' not in t:
+        return None
+    lo = t[field + '_min'] ; hi = t[field + '_max']
+    if thin_data and decimate:
+        x, lo, hi = envelope(x, lo, hi,
+            decimate * int(ax.get_window_extent().width))
+    return ax.fill_between(x, lo, hi, color=color, alpha=envelope_alpha,
+        linewidth=0, zorder=zorder)
+
+def thin(ax, x, y):
+    # x and y cut down to a few points per pixel across ax
+    if not decimate:
+        return x, y
+    return minmax(x, y, decimate * int(ax.get_window_extent().width))
+
+def render(fig, infile, t, layout, thin_data=True):
+    # Draw the figure for layout onto fig from the columns t read
+    # from infile.  Returns a list of (line, field) for each trace, and
+    # the date range and input file text lines.
+    subs = layout['subs']
+    lines = []
+    num_rows = layout['num_rows'] ; num_cols = layout['num_cols']
+
+    # Make X axis based on timestamps
+    start_iso = str(np.datetime64(int(t['unix'][0]),'s'))
+    end_iso = str(np.datetime64(int(t['unix'][-1]),'s'))
+    # convert the whole column at once: unix seconds -> datetime64 ->
+    # matplotlib date numbers.  Times are UTC, as in the iso column.
+    x=mdates.date2num(np.asarray(t['unix'],dtype=np.int64). \
+        astype('datetime64[s]'))
+    if not thin_data:
+        shrink = lambda ax, x, y: (x, y)
+    else:
+        shrink = thin
+    subtitle = "Data starts " + start_iso + " and ends " + end_iso
+
+    # set up subplots
+    axes = fig.subplots(nrows=num_rows, ncols=num_cols, sharex='col',
+        squeeze=False)
+
+    fig.subplots_adjust(layout['b_left'],layout['b_bottom'],
+        layout['b_right'],layout['b_top'],layout['horiz_space'])
+
+    # Position, size, color of title at top
+    fig.suptitle(layout['suptitle'],size='xx-large',weight='bold',
+        x=0.5,y=0.98)
+
+    # Line showing date range at bottom
+    dates = fig.text(0.5,0.029,subtitle,horizontalalignment='center',
+        size='large',weight='bold')
+
+    # Put input file name at bottom left
+    source = fig.text(0.015,0.011,"Input File: " + os.path.basename(infile),
+        horizontalalignment='left',size='medium')
+    # Put date/time plotted at bottom right
+    now = "Created: " + datetime.utcnow().isoformat(timespec='seconds') + \
+        " UTC"
+    fig.text(0.92,0.011,now,horizontalalignment='right',
+        size='medium')
+
+    for i, ax in enumerate(axes.flat):
+        # only make as many subs as have data
+        if i > len(subs) - 1:
+            break
+        if subs[i][0] != None:
+            ax.set_title(subs[i][0])
+
+        # there's always at least one y axis
+        if subs[i][2] != None:
+            ax.set_ylabel(subs[i][2],color='red')
+        ax.tick_params(axis='y',colors='red')
+        ax.ticklabel_format(useOffset=False,style='plain')
         # if we've set limits for the y axis
-        if subs[i][11] != None and subs[i][12] != None:
-            axb.set_ylim(subs[i][11],subs[i][12])
-        axb.plot(x, t[subs[i][5]],color='green',zorder=10)
-
-# put x axis ticks at bottom of each column
-locator = mdates.AutoDateLocator(minticks = 3, maxticks=7)
-formatter = mdates.ConciseDateFormatter(locator)
-for x in range(num_cols):
-    axes[num_rows - 1,x].xaxis.set_major_locator(locator)
-    axes[num_rows - 1,x].xaxis.set_major_formatter(formatter)
-#    axes[num_rows - 1,x].xaxis.set_major_formatter(mdates.DateFormatter('%d-%b'))
-
-if make_png == True:
-    pngout = os.path.basename(sys.argv[1]) + '.png'
-    print("Saving to",pngout)
-    plt.savefig(pngout,bbox_inches='tight')
-    plt.savefig(pngout)
-if show_disp == True:
+        if subs[i][7] != None and subs[i][8] != None:
+            ax.set_ylim(subs[i][7],subs[i][8])
+        band(ax, x, t, subs[i][1], 'red', 0, thin_data)
+        line, = ax.plot(*shrink(ax, x, t[subs[i][1]]),color='red',zorder=0)
+        lines.append((line, subs[i][1]))
+
+        # if there's a second y axis
+        if subs[i][3] != None:
+            axa = ax.twinx()
+            if subs[i][4] != None:
+                axa.set_ylabel(subs[i][4],color='blue')
+            axa.tick_params(axis='y',colors='blue')
+            axa.ticklabel_format(useOffset=False,style='plain')
+            # if we've set limits for the y axis
+            if subs[i][9] != None and subs[i][10] != None:
+                axa.set_ylim(subs[i][9],subs[i][10])
+            band(axa, x, t, subs[i][3], 'blue', 5, thin_data)
+            line, = axa.plot(*shrink(axa, x, t[subs[i][3]]),color='blue',
+                zorder=5)
+            lines.append((line, subs[i][3]))
+
+        # if there's a third y axis
+        if subs[i][5] != None:
+            axb = ax.twinx()
+            if subs[i][6] != None:
+                axb.set_ylabel(subs[i][6],color='green')
+            axb.tick_params(axis='y',colors='green')
+            axb.ticklabel_format(useOffset=False,style='plain')
+            axb.spines.right.set_position(("axes",
+                layout['third_axis_placement']))
+            # if we've set limits for the y axis
+            if subs[i][11] != None and subs[i][12] != None:
+                axb.set_ylim(subs[i][11],subs[i][12])
+            band(axb, x, t, subs[i][5], 'green', 10, thin_data)
+            line, = axb.plot(*shrink(axb, x, t[subs[i][5]]),color='green',
+                zorder=10)
+            lines.append((line, subs[i][5]))
+
+    # put x axis ticks at bottom of each column
+    locator = mdates.AutoDateLocator(minticks = 3, maxticks=7)
+    formatter = mdates.ConciseDateFormatter(locator)
+    for col in range(num_cols):
+        axes[num_rows - 1,col].xaxis.set_major_locator(locator)
+        axes[num_rows - 1,col].xaxis.set_major_formatter(formatter)
+#        axes[num_rows - 1,col].xaxis.set_major_formatter(mdates.DateFormatter('%d-%b'))
+    return lines, dates, source
+
+def png_name(infile, layout_name=None):
+    name = os.path.basename(infile)
+    if layout_name:
+        name = name + '.' + layout_name
+    return name + '.png'
+
+def plot_one(infile, show):
+    # the original one file, one figure mode
+    layout = load_layout()
+    t = load_data(infile,columns_needed(layout))
+    if show:
+        fig = plt.figure(figsize=(layout['fig_width'],layout['fig_height']))
+    else:
+        fig = Figure(figsize=(layout['fig_width'],layout['fig_height']))
+    render(fig, infile, t, layout)
+    if make_png == True:
+        pngout = png_name(infile)
+        print("Saving to",pngout)
+        fig.savefig(pngout)
+    if show:
+        plt.show()
+
+##### Batch mode #####
+
+def render_file(infile, layouts, outdir):
+    # Worker: load infile once and render it with each of layouts, a
+    # list of (name, layout).  Returns a list of (png, rows, load
+    # seconds, draw seconds, save seconds), one per figure.
+    needed = []
+    for name,layout in layouts:
+        needed.extend([c for c in columns_needed(layout) if c not in needed])
+    start = time.perf_counter()
+    t = load_data(infile,needed)
+    load = time.perf_counter() - start
+    results = []
+    for name,layout in layouts:
+        pngout = os.path.join(outdir, png_name(infile, name))
+        a = time.perf_counter()
+        # a bare Figure rather than pyplot: no display, nothing global
+        fig = Figure(figsize=(layout['fig_width'],layout['fig_height']))
+        render(fig, infile, t, layout)
+        b = time.perf_counter()
+        fig.savefig(pngout)
+        c = time.perf_counter()
+        results.append((pngout, len(t['unix']), load, b - a, c - b))
+        load = 0.0      # the rest share the load
+    return results
+
+def run_batch(files, layout_files, jobs, outdir):
+    layouts = []
+    for path in layout_files:
+        name = os.path.splitext(os.path.basename(path))[0]
+        layouts.append((name, load_layout(path)))
+    if not layouts:
+        layouts = [(None, load_layout())]
+    os.makedirs(outdir, exist_ok=True)
+
+    start = time.perf_counter()
+    results = []
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        futures = dict((pool.submit(render_file, f, layouts, outdir), f)
+            for f in files)
+        for fut in concurrent.futures.as_completed(futures):
+            try:
+                results.extend(fut.result())
+            except Exception as e:
+                print("Couldn't plot",futures[fut] + ":",e)
+                failed = failed + 1
+    wall = time.perf_counter() - start
+
+    print("{:40s} {:>9s} {:>7s} {:>7s} {:>7s} {:>7s}".format(
+        'figure','rows','load','draw','save','total'))
+    for png,rows,load,draw,save in sorted(results):
+        print("{:40s} {:9d} {:7.2f} {:7.2f} {:7.2f} {:7.2f}".format(
+            png,rows,load,draw,save,load + draw + save))
+    print("{} figures in {:.1f} seconds with {} jobs".format(
+        len(results),wall,jobs))
+    return failed == 0
+
+##### Live mode #####
+
+class Ring:
+    # Ring buffer of the newest capacity values.  Everything is stored
+    # twice, capacity apart, so the values in time order are always one
+    # slice of the buffer and view() never copies.
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buf = np.full(2 * capacity, np.nan)
+        self.end = 0            # total values ever appended
+
+    def append(self, a):
+        a = np.asarray(a, dtype=np.float64)[-self.capacity:]
+        index = (self.end + np.arange(len(a))) % self.capacity
+        self.buf[index] = a
+        self.buf[index + self.capacity] = a
+        self.end = self.end + len(a)
+
+    def view(self):
+        if self.end < self.capacity:
+            return self.buf[:self.end]
+        start = self.end % self.capacity
+        return self.buf[start:start + self.capacity]
+
+class FileSource:
+    # New rows appended to an influx_query.py output file
+
+    def __init__(self, path, names, delimiter=input_delimiter):
+        self.name = path
+        self.names = names
+        self.delimiter = delimiter
+        self.f = open(path, newline='')
+        header = read_header(self.f, delimiter)
+        self.index = [header.index(n) for n in names]
+        self.partial = ''
+
+    def read(self):
+        # {name: array} of the rows written since the last read
+        lines = (self.partial + self.f.read()).split('\n')
+        self.partial = lines.pop()
+        values = [[] for n in self.names]
+        for line in lines:
+            if line and line[0] != '#':
+                row = line.rstrip('\r').split(self.delimiter)
+                for v,i in zip(values, self.index):
+                    v.append(row[i] if i < len(row) else '')
+        return dict((n, to_array(n, v)) for n,v in zip(self.names, values))
+
+class InfluxSource:
+    # New aggregated rows from InfluxDB.  Only whole agg_val windows
+    # are asked for, so each row arrives once and never changes.
+
+    def __init__(self, names, agg_val, window):
+        import influx_query as iq
+        self.iq = iq
+        self.name = iq.bucket
+        self.names = names
+        self.fields = [n for n in names if n != 'unix']
+        self.agg_val = agg_val
+        self.agg_len = iq.parse_duration(agg_val)
+        self.last = (time.time() - window) // self.agg_len * self.agg_len
+        self.client = iq.InfluxDBClient(url=iq.url, token=iq.token,
+            org=iq.org, timeout=iq.timeout)
+
+    def read(self):
+        iq = self.iq
+        stop = time.time() // self.agg_len * self.agg_len
+        if stop <= self.last:
+            return dict((n, np.array([])) for n in self.names)
+        q = iq.build_query(iq.format_time(self.last), iq.format_time(stop),
+            self.agg_val, self.fields)
+        rows = list(iq.pivot_rows(iq.query_records(self.client, q),
+            iq.column_names(self.fields)))
+        self.last = stop
+        cols = list(zip(*rows)) if rows else [()] * (len(self.fields) + 1)
+        new = {'unix': iq.unix_times(list(cols[0]))}
+        for n,v in zip(self.fields, cols[1:]):
+            new[n] = to_array(n, list(v))
+        return new
+
+def run_live(source, interval, window):
+    # Draw the figure once, then every interval seconds add the new
+    # rows from source to the ring buffers.  Only the new stretch of
+    # each trace is drawn, over what is already on the canvas, and
+    # blitted to the screen, so a refresh costs about the same however
+    # much history is shown.  The whole figure is only redrawn when new
+    # data runs off the axes (the x axis runs a tenth of the window
+    # past the newest data to leave room); the date range line is
+    # updated then too.
+    layout = load_layout()
+    names = columns_needed(layout)
+    rings = dict((n, Ring(live_points)) for n in names)
+
+    def add(new):
+        if len(new['unix']):
+            for n in names:
+                rings[n].append(new[n])
+        return len(new['unix'])
+
+    add(source.read())
+    if rings['unix'].end == 0:
+        print("No data yet in",source.name)
+        return
+    fig = plt.figure(figsize=(layout['fig_width'],layout['fig_height']))
+    t = dict((n, r.view()) for n,r in rings.items())
+    lines, subtitle, name = render(fig, source.name, t, layout,
+        thin_data=False)
+    # axes with no y limits set in subs are rescaled to fit
+    auto = set(line.axes for line,field in lines
+        if line.axes.get_autoscaley_on())
+    # each trace's new stretch is drawn with a matching animated line,
+    # which a full redraw leaves out
+    tails = [line.axes.plot([],[],color=line.get_color(),
+        zorder=line.get_zorder(),animated=True)[0] for line,field in lines]
+    canvas = fig.canvas
+    plt.show(block=False)
+    dirty = True
+    n = 0
+
+    while plt.fignum_exists(fig.number):
+        unix = rings['unix'].view()
+        x = mdates.date2num(unix.astype(np.int64).astype('datetime64[s]'))
+        for line,field in lines:
+            line.set_data(x, rings[field].view())
+        if dirty:
+            for line,field in lines:
+                ax = line.axes
+                ax.set_xlim(x[-1] - window / 86400, x[-1] + window / 864000)
+                y = rings[field].view()
+                if ax in auto and np.isfinite(y).any():
+                    lo = np.nanmin(y) ; hi = np.nanmax(y)
+                    pad = (hi - lo) * 0.05 or abs(hi) * 0.05 or 1.0
+                    ax.set_ylim(lo - pad, hi + pad)
+            subtitle.set_text("Data starts " +
+                str(np.datetime64(int(unix[0]),'s')) + " and ends " +
+                str(np.datetime64(int(unix[-1]),'s')))
+            canvas.draw()
+            dirty = False
+        elif n:
+            k = min(n + 1, len(x))     # join on to the last old point
+            for (line,field),tail in zip(lines, tails):
+                tail.set_data(x[-k:], rings[field].view()[-k:])
+                line.axes.draw_artist(tail)
+            canvas.blit(fig.bbox)
+        canvas.flush_events()
+
+        plt.pause(interval)
+        n = add(source.read())
+        if n:
+            # only the new values decide whether the axes need redoing
+            x1 = mdates.date2num(np.datetime64(
+                int(rings['unix'].view()[-1]),'s'))
+            for line,field in lines:
+                ax = line.axes
+                if x1 > ax.get_xlim()[1]:
+                    dirty = True
+                y = rings[field].view()[-min(n, live_points):]
+                lo,hi = ax.get_ylim()
+                if ax in auto and np.isfinite(y).any() and \
+                        (np.nanmin(y) < lo or np.nanmax(y) > hi):
+                    dirty = True
+
+##### Rollup mode #####
+
+def rollup_columns(store, names, start, stop, pixels):
+    # the mean, min and max of each field from the rollup store
+    # between unix times start and stop, at the level that suits
+    # pixels across
+    level = choose_level(start, stop, pixels)
+    t = {}
+    for name in names:
+        if name != 'unix':
+            level, d = store.read(name, start, stop, level)
+            t[name] = d['mean']
+            t[name + '_min'] = d['min']
+            t[name + '_max'] = d['max']
+            t['unix'] = d['unix']
+    return level, t
+
+def run_rollup(start, stop, show):
+    # Plot start..stop from the rollup store (see rollup.py).  On the
+    # display, zooming or panning a column re-reads its traces at the
+    # level that suits the new range.
+    layout = load_layout()
+    names = columns_needed(layout)
+    store = Rollup()
+    size = (layout['fig_width'],layout['fig_height'])
+    fig = plt.figure(figsize=size) if show else Figure(figsize=size)
+    pixels = int(fig.get_figwidth() * fig.dpi / layout['num_cols'])
+    level, t = rollup_columns(store, names, to_unix(start), to_unix(stop),
+        pixels)
+    lines, dates, name = render(fig, "rollup " + level, t, layout,
+        thin_data=False)
+    if make_png == True:
+        pngout = 'rollup_' + start[:16].replace(':','') + '_' + \
+            stop[:16].replace(':','') + '.png'
+        print("Saving to",pngout)
+        fig.savefig(pngout)
+    if not show:
+        return
+
+    epoch = mdates.date2num(np.datetime64('1970-01-01T00:00:00'))
+    def zoomed(ax):
+        lo,hi = ax.get_xlim()
+        level, t = rollup_columns(store, names,
+            int((lo - epoch) * 86400), int((hi - epoch) * 86400) + 1, pixels)
+        x = mdates.date2num(t['unix'].astype('datetime64[s]'))
+        for line,field in lines:
+            if ax.get_shared_x_axes().joined(ax, line.axes):
+                line.set_data(x, t[field])
+                # each twin axes holds one trace, so its only
+                # collection is that trace's band
+                for c in list(line.axes.collections):
+                    c.remove()
+                band(line.axes, x, t, field, line.get_color(),
+                    line.get_zorder(), thin_data=False)
+        name.set_text("Input File: rollup " + level)
+        if len(t['unix']):
+            dates.set_text("Data starts " +
+                str(t['unix'][0].astype('datetime64[s]')) + " and ends " +
+                str(t['unix'][-1].astype('datetime64[s]')))
+        fig.canvas.draw_idle()
+    # only the axes actually zoomed gets the callback, not the ones
+    # sharing its x axis
+    for line,field in lines:
+        line.axes.callbacks.connect('xlim_changed', zoomed)
     plt.show()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Plot influx_query.py output")
+    parser.add_argument('input_file', nargs='*')
+    parser.add_argument('--no-show', action='store_true',
+        help="don't show the plot on the display")
+    parser.add_argument('--batch', action='store_true',
+        help="render every file with every layout, without a display")
+    parser.add_argument('--layout', action='append', default=[],
+        help="JSON layout file (batch mode; may be repeated)")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+        help="worker processes for batch mode (default %(default)s)")
+    parser.add_argument('--outdir', default='.',
+        help="where batch mode writes PNGs (default %(default)s)")
+    parser.add_argument('--live', type=float, metavar='SECONDS',
+        help="keep the plot up, adding new data this often")
+    parser.add_argument('--influx', metavar='AGG_VAL',
+        help="live mode: get data from InfluxDB (settings in "
+        "influx_query.py) aggregated by AGG_VAL, not from a file")
+    parser.add_argument('--window', type=float, default=live_window/3600,
+        help="live mode: hours of data to show (default %(default)s)")
+    parser.add_argument('--rollup', nargs=2, metavar=('START','STOP'),
+        help="plot this range from the rollup store instead of a file")
+    args = parser.parse_args()
+    if not args.input_file and not (args.live and args.influx) and \
+            not args.rollup:
+        parser.error("an input file is needed")
+
+    if args.rollup:
+        run_rollup(args.rollup[0], args.rollup[1],
+            show_disp and not args.no_show)
+    elif args.live:
+        window = args.window * 3600
+        names = columns_needed(load_layout())
+        if args.influx:
+            source = InfluxSource(names, args.influx, window)
+        else:
+            source = FileSource(args.input_file[0], names)
+        run_live(source, args.live, window)
+    elif args.batch:
+        if not run_batch(args.input_file, args.layout, args.jobs,
+                args.outdir):
+            sys.exit(1)
+    else:
+        for infile in args.input_file:
+            plot_one(infile, show_disp and not args.no_show)
+
+if __name__ == '__main__':
+    main()
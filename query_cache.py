@@ -0,0 +1,105 @@
+# query_cache.py v.20261018.1
+# copyright 2023 John Ackermann N8UR jra@febo.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Local cache of aggregated query results for influx_query.py --cache.
+#
+# Results are kept per (bucket, field list, agg_val) in a directory
+# named by a hash of those three, as one file per chunk of time.  A
+# chunk covers chunk_len seconds starting at a multiple of chunk_len
+# since the epoch, and holds the output rows (iso, unix, fields...,
+# tab separated, no header) whose time falls in it.  aggregateWindow
+# stamps each row with the end of its window, so chunk i holds the
+# rows with i * chunk_len < time <= (i + 1) * chunk_len.
+#
+# The cache as a whole is kept under max_bytes by deleting the least
+# recently used chunk files.  Reading a chunk touches its mtime, which
+# is what "recently used" goes by.
+
+import hashlib
+import json
+import os
+
+cache_dir = os.path.expanduser('~/.cache/influx_query')
+max_bytes = 2 * 1024 ** 3
+
+class QueryCache:
+
+    def __init__(self, bucket, fields, agg_val, chunk_len, path=cache_dir):
+        self.root = path
+        self.chunk_len = chunk_len
+        key = json.dumps([bucket, list(fields), agg_val, chunk_len])
+        self.dir = os.path.join(path,
+            hashlib.sha1(key.encode()).hexdigest()[:16])
+        os.makedirs(self.dir, exist_ok=True)
+        # a note of what's in here, for anyone poking around
+        with open(os.path.join(self.dir, 'key.json'), 'w') as f:
+            f.write(key + '\n')
+
+    def chunk_path(self, i):
+        return os.path.join(self.dir, '%012d.tsv' % i)
+
+    def chunk_range(self, i):
+        # (start, stop) of chunk i in unix seconds
+        return i * self.chunk_len, (i + 1) * self.chunk_len
+
+    def chunk_of(self, t):
+        # the chunk holding a row stamped t
+        return -int(-t // self.chunk_len) - 1
+
+    def get(self, i):
+        # path of chunk i if it's cached, else None
+        path = self.chunk_path(i)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, i, tmp):
+        # move the finished file tmp into the cache as chunk i
+        os.replace(tmp, self.chunk_path(i))
+
+    def invalidate(self, since):
+        # drop every chunk that ends after unix time since; returns
+        # the number dropped
+        dropped = 0
+        for name in os.listdir(self.dir):
+            if name.endswith('.tsv') and \
+                    self.chunk_range(int(name[:-4]))[1] > since:
+                os.remove(os.path.join(self.dir, name))
+                dropped = dropped + 1
+        return dropped
+
+def evict(path=cache_dir, max_bytes=max_bytes):
+    # Delete least recently used chunks until the whole cache fits in
+    # max_bytes.  Returns the number of bytes freed.
+    files = []
+    total = 0
+    for d in os.listdir(path):
+        sub = os.path.join(path, d)
+        if not os.path.isdir(sub):
+            continue
+        for name in os.listdir(sub):
+            if name.endswith('.tsv'):
+                st = os.stat(os.path.join(sub, name))
+                files.append((st.st_mtime, st.st_size,
+                    os.path.join(sub, name)))
+                total = total + st.st_size
+    freed = 0
+    files.sort()
+    for mtime, size, name in files:
+        if total - freed <= max_bytes:
+            break
+        os.remove(name)
+        freed = freed + size
+    return freed
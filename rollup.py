@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+
+# rollup.py v.20261018.1
+# copyright 2023 John Ackermann N8UR jra@febo.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Local multi-resolution store of the fields in influx_query.py, for
+# plotting long spans quickly.  Each field is rolled up at the levels
+# below into windows holding the sum, min, max and count of the raw
+# points in them (mean is sum / count).  Windows are aligned to the
+# epoch like aggregateWindow's: window k of a level of length L holds
+# points with k * L <= time < (k + 1) * L and is stamped (k + 1) * L.
+#
+# Each level of each field is stored as dense .npy chunks of
+# chunk_slots windows, under rollup_dir/<level>/<field>/<chunk>.npy,
+# with one row of (sum, min, max, count) per window.  Empty windows
+# have count 0 and NaN min and max.  Reads memory map the chunks.
+#
+# "rollup.py update" pulls the raw points newer than the last update
+# from InfluxDB, up to the last whole minute, and writes them into the
+# finest level; the coarser levels are then rebuilt from the level
+# below for just the windows that changed.  Run it from cron or a
+# systemd timer to keep up.  The first update starts at rollup_start.
+#
+# Points can reach InfluxDB well after their timestamps: the spool
+# backlog sent after telegraf was down, or logger_daemon.py's summary
+# points, stamped at the start of their window and sent at its end.  So
+# each update goes back overlap seconds before the last one and rolls
+# that span up again from scratch, replacing what was there.  After a
+# longer outage, "rollup.py update --since <time>" redoes everything
+# from that time.
+#
+# Reading picks the coarsest level that still gives at least
+# points_per_pixel windows per pixel across the plot, so a decade and
+# an hour both come back as a few thousand rows.
+#
+# Usage: rollup.py update [--since <time>]
+#        rollup.py status
+#        rollup.py query <start> <stop> [--pixels N] [--level L]
+#            writes <start>_<stop>_<level>.rollup.dat in influx_query.py
+#            style with <field>_mean, _min, _max and _count columns
+
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+
+rollup_dir = os.path.expanduser('~/rollup')
+
+# (name, seconds), finest first; each must divide the next
+levels = [('1m', 60), ('10m', 600), ('1h', 3600), ('1d', 86400)]
+
+chunk_slots = 8192          # windows per chunk file
+rollup_start = '2023-01-01T00:00:00'    # where the first update starts
+update_span = 7 * 86400     # seconds of raw data fetched per query
+overlap = 3600              # seconds before the last update redone each time
+points_per_pixel = 2
+default_pixels = 1600
+
+def level_len(level):
+    return dict(levels)[level]
+
+def to_unix(t):
+    # ISO8601 (with or without Z) to unix seconds
+    return int(np.datetime64(t.rstrip('Z'), 's').astype(np.int64))
+
+def choose_level(start, stop, pixels=default_pixels):
+    # coarsest level with enough windows between unix times start
+    # and stop for pixels across
+    want = pixels * points_per_pixel
+    for name,seconds in reversed(levels):
+        if (stop - start) / seconds >= want:
+            return name
+    return levels[0][0]
+
+class Rollup:
+
+    def __init__(self, path=rollup_dir):
+        self.path = path
+        self.meta_file = os.path.join(path, 'meta.json')
+
+    ##### meta #####
+
+    def read_meta(self):
+        try:
+            with open(self.meta_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'watermark': to_unix(rollup_start), 'fields': []}
+
+    def write_meta(self, meta):
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.meta_file + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(self.meta_file + '.tmp', self.meta_file)
+
+    ##### chunks #####
+
+    def chunk_file(self, level, field, chunk):
+        return os.path.join(self.path, level, field, '%08d.npy' % chunk)
+
+    def load_chunk(self, level, field, chunk, mode='r'):
+        # the chunk's (chunk_slots, 4) array, or None if there isn't one
+        try:
+            return np.load(self.chunk_file(level, field, chunk),
+                mmap_mode=mode)
+        except FileNotFoundError:
+            return None
+
+    def write_slots(self, level, field, first, rows):
+        # store rows, an (n, 4) array, as windows first .. first + n - 1
+        end = first + len(rows)
+        for chunk in range(first // chunk_slots,
+                (end - 1) // chunk_slots + 1):
+            base = chunk * chunk_slots
+            a = self.load_chunk(level, field, chunk)
+            if a is None:
+                a = np.zeros((chunk_slots, 4))
+                a[:,1:3] = np.nan
+            else:
+                a = np.array(a)
+            lo = max(first, base) ; hi = min(end, base + chunk_slots)
+            a[lo - base:hi - base] = rows[lo - first:hi - first]
+            name = self.chunk_file(level, field, chunk)
+            os.makedirs(os.path.dirname(name), exist_ok=True)
+            with open(name + '.tmp', 'wb') as f:
+                np.save(f, a)
+            os.replace(name + '.tmp', name)
+
+    def read_slots(self, level, field, first, end):
+        # (end - first, 4) array of windows first .. end - 1
+        out = np.zeros((end - first, 4))
+        out[:,1:3] = np.nan
+        for chunk in range(first // chunk_slots,
+                (end - 1) // chunk_slots + 1):
+            a = self.load_chunk(level, field, chunk)
+            if a is None:
+                continue
+            base = chunk * chunk_slots
+            lo = max(first, base) ; hi = min(end, base + chunk_slots)
+            out[lo - first:hi - first] = a[lo - base:hi - base]
+        return out
+
+    ##### building #####
+
+    def add_points(self, field, t, v, start, stop):
+        # Roll raw points (unix seconds t, values v, in time order) from
+        # start up to stop, both whole minutes, into the finest level,
+        # replacing whatever its windows there held, then rebuild the
+        # windows above them.  t must hold every point in that span.
+        name,seconds = levels[0]
+        first = start // seconds
+        end = stop // seconds
+        if end <= first:
+            return
+        ok = np.isfinite(v)
+        t = t[ok] ; v = v[ok]
+        rows = np.zeros((end - first, 4))
+        rows[:,1:3] = np.nan
+        if len(t):
+            slot = t // seconds
+            starts = np.concatenate([[0],
+                np.flatnonzero(np.diff(slot)) + 1])
+            k = slot[starts] - first
+            rows[k,0] = np.add.reduceat(v, starts)
+            rows[k,1] = np.minimum.reduceat(v, starts)
+            rows[k,2] = np.maximum.reduceat(v, starts)
+            rows[k,3] = np.diff(np.concatenate([starts, [len(v)]]))
+        self.write_slots(name, field, first, rows)
+        self.rebuild(field, first, end)
+
+    def rebuild(self, field, first, end):
+        # recompute every coarser window over finest windows first .. end
+        for (fine,fsec),(coarse,csec) in zip(levels[:-1], levels[1:]):
+            f = csec // fsec
+            first = first // f
+            end = -(-end // f)
+            rows = self.read_slots(fine, field, first * f, end * f). \
+                reshape(end - first, f, 4)
+            out = np.empty((end - first, 4))
+            out[:,0] = rows[:,:,0].sum(axis=1)
+            # fmin/fmax skip NaN, and give NaN only if all are
+            out[:,1] = np.fmin.reduce(rows[:,:,1], axis=1)
+            out[:,2] = np.fmax.reduce(rows[:,:,2], axis=1)
+            out[:,3] = rows[:,:,3].sum(axis=1)
+            self.write_slots(coarse, field, first, out)
+
+    ##### reading #####
+
+    def read(self, field, start, stop, level=None, pixels=default_pixels):
+        # Windows stamped start < time <= stop at level (chosen from
+        # pixels if None).  Returns (level, dict of arrays 'unix', 'mean',
+        # 'min', 'max', 'count'); empty windows have NaN mean.
+        if level is None:
+            level = choose_level(start, stop, pixels)
+        seconds = level_len(level)
+        first = start // seconds
+        end = max(stop // seconds, first)
+        rows = self.read_slots(level, field, first, end)
+        count = rows[:,3]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(count > 0, rows[:,0] / count, np.nan)
+        unix = (np.arange(first, end, dtype=np.int64) + 1) * seconds
+        return level, {'unix': unix, 'mean': mean, 'min': rows[:,1],
+            'max': rows[:,2], 'count': count}
+
+##### InfluxDB #####
+
+def raw_points(client, start, stop, fields):
+    # {column: (unix seconds, values)} of the raw points from start up
+    # to stop (unix seconds), one query for all the fields (named as
+    # influx_query.py names its columns)
+    import influx_query as iq
+    q = 'from(bucket: "' + iq.bucket + '")' + \
+        '|> range(start: ' + iq.format_time(start) + ', stop: ' + \
+        iq.format_time(stop) + ')' + iq.select_filter(fields, iq.tags) + \
+        '|> keep(columns: ["_time","_value","_field","_measurement"])'
+    names = iq.column_names(fields)
+    column = {}
+    for (m,f),name in zip(map(iq.split_field, fields), names):
+        column[(m,f)] = name
+    times = dict((f, []) for f in names)
+    values = dict((f, []) for f in names)
+    cols = None
+    for record in iq.query_records(client, q):
+        if not record or record[0].startswith('#'):
+            continue
+        if '_time' in record and '_value' in record:
+            cols = (record.index('_time'), record.index('_value'),
+                record.index('_field'), record.index('_measurement'))
+            continue
+        f = record[cols[2]]
+        name = column.get((record[cols[3]], f), column.get((None, f)))
+        if name is not None:
+            times[name].append(record[cols[0]].rstrip('Z'))
+            values[name].append(record[cols[1]])
+    points = {}
+    for f in names:
+        t = np.array(times[f], dtype='datetime64[ns]').view(np.int64)
+        try:
+            v = np.array(values[f], dtype=str).astype(np.float64)
+        except ValueError:
+            continue        # not a number field; nothing to roll up
+        order = np.argsort(t, kind='stable')
+        points[f] = (t[order] // 1_000_000_000, v[order])
+    return points
+
+def update(rollup, since=None):
+    # roll up everything from overlap seconds before the watermark (or
+    # from unix time since) to the last whole minute
+    import influx_query as iq
+    meta = rollup.read_meta()
+    fields = iq.fields
+    seconds = levels[0][1]
+    now = int(time.time()) // seconds * seconds
+    if since is None:
+        start = max(meta['watermark'] - overlap, to_unix(rollup_start))
+    else:
+        start = since
+    start = start // seconds * seconds
+    total = 0
+    with iq.InfluxDBClient(url=iq.url, token=iq.token, org=iq.org,
+            timeout=iq.timeout) as client:
+        while start < now:
+            stop = min(start + update_span, now)
+            for f,(t,v) in raw_points(client, start, stop, fields).items():
+                rollup.add_points(f, t, v, start, stop)
+                total = total + len(t)
+            meta['watermark'] = stop
+            meta['fields'] = sorted(set(meta['fields']) |
+                set(iq.column_names(fields)))
+            rollup.write_meta(meta)
+            print("rolled up to", iq.format_time(stop), file=sys.stderr)
+            start = stop
+    return total
+
+def write_query(rollup, start, stop, pixels, level):
+    # influx_query.py style output from the rollup store
+    meta = rollup.read_meta()
+    t0 = to_unix(start) ; t1 = to_unix(stop)
+    if level is None:
+        level = choose_level(t0, t1, pixels)
+    outfile = start[:16].replace(':','') + '_' + \
+        stop[:16].replace(':','') + '_' + level + '.rollup.dat'
+    columns = []
+    data = []
+    for f in meta['fields']:
+        level, d = rollup.read(f, t0, t1, level)
+        for stat in ('mean','min','max','count'):
+            columns.append(f + '_' + stat)
+            data.append(d[stat])
+    unix = d['unix'] if meta['fields'] else np.array([], np.int64)
+    iso = unix.astype('datetime64[s]').astype(str)
+    with open(outfile, 'w') as outf:
+        outf.write("# Rollup level {} from {}\n".format(level, rollup.path))
+        outf.write("# Records start at {} and end at {}\n".format(
+            start.rstrip('Z'), stop.rstrip('Z')))
+        outf.write("# Field names:\n")
+        outf.write('\t'.join(['iso','unix'] + columns) + '\n')
+        for i in range(len(unix)):
+            outf.write(iso[i] + '\t' + str(unix[i]) + '\t' +
+                '\t'.join('' if np.isnan(a[i]) else repr(float(a[i]))
+                    for a in data) + '\n')
+    return outfile, level, len(unix)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Multi-resolution rollup of InfluxDB fields")
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    u = sub.add_parser('update', help="add new data from InfluxDB")
+    u.add_argument('--since', metavar='TIME',
+        help="redo everything from TIME (ISO8601) instead of just the "
+            "last " + str(overlap) + " seconds before the last update")
+    sub.add_parser('status', help="show what's stored")
+    q = sub.add_parser('query', help="write a range to a file")
+    q.add_argument('start')
+    q.add_argument('stop')
+    q.add_argument('--pixels', type=int, default=default_pixels,
+        help="plot width the rows are for (default %(default)s)")
+    q.add_argument('--level', choices=[name for name,s in levels],
+        help="use this level instead of choosing one")
+    args = parser.parse_args()
+
+    rollup = Rollup()
+    if args.cmd == 'update':
+        since = None if args.since is None else to_unix(args.since)
+        print("rolled up", update(rollup, since), "points")
+    elif args.cmd == 'status':
+        meta = rollup.read_meta()
+        print("rollup in", rollup.path, "up to",
+            str(np.datetime64(meta['watermark'], 's')))
+        for f in meta['fields']:
+            print("   ", f)
+    else:
+        outfile, level, n = write_query(rollup, args.start, args.stop,
+            args.pixels, args.level)
+        print("Output is in", outfile, "({} rows at {})".format(n, level))
+
+if __name__ == '__main__':
+    main()
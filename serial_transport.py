@@ -0,0 +1,133 @@
+# serial_transport.py v.20261018.1
+# copyright 2023 John Ackermann N8UR jra@febo.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Serial port access for the instrument collectors (therm_usb.py and
+# hp5071a.py).  The tty is opened non-blocking and set to raw 8N1 with
+# termios, and every read or write first waits for the port to be
+# ready with a selector, for no longer than a deadline.  A collector
+# waiting on a slow instrument sleeps in the kernel instead of spinning
+# on inWaiting(), and a silent one gives up at the deadline.
+#
+# Replies are cut into lines at '\n', with a '\r' before it dropped.
+# Anything that came in after a line is kept for the next read_line().
+#
+# Deadlines are time.monotonic() values (see deadline()), so setting
+# the clock can't stretch or cut short a wait.  This blocks rather than
+# using asyncio, since logger_daemon.py runs each sample in a worker
+# thread anyway.
+#
+# fake_serial.py makes a pty that answers like the instruments, to try
+# the collectors against without the hardware.
+
+import os
+import selectors
+import termios
+import time
+
+read_size = 4096
+
+def deadline(timeout):
+    # the deadline timeout seconds from now
+    return time.monotonic() + timeout
+
+def make_raw(fd, speed=None):
+    # raw 8N1 with no flow control and the modem lines ignored.  HUPCL
+    # is left as it was, so closing the port still drops DTR (which
+    # resets an Arduino) the same as before.
+    attr = termios.tcgetattr(fd)
+    attr[0] = 0                                     # iflag
+    attr[1] = 0                                     # oflag
+    attr[2] = termios.CS8 | termios.CREAD | termios.CLOCAL | \
+        (attr[2] & termios.HUPCL)                   # cflag
+    attr[3] = 0                                     # lflag
+    if speed is not None:
+        attr[4] = attr[5] = speed
+    attr[6][termios.VMIN] = 0
+    attr[6][termios.VTIME] = 0
+    termios.tcsetattr(fd, termios.TCSANOW, attr)
+
+class SerialPort:
+
+    def __init__(self, path, baud):
+        speed = getattr(termios, 'B' + str(baud), None)
+        if speed is None:
+            raise ValueError("unsupported baud rate " + str(baud))
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        try:
+            make_raw(self.fd, speed)
+            termios.tcflush(self.fd, termios.TCIOFLUSH)
+        except Exception:
+            os.close(self.fd)
+            raise
+        self.selector = selectors.DefaultSelector()
+        self.buf = bytearray()
+
+    def fileno(self):
+        return self.fd
+
+    def wait(self, event, deadline):
+        # True once the port is ready for event, False at the deadline
+        self.selector.register(self.fd, event)
+        try:
+            while True:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                if self.selector.select(left):
+                    return True
+        finally:
+            self.selector.unregister(self.fd)
+
+    def write(self, data, deadline):
+        # Send all of data, raising TimeoutError if it can't be handed
+        # to the driver by the deadline
+        data = memoryview(data)
+        while data:
+            if not self.wait(selectors.EVENT_WRITE, deadline):
+                raise TimeoutError("write to " + self.path + " timed out")
+            try:
+                n = os.write(self.fd, data)
+            except BlockingIOError:
+                continue
+            data = data[n:]
+
+    def reset_input_buffer(self):
+        # drop anything received and not yet read
+        termios.tcflush(self.fd, termios.TCIFLUSH)
+        self.buf.clear()
+
+    def read_line(self, deadline):
+        # Return the next line as bytes without its terminator, or None
+        # if none is complete by the deadline (a partial line is kept)
+        while True:
+            i = self.buf.find(b'\n')
+            if i >= 0:
+                line = bytes(self.buf[:i])
+                del self.buf[:i + 1]
+                return line[:-1] if line.endswith(b'\r') else line
+            if not self.wait(selectors.EVENT_READ, deadline):
+                return None
+            try:
+                data = os.read(self.fd, read_size)
+            except BlockingIOError:
+                continue
+            if not data:
+                raise ConnectionError(self.path + " hung up")
+            self.buf += data
+
+    def close(self):
+        if self.fd is not None:
+            self.selector.close()
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+
+# spool.py v.20261018.1
+# copyright 2023 John Ackermann N8UR jra@febo.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Crash-safe on-disk spool for line protocol.  Collectors append each
+# cycle's lines here first, and a drainer then sends whatever is in the
+# spool to telegraf (or anything else with a send(lines) method) in big
+# batches.  If telegraf is down the data just waits on disk, and when
+# it comes back the backlog goes out in a few seconds.
+#
+# The spool is a directory of append-only segment files.  A segment
+# being written is named <time_ns>-<pid>.open and is renamed to .seg
+# when it reaches segment_size or the writer closes it.  Writes are
+# flushed at once but only fsync'd every sync_every appends or
+# sync_interval seconds.  For each segment the drainer keeps the byte
+# offset it has sent up to in <time_ns>-<pid>.ack, and deletes the
+# segment once it is closed and fully sent.  Only complete lines are
+# ever sent, so a line torn by a crash is never replayed, and an .open
+# segment left by a dead process is closed on the next drain.
+#
+# A writer holds an flock on its .open segment for as long as it has
+# it, so one nobody has locked was left by a process that died (the
+# kernel drops the lock with the process).  This doesn't go by the pid
+# in the name, which after a reboot may belong to something else.
+#
+# Only one process drains at a time (a lock file sees to that); any
+# number of processes can append, each to its own segment.
+#
+# Lines that can never be sent go to the dead letter file, so they
+# don't hold up everything behind them.  A sender raises Rejected for
+# lines it knows were refused for good (InfluxDB can't parse them).
+# A batch whose sends have failed max_failures times in a row (the
+# count is kept in <time_ns>-<pid>.fail) is sent a part at a time to
+# find the lines that fail on their own; if nothing in it will go, the
+# link is down and it all waits.  "spool.py requeue" puts the dead
+# letters back in the spool, once whatever was wrong is fixed.
+#
+# Usage: spool.py           show what's waiting in the spool
+#        spool.py drain     send it all now (to telegraf, or to InfluxDB
+#                           if output = 'influxdb' in logger_funcs.py)
+#        spool.py requeue   move the dead letters back into the spool
+
+import fcntl
+import os
+import sys
+import threading
+import time
+
+spool_dir = "/home/jra/logger_spool"
+segment_size = 4 * 1024 * 1024  # start a new segment after this many bytes
+sync_every = 16                 # fsync after this many appends...
+sync_interval = 10.0            # ...or this many seconds, whichever first
+max_batch = 64 * 1024           # bytes handed to send() at a time
+max_rate = 20000                # lines per second when draining
+# An unlocked .open segment is only taken to be orphaned once it is
+# this many seconds old, as a writer locks its segment just after
+# making it
+orphan_age = 60
+max_failures = 5                # failed sends of a batch before bisecting it
+dead_letter = 'dead_letter.lp'  # in the spool directory
+
+class Rejected(Exception):
+    # Raised by send(lines) for lines that will never be accepted as
+    # they are; every other line it was given has been sent
+    def __init__(self, lines, reason):
+        Exception.__init__(self, reason)
+        self.lines = lines
+
+class Spool:
+
+    def __init__(self, path=spool_dir, segment_size=segment_size,
+            sync_every=sync_every, sync_interval=sync_interval):
+        self.path = path
+        self.segment_size = segment_size
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        os.makedirs(path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.f = None           # active segment
+        self.base = None        # its name without extension
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    ##### Writing #####
+
+    def append(self, lines):
+        # lines is a list of str or bytes, each ending in a newline
+        data = b''.join(x.encode() if isinstance(x, str) else x
+            for x in lines)
+        if not data:
+            return
+        with self.lock:
+            if self.f is not None and self.f.tell() > 0 and \
+                    self.f.tell() + len(data) > self.segment_size:
+                self.close_segment()
+            if self.f is None:
+                self.base = "%020d-%d" % (time.time_ns(), os.getpid())
+                self.f = open(self.segment(self.base, '.open'), 'ab')
+                fcntl.flock(self.f, fcntl.LOCK_EX)
+            self.f.write(data)
+            self.f.flush()
+            self.unsynced = self.unsynced + 1
+            if self.unsynced >= self.sync_every or \
+                    time.monotonic() - self.last_sync >= self.sync_interval:
+                self.sync()
+
+    def sync(self):
+        if self.f is not None and self.unsynced:
+            os.fsync(self.f.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def close_segment(self):
+        # caller holds self.lock
+        if self.f is None:
+            return
+        self.sync()
+        # renamed before the lock goes with the close, so no drainer
+        # takes it for orphaned in between
+        os.rename(self.segment(self.base, '.open'),
+            self.segment(self.base, '.seg'))
+        self.f.close()
+        self.f = None
+        self.base = None
+
+    def close(self):
+        with self.lock:
+            self.close_segment()
+
+    ##### Draining #####
+
+    def segment(self, base, ext):
+        return os.path.join(self.path, base + ext)
+
+    def read_ack(self, base):
+        try:
+            with open(self.segment(base, '.ack')) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def write_ack(self, base, offset):
+        tmp = self.segment(base, '.ack.tmp')
+        with open(tmp, 'w') as f:
+            f.write(str(offset))
+        os.replace(tmp, self.segment(base, '.ack'))
+
+    def read_failures(self, base):
+        # (offset, count) of the batch whose sends have been failing
+        try:
+            with open(self.segment(base, '.fail')) as f:
+                offset, count = f.read().split()
+            return int(offset), int(count)
+        except (FileNotFoundError, ValueError):
+            return None, 0
+
+    def write_failures(self, base, offset, count):
+        tmp = self.segment(base, '.fail.tmp')
+        with open(tmp, 'w') as f:
+            f.write("%d %d" % (offset, count))
+        os.replace(tmp, self.segment(base, '.fail'))
+
+    def reject(self, lines, reason):
+        # put lines in the dead letter file
+        if not lines:
+            return
+        with open(os.path.join(self.path, dead_letter), 'ab') as f:
+            f.write(b''.join(x if x.endswith(b'\n') else x + b'\n'
+                for x in lines))
+            os.fsync(f.fileno())
+        print("spool: " + str(len(lines)) + " lines can't be sent (" + \
+            reason + "); moved to " + dead_letter)
+
+    def isolate(self, sender, lines):
+        # Send lines a part at a time, halving the parts that fail, and
+        # return the lines that fail on their own.  Raises OSError if
+        # no line goes at all: then the link is down, not the lines bad.
+        bad = []
+        went = False
+        parts = [lines]
+        while parts:
+            part = parts.pop()
+            try:
+                sender.send(part)
+                went = True
+            except Rejected as e:
+                bad.extend(e.lines)
+                went = went or len(e.lines) < len(part)
+            except OSError:
+                if len(part) == 1:
+                    bad.extend(part)
+                else:
+                    half = len(part) // 2
+                    parts.extend([part[half:], part[:half]])
+        if not went:
+            raise OSError("no line of the batch could be sent")
+        return bad
+
+    def recover(self, base):
+        # Close an .open segment whose writer died, dropping any torn
+        # last line.  Returns False, leaving it alone, if its writer
+        # still has it locked (or it is too new to tell).
+        name = self.segment(base, '.open')
+        try:
+            f = open(name, 'r+b')
+        except FileNotFoundError:
+            return False
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            if time.time() - os.fstat(f.fileno()).st_mtime < orphan_age:
+                return False
+            data = f.read()
+            f.truncate(data.rfind(b'\n') + 1)
+            os.fsync(f.fileno())
+            os.rename(name, self.segment(base, '.seg'))
+        return True
+
+    def segments(self):
+        # List of (base, closed) oldest first, tidying up as it goes
+        found = {}
+        for name in os.listdir(self.path):
+            base, ext = os.path.splitext(name)
+            if ext == '.seg':
+                found[base] = True
+            elif ext == '.open':
+                with self.lock:
+                    mine = base == self.base
+                if not mine and self.recover(base):
+                    found[base] = True
+                else:
+                    found.setdefault(base, False)
+        for name in os.listdir(self.path):
+            base, ext = os.path.splitext(name)
+            if ext in ('.ack', '.fail') and base not in found:
+                os.remove(self.segment(base, ext))
+        return sorted(found.items())
+
+    def requeue(self):
+        # Move the dead letters back into the spool; returns how many
+        dead = os.path.join(self.path, dead_letter)
+        try:
+            with open(dead, 'rb') as f:
+                lines = f.read().splitlines(keepends=True)
+        except FileNotFoundError:
+            return 0
+        self.append(lines)
+        self.close()
+        os.remove(dead)
+        return len(lines)
+
+    def dead_letters(self):
+        try:
+            with open(os.path.join(self.path, dead_letter), 'rb') as f:
+                return sum(1 for line in f)
+        except FileNotFoundError:
+            return 0
+
+    def backlog(self):
+        # bytes waiting to be sent
+        total = 0
+        for base, closed in self.segments():
+            ext = '.seg' if closed else '.open'
+            try:
+                size = os.path.getsize(self.segment(base, ext))
+            except FileNotFoundError:
+                continue
+            total = total + size - self.read_ack(base)
+        return total
+
+    def drain(self, sender, max_batch=max_batch, max_rate=max_rate,
+            stop=None):
+        # Send everything in the spool with sender.send(lines), which
+        # should raise OSError on failure, or Rejected.  Returns the
+        # number of lines sent, or None if another process is already
+        # draining.  An OSError from send() is passed up; what was sent
+        # before it stays acknowledged and the rest waits for the next
+        # drain, unless the batch has failed max_failures times: then
+        # the lines in it that fail on their own are dead letters.
+        # Setting stop, a threading.Event, ends it after the batch in
+        # hand.
+        with open(os.path.join(self.path, 'drain.lock'), 'w') as lockf:
+            try:
+                fcntl.flock(lockf, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            sent = 0
+            start = time.monotonic()
+            for base, closed in self.segments():
+                offset = self.read_ack(base)
+                fail_offset, fails = self.read_failures(base)
+                try:
+                    f = open(self.segment(base, '.seg' if closed else '.open'),
+                        'rb')
+                except FileNotFoundError:
+                    # closed by its writer since we looked; next time
+                    continue
+                with f:
+                    f.seek(offset)
+                    while stop is None or not stop.is_set():
+                        chunk = f.read(max_batch)
+                        if len(chunk) == max_batch and b'\n' not in chunk:
+                            chunk = chunk + f.readline()   # very long line
+                        end = chunk.rfind(b'\n') + 1
+                        if end == 0:
+                            break
+                        lines = chunk[:end].splitlines(keepends=True)
+                        bad = []
+                        try:
+                            sender.send(lines)
+                        except Rejected as e:
+                            bad = e.lines
+                            self.reject(bad, str(e))
+                        except OSError:
+                            if fail_offset != offset:
+                                fail_offset, fails = offset, 0
+                            fails = fails + 1
+                            self.write_failures(base, offset, fails)
+                            if fails < max_failures:
+                                raise
+                            bad = self.isolate(sender, lines)
+                            self.reject(bad, "failed " + str(fails) + \
+                                " times")
+                        offset = offset + end
+                        self.write_ack(base, offset)
+                        if fail_offset is not None:
+                            os.remove(self.segment(base, '.fail'))
+                            fail_offset, fails = None, 0
+                        sent = sent + len(lines) - len(bad)
+                        f.seek(offset)
+                        # keep under max_rate lines per second
+                        ahead = sent / max_rate - (time.monotonic() - start)
+                        if ahead > 0:
+                            time.sleep(ahead)
+                if closed and offset >= os.path.getsize(
+                        self.segment(base, '.seg')):
+                    os.remove(self.segment(base, '.seg'))
+                    try:
+                        os.remove(self.segment(base, '.ack'))
+                    except FileNotFoundError:
+                        pass
+            return sent
+
+def main():
+    import logger_funcs
+    spool = Spool()
+    if len(sys.argv) > 1 and sys.argv[1] == 'drain':
+        sender = logger_funcs.make_sender()
+        try:
+            sent = spool.drain(sender)
+        except OSError as e:
+            print("spool: couldn't send to " + logger_funcs.output + ":", e)
+            sys.exit(1)
+        finally:
+            sender.close()
+        if sent is None:
+            print("spool: another process is draining")
+        else:
+            print("spool: sent", sent, "lines")
+    elif len(sys.argv) > 1 and sys.argv[1] == 'requeue':
+        print("spool: put back", spool.requeue(), "lines")
+    else:
+        segs = spool.segments()
+        print("spool:", len(segs), "segments,", spool.backlog(),
+            "bytes waiting in", spool.path)
+        dead = spool.dead_letters()
+        if dead:
+            print("spool:", dead, "dead letters in",
+                os.path.join(spool.path, dead_letter))
+
+if __name__ == '__main__':
+    main()
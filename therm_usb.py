@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-# therm_usb.py v.20230110.1
+# therm_usb.py v.20261018.1
 # copyright 2023 John Ackermann N8UR jra@febo.com
 #
 # This program is free software; you can redistribute it and/or modify
@@ -14,87 +14,131 @@
 
 # This program is called by logger_1m.sh to query an Arduino via USB
 # to gather data from a BME280 temp/humidity/pressure sensor and an
-# RTD thermometer
+# RTD thermometer.  It can also be imported by logger_daemon.py, which
+# uses ThermCollector to keep the port open between cycles.
+#
+# The point is stamped with the start of the cycle (see cycle_time() in
+# logger_funcs.py), with acq_latency the seconds from then until the
+# Arduino answered.
+#
+# In logger_daemon.py's high rate mode the Arduino is read by poll()
+# every few seconds instead, and one summary point per window is
+# written (see window_stats.py).
+#
+# The port is read through serial_transport.py, which sleeps until the
+# Arduino answers or the timeout is up, rather than spinning on
+# inWaiting() (which also never gave up on a silent Arduino).
 
 
 import sys
-import signal
-import socket
-import serial
-import time
-from datetime import datetime
-from datetime import timezone
-
-from influxdb_client import InfluxDBClient
-
-port = sys.argv[1]
-
-### GET DATA ###
-try:
-    ser = serial.Serial(port, 115200, timeout=0.5)
-except:
-    print("therm_usb: couldn't open serial port ", port)
-    exit()
-
-try:
-    ser.write(b'D') # this can be anything but tilde (~) 
-except serial.SerialTimeoutException:
-    print("therm_usb: timeout while sending prompt")
-    exit()
-
-timeout = time.time() + 20 # wait up to 20 seconds for response
-while True:
-    while not ser.inWaiting():
-        pass
-    if time.time() > timeout:
+
+from serial_transport import SerialPort, deadline
+from logger_funcs import send_to_telegraf, cycle_time, latency, \
+    latency_field
+from line_protocol import Schema
+
+measure_name = "therm1"
+location = "clockroom"
+
+schema = Schema(measure_name, {'location': location}, [
+    ('rtd_temp','float'), ('bme_temp','float'),
+    ('pressure','float'), ('humidity','float'),
+    (latency_field,'float')])
+baud = 115200
+response_timeout = 20   # wait up to 20 seconds for response
+
+def open_port(port):
+    return SerialPort(port, baud)
+
+def get_data(ser, timeout=response_timeout):
+    # Prompt the Arduino and return its reply split into fields,
+    # or None if it doesn't answer before the timeout.
+    until = deadline(timeout)
+    ser.reset_input_buffer()
+    ser.write(b'D', until) # this can be anything but tilde (~)
+    from_sensor = ser.read_line(until)
+    if from_sensor is None:
+        return None
+    return from_sensor.decode('utf8').split()
+
+# the fields summarized in high rate mode
+fast_fields = ['rtd_temp','bme_temp','pressure','humidity']
+
+def make_message(fields, cycle, lat):
+    # the reply's fields fill the schema up to the latency at the end
+    values = schema.values(fields)
+    values[-1] = lat
+    return schema.encode(values, cycle)
+
+class ThermCollector:
+    # Used by logger_daemon.py.  The port is opened on the first
+    # sample and left open; any error closes it so the next cycle
+    # starts from a fresh open.
+    name = "therm_usb"
+    # high rate mode: (schema, fields) that poll() gives readings for,
+    # and no once a minute sample is needed as well
+    fast = [(schema, fast_fields)]
+    fast_only = True
+    deadbands = []
+
+    def __init__(self, port):
+        self.port = port
+        self.ser = None
+
+    def read(self):
+        try:
+            if self.ser is None:
+                self.ser = open_port(self.port)
+            fields = get_data(self.ser)
+        except Exception:
+            self.close()
+            raise
+        if fields is None:
+            self.close()
+            raise TimeoutError("didn't get therm response")
+        return fields
+
+    def sample(self, cycle=None):
+        if cycle is None:
+            cycle = cycle_time()
+        fields = self.read()
+        return [make_message(fields, cycle, latency(cycle))]
+
+    def poll(self):
+        # one reading for each of fast
+        return [schema.values(self.read())]
+
+    def close(self):
+        if self.ser is not None:
+            try:
+                self.ser.close()
+            except Exception:
+                pass
+            self.ser = None
+
+def main():
+    port = sys.argv[1]
+    cycle = cycle_time()
+
+    ### GET DATA ###
+    try:
+        ser = open_port(port)
+    except:
+        print("therm_usb: couldn't open serial port ", port)
+        exit()
+
+    try:
+        fields = get_data(ser)
+        lat = latency(cycle)
+    except TimeoutError:
+        print("therm_usb: timeout while sending prompt")
+        exit()
+    ser.close()
+    if fields is None:
         print("therm_usb: didn't get therm response")
         exit()
-    from_sensor = ser.readline()
-    break
-ser.close()
-
-fields = from_sensor.decode('utf8').split()
-message =   "therm1" + \
-    ",location=clockroom" + \
-    " rtd_temp=" + str(fields[0]) + \
-    ",bme_temp=" + str(fields[1]) + \
-    ",pressure=" + str(fields[2]) + \
-    ",humidity=" + str(fields[3]) + \
-    " " + str(time.time_ns()) + \
-    "\n"
-#The file handler for the Telegraf process.
-telegraf_socket = "/var/telegraf/telegraf.sock"
-
-# Connection to Telegraf, over a network socket.
-with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
-    sock.settimeout(5)
-    attempts = 0
-    while attempts < 3:
-        try:
-            sock.connect(telegraf_socket)
-            print("therm_usb: connected to telegraf socket")
-        except socket.error as e:
-            print("therm_usb: couldn't connect to telegraf!")
-            print("Try again in 3 seconds")
-            print(e)
-            attempts = attempts + 1
-            time.sleep(3)
-            break
-        try:
-            print("therm_usb: sending to telegraf socket")
-            sock.send(message.encode())
-            attempts = 3
-        except socket.error as e:
-            print("therm_usb: couldn't send to socket; wait and try again")
-            print(e)
-            attempts = attempts + 1
-            time.sleep(3)
-            break
-        try:
-            sock.close()
-            attempts = 3
-        except socket.error as e:
-            print("therm_usb: couldn't close socket!")
-            print(e)
-            break
-quit()
+
+    send_to_telegraf([make_message(fields, cycle, lat)], "therm_usb")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# window_stats.py v.20261018.1
+# copyright 2023 John Ackermann N8UR jra@febo.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Running statistics for the high rate mode of logger_daemon.py.  A
+# device polled every second or so would write sixty times as many
+# points as it does now; instead each reading is folded into running
+# totals for each field, and once a window only a summary point goes
+# out.  For each float field of the schema the summary has:
+#
+#   <field>          mean (under the plain name, so queries and plots
+#                    of the one-a-minute data carry on working)
+#   <field>_min      lowest reading
+#   <field>_max      highest reading
+#   <field>_stddev   sample standard deviation (left out under 2
+#                    readings)
+#   <field>_count    number of readings (int)
+#
+# Mean and variance are kept with Welford's method, so each reading is
+# a few arithmetic operations whatever the window length and there is
+# no loss of precision from summing squares of large values.  Readings
+# that are missing or not finite numbers are skipped.
+
+import math
+
+from line_protocol import Schema
+
+class WindowStats:
+
+    def __init__(self, schema, fields=None):
+        # summarize the float fields of schema named in fields (default
+        # all of them); add() takes values in the schema's field order
+        if fields is None:
+            fields = [name for name,ftype in schema.fields
+                if ftype == 'float']
+        self.index = [schema.field_names.index(f) for f in fields]
+        out = []
+        for f in fields:
+            out.extend([(f,'float'), (f + '_min','float'),
+                (f + '_max','float'), (f + '_stddev','float'),
+                (f + '_count','int')])
+        self.schema = Schema(schema.measurement, schema.tags, out)
+        self.reset()
+
+    def reset(self):
+        k = len(self.index)
+        self.n = [0] * k
+        self.mean = [0.0] * k
+        self.m2 = [0.0] * k
+        self.min = [math.inf] * k
+        self.max = [-math.inf] * k
+
+    def add(self, values):
+        # fold in one reading of the schema's fields
+        for j,i in enumerate(self.index):
+            x = values[i] if i < len(values) else None
+            if x is None:
+                continue
+            try:
+                x = float(x)
+            except ValueError:
+                continue
+            if not math.isfinite(x):
+                continue
+            n = self.n[j] + 1
+            d = x - self.mean[j]
+            self.mean[j] = self.mean[j] + d / n
+            self.m2[j] = self.m2[j] + d * (x - self.mean[j])
+            self.n[j] = n
+            if x < self.min[j]:
+                self.min[j] = x
+            if x > self.max[j]:
+                self.max[j] = x
+
+    def count(self):
+        return max(self.n, default=0)
+
+    def encode_into(self, buf, t):
+        # append the summary line stamped t (ns) to buf and start a new
+        # window.  Returns False, appending nothing, if nothing came in.
+        values = []
+        for j in range(len(self.index)):
+            n = self.n[j]
+            if n == 0:
+                values.extend([None] * 5)
+                continue
+            stddev = math.sqrt(self.m2[j] / (n - 1)) if n > 1 else None
+            values.extend([self.mean[j], self.min[j], self.max[j],
+                stddev, n])
+        self.reset()
+        return self.schema.encode_into(buf, values, int(t))